@@ -1,20 +1,134 @@
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.util.queue import AsyncAdaptedQueue
+from sqlalchemy import exc
 from . import models 
-from config import DATABASE_URL
-from typing import AsyncGenerator
+from config import DATABASE_URL, DB_PROFILE, DB_POOL_WAIT_WARN_MS, DB_AUTO_MIGRATE
+from .migrations import current_version, latest_version, run_migrations
+from app.services.metrics import Gauge
+from typing import AsyncGenerator, Optional
 import logging 
+import os
+import time
+
+logger = logging.getLogger(__name__)
 
 class Base(DeclarativeBase):
     pass
 
 if DATABASE_URL and not DATABASE_URL.startswith("postgresql+asyncpg"):
     MODIFIED_DATABASE_URL = DATABASE_URL.replace("postgresql", "postgresql+asyncpg", 1)
-    logging.info("DATABASE_URL модифицирован для использования asyncpg.")
+    logger.info("DATABASE_URL модифицирован для использования asyncpg.")
 else:
     MODIFIED_DATABASE_URL = DATABASE_URL
 
-engine = create_async_engine(MODIFIED_DATABASE_URL, echo=True)
+# Профили движка; отдельные значения можно переопределить через DB_POOL_SIZE и т.п.
+ENGINE_PROFILES = {
+    "dev": {
+        "pool_size": 5, "max_overflow": 5, "pool_timeout": 30, "pool_pre_ping": True,
+        "pool_recycle": 1800, "statement_cache_size": 100, "echo": True,
+    },
+    "prod": {
+        "pool_size": 20, "max_overflow": 10, "pool_timeout": 10, "pool_pre_ping": True,
+        "pool_recycle": 1800, "statement_cache_size": 500, "echo": False,
+    },
+    "benchmark": {
+        "pool_size": 50, "max_overflow": 0, "pool_timeout": 30, "pool_pre_ping": False,
+        "pool_recycle": -1, "statement_cache_size": 1000, "echo": False,
+    },
+}
+
+
+def _engine_settings(profile: str) -> dict:
+    if profile not in ENGINE_PROFILES:
+        raise ValueError(f"Неизвестный DB_PROFILE '{profile}', ожидается один из: {', '.join(ENGINE_PROFILES)}")
+    settings = dict(ENGINE_PROFILES[profile])
+    for key, value in settings.items():
+        override = os.getenv(f"DB_{key.upper()}")
+        if override is not None:
+            settings[key] = override.lower() == "true" if isinstance(value, bool) else type(value)(override)
+    return settings
+
+
+class PoolMetrics:
+    """Счётчики пула соединений БД: занятость, ожидание выдачи, overflow и таймауты."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.checkouts = 0
+        self.wait_total_s = 0.0
+        self.wait_max_s = 0.0
+        self.slow_checkouts = 0
+        self.overflow_checkouts = 0
+        self.timeouts = 0
+
+    def record_checkout(self, waited_s: float, pool: "InstrumentedPool"):
+        self.checkouts += 1
+        self.wait_total_s += waited_s
+        self.wait_max_s = max(self.wait_max_s, waited_s)
+        if pool.checkedout() > pool.size():
+            self.overflow_checkouts += 1
+        if waited_s * 1000 >= DB_POOL_WAIT_WARN_MS:
+            self.slow_checkouts += 1
+            logger.warning(
+                f"⏳ Ожидание соединения из пула БД {waited_s * 1000:.0f} мс "
+                f"(занято {pool.checkedout()}, размер {pool.size()}, overflow {max(pool.overflow(), 0)})."
+            )
+
+
+pool_metrics = PoolMetrics()
+
+
+class _TimedQueue(AsyncAdaptedQueue):
+    """Очередь свободных соединений, которая помечает выданную запись временем ожидания в ней."""
+
+    def get(self, block: bool = True, timeout: Optional[float] = None):
+        started = time.perf_counter()
+        record = super().get(block, timeout)
+        record.queue_wait_s = time.perf_counter() - started
+        return record
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """Пул, который меряет ожидание свободного соединения.
+
+    В ожидание входит только время в очереди пула: открытие нового
+    соединения (первое заполнение или overflow) и pre-ping меряют сеть и
+    саму БД, а не нехватку соединений, и в метрику не попадают.
+    """
+    _queue_class = _TimedQueue
+
+    def connect(self):
+        try:
+            connection = super().connect()
+        except exc.TimeoutError:
+            pool_metrics.timeouts += 1
+            raise
+        waited_s = vars(connection._connection_record).pop("queue_wait_s", 0.0)
+        pool_metrics.record_checkout(waited_s, self)
+        return connection
+
+
+ENGINE_SETTINGS = _engine_settings(DB_PROFILE)
+
+# echo=True повесил бы на sqlalchemy.engine собственный синхронный StreamHandler
+# в обход очереди логов, поэтому SQL включаем уровнем логгера.
+if ENGINE_SETTINGS["echo"]:
+    logging.getLogger("sqlalchemy.engine").setLevel(logging.INFO)
+
+engine = create_async_engine(
+    MODIFIED_DATABASE_URL,
+    poolclass=InstrumentedPool,
+    pool_size=ENGINE_SETTINGS["pool_size"],
+    max_overflow=ENGINE_SETTINGS["max_overflow"],
+    pool_timeout=ENGINE_SETTINGS["pool_timeout"],
+    pool_pre_ping=ENGINE_SETTINGS["pool_pre_ping"],
+    pool_recycle=ENGINE_SETTINGS["pool_recycle"],
+    connect_args={"prepared_statement_cache_size": ENGINE_SETTINGS["statement_cache_size"]},
+)
 
 AsyncSessionLocal = async_sessionmaker(
     bind=engine, 
@@ -22,10 +136,42 @@ AsyncSessionLocal = async_sessionmaker(
     expire_on_commit=False
 )
 
+
+def pool_stats() -> dict:
+    """Текущее состояние пула: сколько соединений выдано и сколько ждали выдачи."""
+    pool = engine.sync_engine.pool
+    return {
+        "profile": DB_PROFILE,
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "overflow": max(pool.overflow(), 0),
+        "checkouts": pool_metrics.checkouts,
+        "wait_avg_ms": pool_metrics.wait_total_s / pool_metrics.checkouts * 1000 if pool_metrics.checkouts else 0.0,
+        "wait_max_ms": pool_metrics.wait_max_s * 1000,
+        "slow_checkouts": pool_metrics.slow_checkouts,
+        "overflow_checkouts": pool_metrics.overflow_checkouts,
+        "timeouts": pool_metrics.timeouts,
+    }
+
+Gauge("db_pool_size", "Размер пула соединений БД.", lambda: engine.sync_engine.pool.size())
+Gauge("db_pool_checked_out", "Выданные из пула соединения БД.", lambda: engine.sync_engine.pool.checkedout())
+Gauge("db_pool_overflow", "Соединения сверх pool_size.", lambda: max(engine.sync_engine.pool.overflow(), 0))
+Gauge("db_pool_checkout_wait_max_seconds", "Максимальное ожидание соединения из пула.", lambda: pool_metrics.wait_max_s)
+Gauge("db_pool_timeouts", "Таймауты ожидания соединения из пула с запуска.", lambda: pool_metrics.timeouts)
+
 async def init_db():
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
-        logging.info("База данных инициализирована и таблицы созданы.")
+    """Сверяет версию схемы; DDL выполняется, только если база отстала."""
+    version = await current_version(engine)
+    target = latest_version()
+    if version >= target:
+        logger.info(f"База данных актуальна (схема v{version}).")
+        return
+
+    if not DB_AUTO_MIGRATE:
+        raise RuntimeError(f"Схема БД v{version} устарела (нужна v{target}). Запустите python migrate.py.")
+
+    version = await run_migrations(engine)
+    logger.info(f"База данных инициализирована, схема обновлена до v{version}.")
 
 async def get_session() -> AsyncGenerator[AsyncSession, None]:
     async with AsyncSessionLocal() as session:
@@ -38,5 +184,9 @@ async def get_session() -> AsyncGenerator[AsyncSession, None]:
             await session.close()
 
 async def get_db_session() -> AsyncSession:
-    """Простой асинхронный метод для получения сессии."""
+    """Простой асинхронный метод для получения сессии.
+
+    Соединение берётся из пула при первом запросе; ожидание дольше
+    DB_POOL_WAIT_WARN_MS логируется, общая картина — в pool_stats().
+    """
     return AsyncSessionLocal()
@@ -0,0 +1,103 @@
+"""Версионированные миграции схемы.
+
+Каждая миграция — модуль vNNNN_*.py с VERSION, DESCRIPTION, флагом
+TRANSACTIONAL и функцией upgrade(conn). Нетранзакционные миграции
+выполняются в AUTOCOMMIT, чтобы строить индексы CONCURRENTLY без
+блокировки записи. Применённые версии хранятся в таблице schema_version.
+"""
+import importlib
+import logging
+import pkgutil
+from datetime import datetime
+from types import ModuleType
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+logger = logging.getLogger(__name__)
+
+# Произвольный ключ advisory-lock, чтобы миграции не шли из двух реплик одновременно.
+MIGRATION_LOCK_KEY = 7_114_201
+
+
+def load_migrations() -> list[ModuleType]:
+    modules = [
+        importlib.import_module(f"{__name__}.{info.name}")
+        for info in pkgutil.iter_modules(__path__)
+        if info.name.startswith("v")
+    ]
+    return sorted(modules, key=lambda module: module.VERSION)
+
+
+def latest_version() -> int:
+    migrations = load_migrations()
+    return migrations[-1].VERSION if migrations else 0
+
+
+async def _ensure_version_table(conn: AsyncConnection):
+    await conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_version ("
+        " version INTEGER PRIMARY KEY,"
+        " description VARCHAR(200) NOT NULL,"
+        " applied_at TIMESTAMP NOT NULL)"
+    ))
+
+
+async def current_version(engine: AsyncEngine) -> int:
+    async with engine.connect() as conn:
+        exists = await conn.scalar(text("SELECT to_regclass('schema_version') IS NOT NULL"))
+        if not exists:
+            return 0
+        return await conn.scalar(text("SELECT COALESCE(MAX(version), 0) FROM schema_version")) or 0
+
+
+async def create_index_concurrently(conn: AsyncConnection, name: str, ddl: str):
+    """CREATE INDEX CONCURRENTLY с уборкой невалидного индекса от прерванной попытки.
+
+    ddl — выражение после имени индекса, например "ON subscriptions (user_id)".
+    """
+    invalid = await conn.scalar(text(
+        "SELECT NOT i.indisvalid FROM pg_index i"
+        " JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = :name"
+    ), {"name": name})
+    if invalid:
+        logger.warning(f"Индекс {name} невалиден после прерванной сборки, пересоздаём.")
+        await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+    await conn.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} {ddl}"))
+
+
+async def run_migrations(engine: AsyncEngine) -> int:
+    """Применяет недостающие миграции по порядку и возвращает итоговую версию."""
+    async with engine.connect() as lock_conn:
+        lock_conn = await lock_conn.execution_options(isolation_level="AUTOCOMMIT")
+        await lock_conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+        try:
+            await _ensure_version_table(lock_conn)
+            version = await current_version(engine)
+
+            for migration in load_migrations():
+                if migration.VERSION <= version:
+                    continue
+
+                logger.info(f"🛠 Миграция {migration.VERSION}: {migration.DESCRIPTION}...")
+                if migration.TRANSACTIONAL:
+                    async with engine.begin() as conn:
+                        await migration.upgrade(conn)
+                        await _record_version(conn, migration)
+                else:
+                    async with engine.connect() as conn:
+                        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+                        await migration.upgrade(conn)
+                        await _record_version(conn, migration)
+                version = migration.VERSION
+                logger.info(f"✅ Миграция {migration.VERSION} применена.")
+
+            return version
+        finally:
+            await lock_conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_LOCK_KEY})
+
+
+async def _record_version(conn: AsyncConnection, migration: ModuleType):
+    await conn.execute(
+        text("INSERT INTO schema_version (version, description, applied_at) VALUES (:version, :description, :applied_at)"),
+        {"version": migration.VERSION, "description": migration.DESCRIPTION, "applied_at": datetime.utcnow()},
+    )
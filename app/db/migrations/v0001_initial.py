@@ -0,0 +1,41 @@
+"""Базовая схема: таблицы users и subscriptions.
+
+DDL зафиксирован таким, каким был на момент появления миграции, и не
+зависит от текущих моделей: более поздние изменения схемы приходят
+своими миграциями. IF NOT EXISTS делает миграцию безопасной для баз,
+созданных до появления schema_version.
+"""
+from sqlalchemy import text
+
+VERSION = 1
+DESCRIPTION = "users и subscriptions"
+TRANSACTIONAL = True
+
+DDL = (
+    "CREATE TABLE IF NOT EXISTS users ("
+    " id BIGSERIAL NOT NULL,"
+    " username VARCHAR(50),"
+    " registration_date TIMESTAMP WITHOUT TIME ZONE NOT NULL,"
+    " PRIMARY KEY (id))",
+    "CREATE TABLE IF NOT EXISTS subscriptions ("
+    " id SERIAL NOT NULL,"
+    " marzban_username VARCHAR(100),"
+    " tariff_code VARCHAR(10) NOT NULL,"
+    " expires_at TIMESTAMP WITHOUT TIME ZONE,"
+    " data_limit_gb INTEGER NOT NULL,"
+    " status VARCHAR(20) NOT NULL,"
+    " created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,"
+    " user_id BIGINT NOT NULL,"
+    " invoice_id VARCHAR(100),"
+    " is_paid BOOLEAN NOT NULL,"
+    " vpn_link VARCHAR(500),"
+    " PRIMARY KEY (id),"
+    " FOREIGN KEY (user_id) REFERENCES users (id))",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_subscriptions_marzban_username ON subscriptions (marzban_username)",
+    "CREATE INDEX IF NOT EXISTS ix_subscriptions_status ON subscriptions (status)",
+)
+
+
+async def upgrade(conn):
+    for statement in DDL:
+        await conn.execute(text(statement))
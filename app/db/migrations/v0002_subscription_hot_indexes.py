@@ -0,0 +1,24 @@
+"""Индексы под горячие запросы к subscriptions, строятся CONCURRENTLY."""
+from app.db.migrations import create_index_concurrently
+
+VERSION = 2
+DESCRIPTION = "индексы subscriptions: проверка пробного доступа, неоплаченные инвойсы, expires_at"
+TRANSACTIONAL = False
+
+
+async def upgrade(conn):
+    # start_cmd: WHERE user_id = ? AND tariff_code = ?
+    await create_index_concurrently(
+        conn, "ix_subscriptions_user_tariff",
+        "ON subscriptions (user_id, tariff_code)",
+    )
+    # check_crypto_payments и вебхук: WHERE is_paid = false AND invoice_id IS NOT NULL
+    await create_index_concurrently(
+        conn, "ix_subscriptions_pending_invoices",
+        "ON subscriptions (invoice_id) WHERE is_paid = false AND invoice_id IS NOT NULL",
+    )
+    # Свипер истёкших подписок: WHERE status = ? AND expires_at < ? ORDER BY expires_at, id
+    await create_index_concurrently(
+        conn, "ix_subscriptions_status_expires_at",
+        "ON subscriptions (status, expires_at, id)",
+    )
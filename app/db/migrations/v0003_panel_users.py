@@ -0,0 +1,25 @@
+"""Локальная копия пользователей Marzban для экранов статуса и подключения."""
+from sqlalchemy import text
+
+VERSION = 3
+DESCRIPTION = "panel_users: read-модель пользователей Marzban"
+TRANSACTIONAL = True
+
+DDL = (
+    "CREATE TABLE IF NOT EXISTS panel_users ("
+    " username VARCHAR(100) NOT NULL,"
+    " user_id BIGINT,"
+    " status VARCHAR(20) NOT NULL,"
+    " expire BIGINT NOT NULL,"
+    " data_limit BIGINT NOT NULL,"
+    " used_traffic BIGINT NOT NULL,"
+    " subscription_url VARCHAR(500),"
+    " synced_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,"
+    " PRIMARY KEY (username))",
+    "CREATE INDEX IF NOT EXISTS ix_panel_users_user_id ON panel_users (user_id)",
+)
+
+
+async def upgrade(conn):
+    for statement in DDL:
+        await conn.execute(text(statement))
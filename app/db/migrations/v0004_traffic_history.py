@@ -0,0 +1,48 @@
+"""История трафика: сырые приросты, часовые и дневные агрегаты."""
+from datetime import datetime, timedelta
+from sqlalchemy import text
+
+VERSION = 4
+DESCRIPTION = "traffic_samples/traffic_hourly (секции по дням), traffic_daily, rollup_state"
+TRANSACTIONAL = True
+
+DDL = (
+    "CREATE TABLE IF NOT EXISTS traffic_samples ("
+    " user_id BIGINT NOT NULL,"
+    " ts TIMESTAMP WITHOUT TIME ZONE NOT NULL,"
+    " bytes BIGINT NOT NULL,"
+    " PRIMARY KEY (user_id, ts))"
+    " PARTITION BY RANGE (ts)",
+    "CREATE TABLE IF NOT EXISTS traffic_hourly ("
+    " user_id BIGINT NOT NULL,"
+    " hour TIMESTAMP WITHOUT TIME ZONE NOT NULL,"
+    " bytes BIGINT NOT NULL,"
+    " PRIMARY KEY (user_id, hour))"
+    " PARTITION BY RANGE (hour)",
+    "CREATE TABLE IF NOT EXISTS traffic_daily ("
+    " user_id BIGINT NOT NULL,"
+    " day TIMESTAMP WITHOUT TIME ZONE NOT NULL,"
+    " bytes BIGINT NOT NULL,"
+    " PRIMARY KEY (user_id, day))",
+    "CREATE INDEX IF NOT EXISTS ix_traffic_daily_day ON traffic_daily (day)",
+    "CREATE TABLE IF NOT EXISTS rollup_state ("
+    " name VARCHAR(50) NOT NULL,"
+    " done_until TIMESTAMP WITHOUT TIME ZONE NOT NULL,"
+    " PRIMARY KEY (name))",
+)
+
+# Дневные секции на сегодня и столько дней вперёд; дальше их создаёт сам бот.
+PARTITIONS_AHEAD_DAYS = 3
+
+
+async def upgrade(conn):
+    for statement in DDL:
+        await conn.execute(text(statement))
+    today = datetime.utcnow().date()
+    for table in ("traffic_samples", "traffic_hourly"):
+        for offset in range(PARTITIONS_AHEAD_DAYS + 1):
+            day = today + timedelta(days=offset)
+            await conn.execute(text(
+                f"CREATE TABLE IF NOT EXISTS {table}_p{day:%Y%m%d} PARTITION OF {table} "
+                f"FOR VALUES FROM ('{day.isoformat()}') TO ('{(day + timedelta(days=1)).isoformat()}')"
+            ))
@@ -0,0 +1,37 @@
+"""Журнал платежей с уникальностью по (provider, charge_id)."""
+from sqlalchemy import text
+
+VERSION = 5
+DESCRIPTION = "payments: идемпотентный журнал платежей Stars и CryptoPay"
+TRANSACTIONAL = True
+
+DDL = (
+    "CREATE TABLE IF NOT EXISTS payments ("
+    " id SERIAL NOT NULL,"
+    " provider VARCHAR(20) NOT NULL,"
+    " charge_id VARCHAR(255) NOT NULL,"
+    " user_id BIGINT NOT NULL,"
+    " tariff_code VARCHAR(10) NOT NULL,"
+    " amount INTEGER,"
+    " currency VARCHAR(10),"
+    " subscription_id INTEGER,"
+    " status VARCHAR(20) NOT NULL,"
+    " attempts INTEGER NOT NULL,"
+    " lease_until TIMESTAMP WITHOUT TIME ZONE,"
+    " grant_expire BIGINT,"
+    " grant_data_limit BIGINT,"
+    " vpn_link VARCHAR(500),"
+    " created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,"
+    " applied_at TIMESTAMP WITHOUT TIME ZONE,"
+    " PRIMARY KEY (id),"
+    " CONSTRAINT uq_payments_provider_charge UNIQUE (provider, charge_id),"
+    " FOREIGN KEY (subscription_id) REFERENCES subscriptions (id))",
+    "CREATE INDEX IF NOT EXISTS ix_payments_user_id ON payments (user_id)",
+    "CREATE INDEX IF NOT EXISTS ix_payments_unfinished ON payments (lease_until)"
+    " WHERE status IN ('claimed', 'provisioning')",
+)
+
+
+async def upgrade(conn):
+    for statement in DDL:
+        await conn.execute(text(statement))
@@ -0,0 +1,27 @@
+"""Очередь фоновых заданий (outbox) для выдачи ключей по оплатам."""
+from sqlalchemy import text
+
+VERSION = 6
+DESCRIPTION = "outbox: очередь заданий с повторами и dead-letter"
+TRANSACTIONAL = True
+
+DDL = (
+    "CREATE TABLE IF NOT EXISTS outbox ("
+    " id BIGSERIAL NOT NULL,"
+    " kind VARCHAR(50) NOT NULL,"
+    " payload JSONB NOT NULL,"
+    " status VARCHAR(10) NOT NULL,"
+    " attempts INTEGER NOT NULL,"
+    " available_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,"
+    " last_error TEXT,"
+    " created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,"
+    " finished_at TIMESTAMP WITHOUT TIME ZONE,"
+    " PRIMARY KEY (id))",
+    "CREATE INDEX IF NOT EXISTS ix_outbox_pending ON outbox (available_at) WHERE status = 'pending'",
+    "CREATE INDEX IF NOT EXISTS ix_outbox_finished_at ON outbox (finished_at) WHERE status = 'done'",
+)
+
+
+async def upgrade(conn):
+    for statement in DDL:
+        await conn.execute(text(statement))
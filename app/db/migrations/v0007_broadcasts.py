@@ -0,0 +1,36 @@
+"""Рассылки с курсором и отметка пользователей, заблокировавших бота."""
+from sqlalchemy import text
+from app.db.migrations import create_index_concurrently
+
+VERSION = 7
+DESCRIPTION = "broadcasts: рассылки с курсором; users.blocked_at"
+TRANSACTIONAL = False
+
+BROADCASTS_DDL = (
+    "CREATE TABLE IF NOT EXISTS broadcasts ("
+    " id SERIAL NOT NULL,"
+    " text TEXT NOT NULL,"
+    " status VARCHAR(10) NOT NULL,"
+    " created_by BIGINT NOT NULL,"
+    " report_message_id BIGINT,"
+    " cursor BIGINT NOT NULL,"
+    " total INTEGER NOT NULL,"
+    " sent INTEGER NOT NULL,"
+    " failed INTEGER NOT NULL,"
+    " blocked INTEGER NOT NULL,"
+    " owner VARCHAR(64),"
+    " lease_until TIMESTAMP WITHOUT TIME ZONE,"
+    " created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,"
+    " finished_at TIMESTAMP WITHOUT TIME ZONE,"
+    " PRIMARY KEY (id))"
+)
+
+
+async def upgrade(conn):
+    # Колонка без DEFAULT добавляется без перезаписи таблицы.
+    await conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS blocked_at TIMESTAMP"))
+    await conn.execute(text(BROADCASTS_DDL))
+    await create_index_concurrently(
+        conn, "ix_users_reachable",
+        "ON users (id) WHERE blocked_at IS NULL",
+    )
@@ -0,0 +1,32 @@
+"""Напоминания об окончании подписки и трафика: журнал отправок и индексы panel_users."""
+from sqlalchemy import text
+from app.db.migrations import create_index_concurrently
+
+VERSION = 8
+DESCRIPTION = "reminders_sent; индексы panel_users по expire и доле трафика"
+TRANSACTIONAL = False
+
+DDL = (
+    "CREATE TABLE IF NOT EXISTS reminders_sent ("
+    " user_id BIGINT NOT NULL,"
+    " kind VARCHAR(20) NOT NULL,"
+    " cycle VARCHAR(50) NOT NULL,"
+    " sent_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,"
+    " PRIMARY KEY (user_id, kind, cycle))",
+    "CREATE INDEX IF NOT EXISTS ix_reminders_sent_sent_at ON reminders_sent (sent_at)",
+)
+
+
+async def upgrade(conn):
+    for statement in DDL:
+        await conn.execute(text(statement))
+    # Окна напоминаний: WHERE expire > ? AND expire <= ?
+    await create_index_concurrently(
+        conn, "ix_panel_users_expire",
+        "ON panel_users (expire) WHERE expire > 0",
+    )
+    # Пороги трафика: WHERE CAST(used_traffic AS FLOAT) / data_limit >= ?
+    await create_index_concurrently(
+        conn, "ix_panel_users_usage_ratio",
+        "ON panel_users ((CAST(used_traffic AS FLOAT) / data_limit)) WHERE data_limit > 0",
+    )
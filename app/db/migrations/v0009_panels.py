@@ -0,0 +1,12 @@
+"""Пул панелей Marzban: на какой панели живёт пользователь."""
+from sqlalchemy import text
+
+VERSION = 9
+DESCRIPTION = "subscriptions.panel и panel_users.panel для пула панелей Marzban"
+TRANSACTIONAL = True
+
+
+async def upgrade(conn):
+    # Колонки без DEFAULT добавляются без перезаписи таблиц; NULL — панель по умолчанию.
+    await conn.execute(text("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS panel VARCHAR(32)"))
+    await conn.execute(text("ALTER TABLE panel_users ADD COLUMN IF NOT EXISTS panel VARCHAR(32)"))
@@ -0,0 +1,14 @@
+"""История трафика без пропусков: секции DEFAULT и устаревшие строки panel_users вместо удаления."""
+from sqlalchemy import text
+
+VERSION = 10
+DESCRIPTION = "секции DEFAULT у traffic_samples/traffic_hourly, panel_users.synced_at допускает NULL"
+TRANSACTIONAL = True
+
+
+async def upgrade(conn):
+    # Приросты на день без своей секции уходят в DEFAULT, а не роняют транзакцию синхронизации.
+    await conn.execute(text("CREATE TABLE IF NOT EXISTS traffic_samples_default PARTITION OF traffic_samples DEFAULT"))
+    await conn.execute(text("CREATE TABLE IF NOT EXISTS traffic_hourly_default PARTITION OF traffic_hourly DEFAULT"))
+    # synced_at IS NULL — строка устарела, но её used_traffic остаётся базой для следующего прироста.
+    await conn.execute(text("ALTER TABLE panel_users ALTER COLUMN synced_at DROP NOT NULL"))
@@ -0,0 +1,11 @@
+"""Панель, выбранная для пользователя до появления у него подписки."""
+from sqlalchemy import text
+
+VERSION = 11
+DESCRIPTION = "users.panel: размещение нового пользователя в пуле панелей Marzban"
+TRANSACTIONAL = True
+
+
+async def upgrade(conn):
+    # Колонка без DEFAULT добавляется без перезаписи таблицы; NULL — ещё не размещён.
+    await conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS panel VARCHAR(32)"))
@@ -0,0 +1,11 @@
+"""Счётчик откладываний задания outbox, отдельный от попыток."""
+from sqlalchemy import text
+
+VERSION = 12
+DESCRIPTION = "outbox.postpones: предел откладываний задания до dead-letter"
+TRANSACTIONAL = True
+
+
+async def upgrade(conn):
+    # Константный DEFAULT с PostgreSQL 11 не перезаписывает таблицу.
+    await conn.execute(text("ALTER TABLE outbox ADD COLUMN IF NOT EXISTS postpones INTEGER NOT NULL DEFAULT 0"))
@@ -1,5 +1,6 @@
 from datetime import datetime
-from sqlalchemy import BigInteger, Column, DateTime, Integer, String, ForeignKey, Boolean
+from sqlalchemy import BigInteger, Column, DateTime, Integer, String, Text, ForeignKey, Boolean, Index, UniqueConstraint, text
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import relationship, Mapped, mapped_column
 from .database import Base
 
@@ -9,9 +10,18 @@ class User(Base):
     id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
     username: Mapped[str | None] = mapped_column(String(50), nullable=True)
     registration_date: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    # Бот заблокирован пользователем (403 при рассылке); сбрасывается его следующим /start.
+    blocked_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+    # Панель пула, выбранная при первом размещении; до подписки это единственная её запись.
+    panel: Mapped[str | None] = mapped_column(String(32), nullable=True)
 
     subscriptions: Mapped[list["Subscription"]] = relationship("Subscription", back_populates="user")
 
+    __table_args__ = (
+        # Получатели рассылки: WHERE blocked_at IS NULL AND id > :cursor ORDER BY id
+        Index("ix_users_reachable", "id", postgresql_where=text("blocked_at IS NULL")),
+    )
+
     def __repr__(self):
         return f"<User id={self.id} username={self.username}>"
 
@@ -35,7 +45,220 @@ class Subscription(Base):
     invoice_id: Mapped[str | None] = mapped_column(String(100), nullable=True)  
     is_paid: Mapped[bool] = mapped_column(Boolean, default=False)             
     vpn_link: Mapped[str | None] = mapped_column(String(500), nullable=True)   
+    # Панель Marzban, на которой живёт пользователь; NULL у строк до пула панелей — панель по умолчанию.
+    panel: Mapped[str | None] = mapped_column(String(32), nullable=True)
+
+    __table_args__ = (
+        # Проверка пробного доступа в /start.
+        Index("ix_subscriptions_user_tariff", "user_id", "tariff_code"),
+        # Неоплаченные крипто-инвойсы для опроса и вебхука.
+        Index(
+            "ix_subscriptions_pending_invoices",
+            "invoice_id",
+            postgresql_where=text("is_paid = false AND invoice_id IS NOT NULL"),
+        ),
+        # Для свипера истёкших подписок: диапазон по expires_at внутри status.
+        Index("ix_subscriptions_status_expires_at", "status", "expires_at", "id"),
+    )
 
     def __repr__(self):
         return f"<Subscription id={self.id} marzban_user={self.marzban_username} status={self.status}>"
 
+
+class PanelUser(Base):
+    """Копия полей пользователя Marzban для экранов статуса и подключения.
+
+    Заполняется фоновой синхронизацией со списком api/users; хендлеры читают
+    отсюда и ходят в панель только для новых пользователей и по кнопке обновления.
+    """
+    __tablename__ = "panel_users"
+
+    username: Mapped[str] = mapped_column(String(100), primary_key=True)
+    user_id: Mapped[int | None] = mapped_column(BigInteger, nullable=True, index=True)
+    status: Mapped[str] = mapped_column(String(20))
+    expire: Mapped[int] = mapped_column(BigInteger, default=0)
+    data_limit: Mapped[int] = mapped_column(BigInteger, default=0)
+    used_traffic: Mapped[int] = mapped_column(BigInteger, default=0)
+    subscription_url: Mapped[str | None] = mapped_column(String(500), nullable=True)
+    panel: Mapped[str | None] = mapped_column(String(32), nullable=True)
+    # NULL — строка устарела после начисления: экраны идут в панель, база трафика сохраняется.
+    synced_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True, default=datetime.utcnow)
+
+    __table_args__ = (
+        # Напоминания об окончании: WHERE expire > :from AND expire <= :to
+        Index("ix_panel_users_expire", "expire", postgresql_where=text("expire > 0")),
+        # Напоминания о трафике: диапазон по доле израсходованного лимита.
+        Index(
+            "ix_panel_users_usage_ratio",
+            text("(CAST(used_traffic AS FLOAT) / data_limit)"),
+            postgresql_where=text("data_limit > 0"),
+        ),
+    )
+
+    def __repr__(self):
+        return f"<PanelUser username={self.username} status={self.status}>"
+
+class TrafficSample(Base):
+    """Прирост трафика пользователя между двумя проходами синхронизации.
+
+    Таблица секционирована по дням (RANGE по ts): старые сырые данные
+    удаляются целыми секциями после свёртки в traffic_hourly.
+    """
+    __tablename__ = "traffic_samples"
+
+    user_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    ts: Mapped[datetime] = mapped_column(DateTime, primary_key=True)
+    bytes: Mapped[int] = mapped_column(BigInteger)
+
+    __table_args__ = {"postgresql_partition_by": "RANGE (ts)"}
+
+
+class TrafficHourly(Base):
+    __tablename__ = "traffic_hourly"
+
+    user_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    hour: Mapped[datetime] = mapped_column(DateTime, primary_key=True)
+    bytes: Mapped[int] = mapped_column(BigInteger)
+
+    __table_args__ = {"postgresql_partition_by": "RANGE (hour)"}
+
+
+class TrafficDaily(Base):
+    __tablename__ = "traffic_daily"
+
+    user_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    day: Mapped[datetime] = mapped_column(DateTime, primary_key=True)
+    bytes: Mapped[int] = mapped_column(BigInteger)
+
+    __table_args__ = (
+        # Удаление по сроку хранения: WHERE day < ?
+        Index("ix_traffic_daily_day", "day"),
+    )
+
+
+class RollupState(Base):
+    """До какого момента (не включительно) свёртка уже посчитана."""
+    __tablename__ = "rollup_state"
+
+    name: Mapped[str] = mapped_column(String(50), primary_key=True)
+    done_until: Mapped[datetime] = mapped_column(DateTime)
+
+
+class Payment(Base):
+    """Журнал платежей: каждый charge применяется к панели ровно один раз.
+
+    Строка заявляется INSERT ... ON CONFLICT по (provider, charge_id), затем
+    проходит claimed -> provisioning (аренда lease_until) -> applied. План
+    начисления (grant_*) сохраняется до обращения к панели, поэтому повтор
+    после сбоя выставляет те же абсолютные значения.
+    """
+    __tablename__ = "payments"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    provider: Mapped[str] = mapped_column(String(20))  # stars | crypto
+    charge_id: Mapped[str] = mapped_column(String(255))
+    user_id: Mapped[int] = mapped_column(BigInteger, index=True)
+    tariff_code: Mapped[str] = mapped_column(String(10))
+    amount: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    currency: Mapped[str | None] = mapped_column(String(10), nullable=True)
+    subscription_id: Mapped[int | None] = mapped_column(Integer, ForeignKey("subscriptions.id"), nullable=True)
+
+    status: Mapped[str] = mapped_column(String(20), default="claimed")  # claimed | provisioning | applied | failed
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    lease_until: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+    grant_expire: Mapped[int | None] = mapped_column(BigInteger, nullable=True)
+    grant_data_limit: Mapped[int | None] = mapped_column(BigInteger, nullable=True)
+    vpn_link: Mapped[str | None] = mapped_column(String(500), nullable=True)
+
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    applied_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+
+    __table_args__ = (
+        UniqueConstraint("provider", "charge_id", name="uq_payments_provider_charge"),
+        # Восстановление зависших платежей: незавершённые строки по сроку аренды.
+        Index(
+            "ix_payments_unfinished",
+            "lease_until",
+            postgresql_where=text("status IN ('claimed', 'provisioning')"),
+        ),
+    )
+
+    def __repr__(self):
+        return f"<Payment id={self.id} {self.provider}:{self.charge_id} status={self.status}>"
+
+
+class OutboxJob(Base):
+    """Задание фоновой очереди, записанное в той же транзакции, что и его причина.
+
+    Воркеры забирают готовые задания через FOR UPDATE SKIP LOCKED и сдвигают
+    available_at на срок аренды; неудача переносит его на время повтора,
+    а после OUTBOX_MAX_ATTEMPTS задание уходит в status="dead". Ожидание
+    чужой работы (RetryLater с delay_s) попыток не тратит, но считается в
+    postpones и после OUTBOX_MAX_POSTPONES тоже уводит задание в dead.
+    """
+    __tablename__ = "outbox"
+
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
+    kind: Mapped[str] = mapped_column(String(50))
+    payload: Mapped[dict] = mapped_column(JSONB)
+    status: Mapped[str] = mapped_column(String(10), default="pending")  # pending | done | dead
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    postpones: Mapped[int] = mapped_column(Integer, default=0, server_default=text("0"))
+    available_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    last_error: Mapped[str | None] = mapped_column(Text, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    finished_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+
+    __table_args__ = (
+        # Выборка готовых заданий: WHERE status = 'pending' AND available_at <= now ORDER BY available_at
+        Index("ix_outbox_pending", "available_at", postgresql_where=text("status = 'pending'")),
+        # Очистка выполненных заданий по сроку хранения.
+        Index("ix_outbox_finished_at", "finished_at", postgresql_where=text("status = 'done'")),
+    )
+
+    def __repr__(self):
+        return f"<OutboxJob id={self.id} kind={self.kind} status={self.status}>"
+
+
+class Broadcast(Base):
+    """Рассылка всем пользователям с курсором по users.id для продолжения после рестарта.
+
+    Выполняет её процесс, владеющий арендой (owner, lease_until); курсор и
+    счётчики сохраняются после каждой страницы получателей.
+    """
+    __tablename__ = "broadcasts"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    text: Mapped[str] = mapped_column(Text)
+    status: Mapped[str] = mapped_column(String(10), default="running")  # running | done | cancelled
+    created_by: Mapped[int] = mapped_column(BigInteger)
+    report_message_id: Mapped[int | None] = mapped_column(BigInteger, nullable=True)
+    cursor: Mapped[int] = mapped_column(BigInteger, default=0)
+    total: Mapped[int] = mapped_column(Integer, default=0)
+    sent: Mapped[int] = mapped_column(Integer, default=0)
+    failed: Mapped[int] = mapped_column(Integer, default=0)
+    blocked: Mapped[int] = mapped_column(Integer, default=0)
+    owner: Mapped[str | None] = mapped_column(String(64), nullable=True)
+    lease_until: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    finished_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+
+    def __repr__(self):
+        return f"<Broadcast id={self.id} status={self.status} cursor={self.cursor}>"
+
+
+class ReminderSent(Base):
+    """Отправленное напоминание: не больше одного вида kind на цикл подписки.
+
+    cycle — expire (и data_limit для напоминаний о трафике) на момент
+    отправки, так что после продления напоминания начинаются заново.
+    """
+    __tablename__ = "reminders_sent"
+
+    user_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    kind: Mapped[str] = mapped_column(String(20), primary_key=True)
+    cycle: Mapped[str] = mapped_column(String(50), primary_key=True)
+    sent_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
+
+    def __repr__(self):
+        return f"<ReminderSent user_id={self.user_id} kind={self.kind} cycle={self.cycle}>"
@@ -0,0 +1,170 @@
+import time
+from aiogram import Router, F
+from aiogram.filters import Command, CommandObject
+from aiogram.types import Message
+from sqlalchemy import select, func, distinct
+from app.db.database import get_db_session
+from app.db.models import Subscription
+from app.keyboards.pay_menu import TARIFS
+from app.services.marzban_pool import marzban_client
+from app.services.outbox import requeue_dead
+from app.services.broadcast import create_broadcast, cancel_broadcast, get_broadcast, format_progress
+from config import ADMIN_IDS, BULK_COHORT_PAGE_SIZE
+
+router = Router()
+router.message.filter(F.from_user.id.in_(ADMIN_IDS))
+
+PROGRESS_INTERVAL_S = 2
+
+
+async def _tariff_cohort(tariff_code: str, page_size: int = BULK_COHORT_PAGE_SIZE):
+    """Отдаёт marzban-имена активных подписчиков тарифа страницами по user_id.
+
+    Каждая страница читается в своей короткой сессии: пока массовая
+    операция ходит в Marzban, соединение БД не удерживается.
+    """
+    cursor = None
+    while True:
+        query = select(distinct(Subscription.user_id)).where(
+            Subscription.tariff_code == tariff_code,
+            Subscription.status == "active",
+        )
+        if cursor is not None:
+            query = query.where(Subscription.user_id > cursor)
+        async with await get_db_session() as session:
+            user_ids = (await session.scalars(query.order_by(Subscription.user_id).limit(page_size))).all()
+        for user_id in user_ids:
+            yield f"tg{user_id}"
+        if len(user_ids) < page_size:
+            return
+        cursor = user_ids[-1]
+
+
+async def _tariff_cohort_size(tariff_code: str) -> int:
+    async with await get_db_session() as session:
+        return await session.scalar(
+            select(func.count(distinct(Subscription.user_id))).where(
+                Subscription.tariff_code == tariff_code,
+                Subscription.status == "active",
+            )
+        )
+
+
+def _parse_targets(args: str | None):
+    """Аргумент команды: код тарифа (вся когорта) или список tg-имён / Telegram ID."""
+    parts = (args or "").split()
+    if len(parts) == 1 and parts[0] in TARIFS:
+        return _tariff_cohort(parts[0]), parts[0]
+    return [p if p.startswith("tg") else f"tg{p}" for p in parts if p.removeprefix("tg").isdigit()], None
+
+
+async def _run_bulk(message: Message, command: CommandObject, enable: bool):
+    targets, tariff_code = _parse_targets(command.args)
+    if tariff_code:
+        total = await _tariff_cohort_size(tariff_code)
+    else:
+        total = len(targets)
+
+    if not total:
+        await message.answer(
+            f"Использование: /{command.command} <код тарифа | tg-имена / Telegram ID через пробел>"
+        )
+        return
+
+    action = "Включение" if enable else "Отключение"
+    status_message = await message.answer(f"⏳ {action}: 0 / {total}")
+    last_edit = time.monotonic()
+
+    async def progress(done: int):
+        nonlocal last_edit
+        if time.monotonic() - last_edit >= PROGRESS_INTERVAL_S:
+            last_edit = time.monotonic()
+            await status_message.edit_text(f"⏳ {action}: {done} / {total}")
+
+    started = time.monotonic()
+    bulk = marzban_client.bulk_enable_users if enable else marzban_client.bulk_disable_users
+    report = await bulk(targets, progress=progress)
+
+    counts: dict[str, int] = {}
+    for result in report.values():
+        counts[result] = counts.get(result, 0) + 1
+    failed = [username for username, result in report.items() if result in ("error", "not_found")]
+
+    text = (
+        f"✅ {action} завершено за {time.monotonic() - started:.1f} с\n\n"
+        f"├ Успешно: {counts.get('ok', 0)}\n"
+        f"├ Без изменений: {counts.get('unchanged', 0)}\n"
+        f"├ Не найдены: {counts.get('not_found', 0)}\n"
+        f"└ Ошибки: {counts.get('error', 0)}"
+    )
+    if failed:
+        text += "\n\nНе обработаны: " + ", ".join(failed[:50]) + (" …" if len(failed) > 50 else "")
+    await status_message.edit_text(text)
+
+
+@router.message(Command("bulk_disable"), flags={"throttling": "exempt"})
+async def bulk_disable_cmd(message: Message, command: CommandObject):
+    await _run_bulk(message, command, enable=False)
+
+
+@router.message(Command("bulk_enable"), flags={"throttling": "exempt"})
+async def bulk_enable_cmd(message: Message, command: CommandObject):
+    await _run_bulk(message, command, enable=True)
+
+
+@router.message(Command("requeue_dead"), flags={"throttling": "exempt"})
+async def requeue_dead_cmd(message: Message, command: CommandObject):
+    """Возвращает задания outbox из dead-letter в очередь: все или одного вида."""
+    requeued = await requeue_dead((command.args or "").strip() or None)
+    await message.answer(f"♻️ Возвращено в очередь заданий: {requeued}")
+
+
+@router.message(Command("broadcast"), flags={"throttling": "exempt"})
+async def broadcast_cmd(message: Message, command: CommandObject):
+    """Рассылка всем пользователям; текст в HTML-разметке Telegram."""
+    if not command.args:
+        await message.answer("Использование: /broadcast <текст рассылки в HTML>")
+        return
+    report = await message.answer("📣 Рассылка поставлена в очередь…")
+    broadcast = await create_broadcast(command.args, message.from_user.id, report.message_id)
+    await report.edit_text(format_progress(broadcast))
+
+
+@router.message(Command("broadcast_status"), flags={"throttling": "exempt"})
+async def broadcast_status_cmd(message: Message, command: CommandObject):
+    arg = (command.args or "").strip()
+    broadcast = await get_broadcast(int(arg) if arg.isdigit() else None)
+    await message.answer(format_progress(broadcast) if broadcast else "Рассылок ещё не было.")
+
+
+@router.message(Command("broadcast_cancel"), flags={"throttling": "exempt"})
+async def broadcast_cancel_cmd(message: Message, command: CommandObject):
+    arg = (command.args or "").strip()
+    if not arg.isdigit():
+        await message.answer("Использование: /broadcast_cancel <id рассылки>")
+        return
+    if await cancel_broadcast(int(arg)):
+        await message.answer(f"⛔ Рассылка #{arg} отменена.")
+    else:
+        await message.answer(f"Рассылка #{arg} не найдена или уже завершена.")
+
+
+def _rate(load: float) -> str:
+    return f"{load * 8 / 1_000_000:.1f} Мбит/с"
+
+
+@router.message(Command("nodes"), flags={"throttling": "exempt"})
+async def nodes_cmd(message: Message):
+    """Снимок здоровья нод и нагрузки инбаундов по панелям, как его видит эта реплика."""
+    lines = []
+    for panel, health in marzban_client.health_snapshot().items():
+        age = "нет снимка" if health["age_s"] is None else f"{health['age_s']:.0f} с назад"
+        lines.append(f"🖥 {panel} ({age}{'' if health['fresh'] else ', устарел'})")
+        for name, node in health["nodes"].items():
+            mark = "✅" if node["status"] == "connected" else "❌"
+            lines.append(f"  {mark} {name}: {node['status']}, {_rate(node['load'])}")
+        for tag, inbound in health["inbounds"].items():
+            mark = "✅" if inbound["healthy"] else "❌"
+            lines.append(f"  {mark} {tag} → {', '.join(inbound['nodes']) or '—'}: {_rate(inbound['load'])}, "
+                         f"выдано с обновления {inbound['pending']}")
+    await message.answer("\n".join(lines))
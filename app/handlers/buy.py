@@ -1,22 +1,30 @@
 from aiogram import Router, F, Bot
-from aiogram.types import Message, CallbackQuery, LabeledPrice, PreCheckoutQuery, SuccessfulPayment, ContentType
+from aiogram.types import Message, CallbackQuery, LabeledPrice, PreCheckoutQuery, ContentType
 from aiogram.exceptions import TelegramBadRequest, TelegramAPIError
-from sqlalchemy import select
-from sqlalchemy.orm import selectinload
+from sqlalchemy import select, update
 from app.db.database import get_db_session 
-from app.db.models import User, Subscription 
+from app.db.models import User, Subscription, Payment
 from app.keyboards.pay_menu import get_tarfs_keyboard, get_payment_keyboard, TARIFS
-from app.services.marzban_api import marzban_client
-from config import PROVIDER_TOKEN, CRYPTO_TOKEN
+from app.services.marzban_pool import marzban_client
+from app.services.payments import claim_payment
+from app.services.metrics import CRYPTO_SWEEP_DURATION, CRYPTO_PENDING_INVOICES
+from app.services.logging_setup import new_request_id, user_id_var
+from config import (
+    PROVIDER_TOKEN, CRYPTO_TOKEN, CRYPTO_API_URL, CRYPTO_INVOICE_BATCH_SIZE, CRYPTO_INVOICE_FETCH_CONCURRENCY,
+    CRYPTO_POLL_INTERVAL, CRYPTO_WEBHOOK_ENABLED, CRYPTO_WEBHOOK_POLL_INTERVAL, CRYPTO_WEBHOOK_GRACE_S,
+)
 from datetime import datetime, timedelta
-from aiocryptopay import AioCryptoPay, Networks
+from aiocryptopay import AioCryptoPay
 import asyncio
-from aiocryptopay.exceptions import CryptoPayAPIError
+import logging
+import time
+
+logger = logging.getLogger(__name__)
 
 router = Router()
-crypto = AioCryptoPay(token=CRYPTO_TOKEN, network=Networks.MAIN_NET)
+crypto = AioCryptoPay(token=CRYPTO_TOKEN, network=CRYPTO_API_URL)
 
-@router.message(F.text == "💳 Купить")
+@router.message(F.text == "💳 Купить", flags={"throttling": "expensive"})
 async def handle_buy_menu(message: Message):
     await message.delete()
 
@@ -28,7 +36,7 @@ async def handle_buy_menu(message: Message):
              parse_mode="Markdown",
     )
     
-@router.callback_query(F.data.startswith("buy_"))
+@router.callback_query(F.data.startswith("buy_"), flags={"throttling": "expensive"})
 async def handle_tarrife(callback: CallbackQuery):
     tariff = callback.data.split("_")[1]
     user_id = callback.from_user.id
@@ -59,7 +67,7 @@ async def handle_tarrife(callback: CallbackQuery):
     await callback.answer()
 
 
-@router.callback_query(F.data.startswith("pay_stars_"))
+@router.callback_query(F.data.startswith("pay_stars_"), flags={"throttling": "expensive"})
 async def process_payment(callback: CallbackQuery, bot: Bot):
     user_id = callback.from_user.id
 
@@ -93,7 +101,7 @@ async def process_payment(callback: CallbackQuery, bot: Bot):
             reply_markup=None,
         )
     except TelegramBadRequest as e:
-        print(f"Ошибка при отправке инвойса: {e}")
+        logger.error(f"Ошибка при отправке инвойса: {e}")
         await callback.message.answer("Произошла ошибка при создании счета.")
     
     await callback.answer()
@@ -103,9 +111,9 @@ async def process_pre_checkout(pre_checkout_query: PreCheckoutQuery, bot: Bot):
     try:
         await bot.answer_pre_checkout_query(pre_checkout_query.id, ok=True)
     except TelegramAPIError as e:
-        print(f"Ошибка PreCheckout: {e}")
+        logger.error(f"Ошибка PreCheckout: {e}")
 
-@router.message(F.content_type == ContentType.SUCCESSFUL_PAYMENT)
+@router.message(F.content_type == ContentType.SUCCESSFUL_PAYMENT, flags={"throttling": "exempt"})
 async def process_successful_payment(message: Message):
     
     payment_info = message.successful_payment
@@ -124,33 +132,29 @@ async def process_successful_payment(message: Message):
         
     title = tariff_data.get("title", "Ваш новый тариф")
     
-    subscription_link = await marzban_client.create_user(
-        telegram_user_id=user_id, 
-        tariff_code=tariff_code, 
-        user_data=tariff_data
+    _, created = await claim_payment(
+        "stars", payment_info.telegram_payment_charge_id, user_id, tariff_code,
+        amount=payment_info.total_amount, currency=payment_info.currency,
     )
     
-    if subscription_link:
-        response_text = (
-            "🎉 **Оплата прошла успешно!** 🎉\n"
-            f"Вы приобрели: **{title}**.\n\n"
-            "🔑 **Ваша персональная ссылка для подписки:**\n"
-            f"```\n{subscription_link}\n```\n\n"
-            "🔗 Нажмите на ссылку, чтобы добавить ключ в ваш VPN-клиент (V2RayNG, Hiddify и т.д.).\n"
-            "💡 Нажмите **❤️ Подключится** для дальнейших инструкций и просмотра ссылки."
-        )
-    else:
-        response_text = (
-            "⚠️ **Оплата прошла успешно**, но произошла ошибка при генерации ключа.\n"
-            "Администратор уже уведомлен. Пожалуйста, свяжитесь с поддержкой."
-        )
+    if not created:
+        # Повторная доставка того же successful_payment: начисление уже в очереди или выполнено.
+        logger.info(f"Повторная доставка оплаты {payment_info.telegram_payment_charge_id}, пропускаем.")
+        return
+
+    response_text = (
+        "✅ **Оплата получена!**\n"
+        f"Вы приобрели: **{title}**.\n\n"
+        "🔑 Ключ выдаётся — ссылка придёт отдельным сообщением в течение пары минут.\n"
+        "💡 Потом её всегда можно посмотреть через **❤️ Подключится**."
+    )
         
     await message.answer(
         text=response_text,
         parse_mode="Markdown"
     )
 
-@router.callback_query(F.data.startswith("pay_crypto_"))
+@router.callback_query(F.data.startswith("pay_crypto_"), flags={"throttling": "expensive"})
 async def crypto_payment(callback: CallbackQuery, bot: Bot):
     user_id = callback.from_user.id
 
@@ -176,12 +180,14 @@ async def crypto_payment(callback: CallbackQuery, bot: Bot):
             expires_in=3600, 
         )
 
+        panel = await marzban_client.panel_for(user_id)
         async with await get_db_session() as session:
             invoice_id_str = str(invoice.invoice_id)
             
             subscription = Subscription(
                 user_id=user_id,
                 marzban_username=None,
+                panel=panel,
                 tariff_code=tariff_code,
                 expires_at=None,
                 data_limit_gb=tariff_data["limit_gb"],
@@ -204,104 +210,162 @@ async def crypto_payment(callback: CallbackQuery, bot: Bot):
         )
 
     except Exception as e:
-        print(f"Ошибка при создании crypto-инвойса: {e}") 
+        logger.exception(f"Ошибка при создании crypto-инвойса: {e}")
         await callback.message.answer("Произошла ошибка при создании крипто-счета. Пожалуйста, попробуйте снова.")
 
     await callback.answer()
 
 
-async def check_crypto_payments(bot: Bot):
+def _extract_invoices(invoice_result) -> list:
+    """Приводит ответ CryptoPay.get_invoices к списку инвойсов."""
+    if invoice_result is None:
+        return []
+    if isinstance(invoice_result, list):
+        return invoice_result
+    if hasattr(invoice_result, 'items'):
+        return list(invoice_result.items)
+    if hasattr(invoice_result, 'invoice_id'):
+        return [invoice_result]
+    logger.error(f"❌ Неизвестный формат ответа CryptoPay: {type(invoice_result)}")
+    return []
+
+
+async def fetch_invoice_statuses(invoice_ids: list[str], stats: dict) -> dict[str, str]:
+    """Получает статусы инвойсов пачками по CRYPTO_INVOICE_BATCH_SIZE с ограниченным параллелизмом."""
+    statuses: dict[str, str] = {}
+    semaphore = asyncio.Semaphore(CRYPTO_INVOICE_FETCH_CONCURRENCY)
+
+    async def fetch_chunk(chunk: list[str]):
+        async with semaphore:
+            stats["api_calls"] += 1
+            try:
+                invoice_result = await crypto.get_invoices(
+                    invoice_ids=[int(invoice_id) for invoice_id in chunk],
+                    count=len(chunk),
+                )
+            except Exception as e:
+                stats["api_errors"] += 1
+                logger.error(f"❌ Ошибка CryptoPay при запросе пачки из {len(chunk)} инвойсов: {e}")
+                return
+
+            for inv in _extract_invoices(invoice_result):
+                statuses[str(inv.invoice_id)] = inv.status
+
+    chunks = [
+        invoice_ids[i:i + CRYPTO_INVOICE_BATCH_SIZE]
+        for i in range(0, len(invoice_ids), CRYPTO_INVOICE_BATCH_SIZE)
+    ]
+    await asyncio.gather(*(fetch_chunk(chunk) for chunk in chunks))
+    return statuses
+
+
+async def claim_paid_invoice(sub: Subscription) -> bool:
+    """Заявляет оплаченный крипто-инвойс в журнале; начисление выполнит воркер outbox.
+
+    Возвращает True, если инвойс заявлен впервые.
+    """
+    _, created = await claim_payment(
+        "crypto", sub.invoice_id, sub.user_id, sub.tariff_code, subscription_id=sub.id,
+    )
+    if created:
+        logger.info(f"✅ Инвойс {sub.invoice_id} оплачен пользователем {sub.user_id}", extra={"invoice_id": sub.invoice_id})
+    return created
+
+
+async def sweep_crypto_invoices(grace_s: int = 0) -> dict:
+    """Один проход проверки неоплаченных крипто-инвойсов.
+
+    Загружает только ID ожидающих и ещё не заявленных инвойсов, запрашивает
+    их статусы пачками и поднимает из БД лишь те строки, которые стали
+    paid/expired.
+    grace_s пропускает свежие инвойсы, которые ещё может подтвердить вебхук.
+    """
+    stats = {"pending": 0, "api_calls": 0, "api_errors": 0, "paid": 0, "expired": 0, "elapsed_s": 0.0}
+    started = time.perf_counter()
+
+    async with await get_db_session() as session:
+        result = await session.execute(
+            select(Subscription.invoice_id).where(
+                Subscription.is_paid == False,
+                Subscription.invoice_id.is_not(None),
+                Subscription.status == "pending",
+                Subscription.created_at <= datetime.utcnow() - timedelta(seconds=grace_s),
+                # Заявленный инвойс остаётся pending до начисления, но его уже ведёт журнал платежей.
+                ~select(Payment.id).where(
+                    Payment.provider == "crypto", Payment.charge_id == Subscription.invoice_id,
+                ).exists(),
+            )
+        )
+        pending_ids = [str(invoice_id) for invoice_id in result.scalars().all()]
+    stats["pending"] = len(pending_ids)
+
+    if not pending_ids:
+        stats["elapsed_s"] = time.perf_counter() - started
+        return stats
+
+    statuses = await fetch_invoice_statuses(pending_ids, stats)
+    paid_ids = [invoice_id for invoice_id, status in statuses.items() if status == "paid"]
+    expired_ids = [invoice_id for invoice_id, status in statuses.items() if status == "expired"]
+
+    if expired_ids:
+        async with await get_db_session() as session:
+            await session.execute(
+                update(Subscription)
+                .where(
+                    Subscription.invoice_id.in_(expired_ids),
+                    Subscription.is_paid == False,
+                )
+                .values(status="expired")
+            )
+            await session.commit()
+        stats["expired"] = len(expired_ids)
+
+    if paid_ids:
+        async with await get_db_session() as session:
+            result = await session.execute(
+                select(Subscription).where(
+                    Subscription.invoice_id.in_(paid_ids),
+                    Subscription.is_paid == False,
+                )
+            )
+            paid_subs = result.scalars().all()
+
+        # Подписка станет is_paid только после начисления, до тех пор повторная заявка — no-op.
+        for sub in paid_subs:
+            user_token = user_id_var.set(sub.user_id)
+            try:
+                if await claim_paid_invoice(sub):
+                    stats["paid"] += 1
+            except Exception as e:
+                logger.exception(f"Ошибка при обработке инвойса {sub.invoice_id}: {e}")
+            finally:
+                user_id_var.reset(user_token)
+
+    stats["elapsed_s"] = time.perf_counter() - started
+    return stats
+
+
+async def check_crypto_payments():
+    # При включённом вебхуке опрос только подбирает пропущенные им инвойсы.
+    if CRYPTO_WEBHOOK_ENABLED:
+        interval_s, grace_s = CRYPTO_WEBHOOK_POLL_INTERVAL, CRYPTO_WEBHOOK_GRACE_S
+    else:
+        interval_s, grace_s = CRYPTO_POLL_INTERVAL, 0
+
     while True:
-        unpaid_subs_count = 0 
+        new_request_id("crypto-sweep")
         try:
-            async with await get_db_session() as session:
-                result = await session.execute(
-                    select(Subscription).where(
-                        Subscription.is_paid == False,
-                        Subscription.invoice_id.is_not(None),
-                    )
+            stats = await sweep_crypto_invoices(grace_s=grace_s)
+            CRYPTO_SWEEP_DURATION.observe(stats["elapsed_s"])
+            CRYPTO_PENDING_INVOICES.set(stats["pending"])
+            if stats["pending"] > 0:
+                logger.info(
+                    f"Проверено {stats['pending']} неоплаченных инвойсов за {stats['elapsed_s']:.2f} с: "
+                    f"запросов к CryptoPay {stats['api_calls']} (ошибок {stats['api_errors']}), "
+                    f"оплачено {stats['paid']}, истекло {stats['expired']}.",
+                    extra={"sweep_stats": stats},
                 )
-                unpaid_subs = result.scalars().all()
-                unpaid_subs_count = len(unpaid_subs) 
-
-                for sub in unpaid_subs:
-                    try:
-                        invoice_id_str = str(sub.invoice_id)
-                        
-                        invoice_result = await crypto.get_invoices(invoice_ids=[invoice_id_str])
-                        
-                        invoices = None
-                        if invoice_result is None:
-                            print(f"❌ Ошибка: CryptoPay вернул None для инвойса {sub.invoice_id}. Проверьте токен/сеть.")
-                            continue
-                        elif isinstance(invoice_result, list):
-                            invoices = invoice_result
-                        elif hasattr(invoice_result, 'items'):
-                            invoices = invoice_result.items
-                        else:
-                            print(f"❌ Неизвестный формат ответа CryptoPay: {type(invoice_result)} для инвойса {sub.invoice_id}")
-                            continue
-
-                        if not invoices:
-                            print(f"⚠️ Инвойс {sub.invoice_id} не найден.")
-                            continue
-
-                        inv = invoices[0] 
-                        
-                        if inv.status == "paid":
-                            print(f"✅ Инвойс {sub.invoice_id} оплачен пользователем {sub.user_id}")
-
-                            link = None
-                            try:
-                                metadata = marzban_client.metadata_presets.get(sub.tariff_code, {})
-                                duration_s = metadata.get('expire', 0)
-      
-                                link = await marzban_client.create_user(
-                                    telegram_user_id=sub.user_id,
-                                    tariff_code=sub.tariff_code,
-                                    user_data=TARIFS[sub.tariff_code]
-                                )
-                            except CryptoPayAPIError as e:
-                                print(f"❌ Ошибка CryptoPay API: {e}")
-                                continue
-                            except Exception as marzban_e:
-                                print(f"❌ Ошибка при создании пользователя {sub.user_id}: {marzban_e}")
-                                await bot.send_message(
-                                    sub.user_id,
-                                    "⚠️ Оплата прошла. Повторим попытку через 30 секунд.",
-                                )
-                                continue
-                            
-                            if link:
-                                start_date = sub.expires_at if sub.expires_at and sub.expires_at > datetime.utcnow() else datetime.utcnow()
-                                duration_timedelta = timedelta(seconds=duration_s)
-
-                                sub.expires_at = start_date + duration_timedelta
-                                sub.is_paid = True
-                                sub.vpn_link = link
-                                sub.status = "active" 
-                                
-                                await session.commit()
-
-                                await bot.send_message(
-                                    sub.user_id,
-                                    f"🎉 Оплата прошла успешно!\n\n🔑 Ваша ссылка:\n\n{link}\n",
-                                    parse_mode="Markdown"
-                                )
-                            else:
-                                await bot.send_message(
-                                    sub.user_id,
-                                    "⚠️ Оплата прошла, но не удалось создать ключ VPN. Пожалуйста, свяжитесь с поддержкой.",
-                                    parse_mode="Markdown"
-                                )
-                                
-                    except Exception as e:
-                        print(f"Ошибка при проверке или обработке инвойса {sub.invoice_id}: {e}")
-
         except Exception as e:
-            print("Ошибка при проверке криптооплаты (DB):", e)
+            logger.exception(f"Ошибка при проверке криптооплаты (DB): {e}")
 
-        await asyncio.sleep(30)
-        
-        if unpaid_subs_count > 0:
-            print(f"Проверяю {unpaid_subs_count} неоплаченных инвойсов...")
\ No newline at end of file
+        await asyncio.sleep(interval_s)
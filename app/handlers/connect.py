@@ -1,11 +1,11 @@
 from aiogram import Router, F
 from aiogram.types import Message
 from ..keyboards.connect_menu import connect_menu_keyboard
-from app.services.marzban_api import marzban_client
+from app.services.panel_sync import get_user_view
 
 router = Router()
 
-@router.message(F.text == "❤️ Подключится")
+@router.message(F.text == "❤️ Подключится", flags={"throttling": "cheap"})
 async def handle_help(message: Message):
     await message.delete()
 
@@ -16,7 +16,7 @@ async def handle_help(message: Message):
     telegram_user_id = message.from_user.id
     marzban_username = f"tg{telegram_user_id}"
     
-    user_info = await marzban_client.get_user_info(marzban_username)
+    user_info, is_stale = await get_user_view(marzban_username)
     
     subscription_link = None
     if user_info:
@@ -25,6 +25,9 @@ async def handle_help(message: Message):
     if subscription_link:
         link_display = f"<code>{subscription_link}</code>"
         link_instructions = "Ссылка для ручного подключения\nТапните чтобы скопировать в буфер обмена ↓\n\n"
+    elif is_stale:
+        link_display = "Попробуйте через пару минут."
+        link_instructions = "⚠️ Сервер временно недоступен, не удалось получить ссылку.\n"
     else:
         link_display = "У вас нет активной подписки или она еще не сгенерирована."
         link_instructions = "❗️ Пожалуйста, сначала приобретите подписку в меню 💳 Купить.\n"
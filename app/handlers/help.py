@@ -3,7 +3,7 @@ from aiogram.types import Message
 
 router = Router()
 
-@router.message(F.text == "🆘 Помощь")
+@router.message(F.text == "🆘 Помощь", flags={"throttling": "cheap"})
 async def handle_help(message: Message):
     await message.delete()
 
@@ -1,8 +1,10 @@
 import time
 from datetime import datetime, timedelta
 from aiogram import Router, F
-from aiogram.types import Message
-from app.services.marzban_api import marzban_client
+from aiogram.types import Message, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup
+from aiogram.exceptions import TelegramBadRequest
+from app.services.panel_sync import get_user_view
+from app.services.traffic_history import get_daily_usage
 
 router = Router()
 
@@ -17,26 +19,64 @@ def format_bytes(bytes_value: int, suffix: str = "B") -> str:
     return f"{bytes_value:.2f} P{suffix}"
 
 
-@router.message(F.text == "ℹ️ Cтатус")
-async def handle_status(message: Message):
-    await message.delete()
-    
-    telegram_user_id = message.from_user.id
-    marzban_username = f"tg{telegram_user_id}"
-    user_info = await marzban_client.get_user_info(marzban_username)
+USAGE_PERIODS = (7, 30)
+SPARK_BLOCKS = "▁▂▃▄▅▆▇█"
+
+
+def status_keyboard() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text=f"📊 {days} дней", callback_data=f"usage_{days}")
+            for days in USAGE_PERIODS
+        ],
+        [InlineKeyboardButton(text="🔄 Обновить", callback_data="status_refresh")],
+    ])
+
+
+def usage_keyboard() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⬅️ Назад к статусу", callback_data="status_back")]
+    ])
 
+
+def _usage_text(usage: list, days: int) -> str:
+    total = sum(used for _, used in usage)
+    if not total:
+        return f"📊 Трафик за {days} дней\n\nЗа этот период трафика не было."
+
+    peak = max(used for _, used in usage)
+    lines = [f"📊 Трафик за {days} дней\n"]
+    if days <= 7:
+        for day, used in usage:
+            bar = "█" * round(used / peak * 10) if used else ""
+            lines.append(f"<code>{day:%d.%m} {bar:<10}</code> {format_bytes(used)}")
+    else:
+        spark = "".join(SPARK_BLOCKS[round(used / peak * (len(SPARK_BLOCKS) - 1))] for _, used in usage)
+        lines.append(f"<code>{spark}</code>")
+        lines.append(f"{usage[0][0]:%d.%m} — {usage[-1][0]:%d.%m}")
+    lines.append("")
+    lines.append(f"├ Всего: {format_bytes(total)}")
+    lines.append(f"├ В среднем за день: {format_bytes(total // days)}")
+    lines.append(f"└ Максимум за день: {format_bytes(peak)}")
+    return "\n".join(lines)
+
+
+def _status_text(user_info: dict | None, is_stale: bool) -> str:
     if not user_info:
-        await message.answer(
-            "ℹ️ **Ваш статус:**\n\n"
+        if is_stale:
+            return (
+                "⚠️ Сервер временно недоступен, не удалось получить статус подписки.\n\n"
+                "Попробуйте через пару минут."
+            )
+        return (
+            "ℹ️ <b>Ваш статус:</b>\n\n"
             "❌ Подписка не найдена. Похоже, вы еще не приобретали VPN-ключ.\n\n"
-            "Нажмите кнопку 'Купить', чтобы выбрать тариф.",
-            parse_mode="Markdown"
+            "Нажмите кнопку 'Купить', чтобы выбрать тариф."
         )
-        return
     
     subscription_link = user_info.get("subscription_url") or user_info.get("link")
 
-    expire_timestamp = user_info.get('expire', 0)
+    expire_timestamp = user_info.get('expire') or 0
     current_time_s = int(time.time())
     
     if expire_timestamp > current_time_s:
@@ -52,12 +92,12 @@ async def handle_status(message: Message):
         expire_date_str = expire_date.strftime("%d.%m.%Y %H:%M")
         
     else:
-        status_line = "❌ **ИСТЕКЛА**"
+        status_line = "❌ <b>ИСТЕКЛА</b>"
         time_left_str = "0 дн."
         expire_date_str = "—"
         
-    data_usage = user_info.get('data_usage', 0)
-    data_limit = user_info.get('data_limit', 0)
+    data_usage = user_info.get('used_traffic') or user_info.get('data_usage') or 0
+    data_limit = user_info.get('data_limit') or 0
     
     used_traffic = format_bytes(data_usage)
     total_limit = format_bytes(data_limit)
@@ -74,7 +114,7 @@ async def handle_status(message: Message):
         f"├ Осталось дней: {time_left_str}\n"
         f"├ Активна до: {expire_date_str}\n"
         f"{traffic_line}\n"
-        f"└ Статус сервера: `{user_info.get('status', 'Неизвестен')}`\n\n"
+        f"└ Статус сервера: <code>{user_info.get('status', 'Неизвестен')}</code>\n\n"
     )
 
     if subscription_link:
@@ -86,4 +126,54 @@ async def handle_status(message: Message):
     else:
         message_text += "🔗 Ссылка для подписки пока не найдена. Попробуйте позже."
 
-    await message.answer(message_text, parse_mode="HTML")
+    if is_stale:
+        message_text += "\n\n⚠️ Сервер временно недоступен, показаны последние известные данные."
+
+    return message_text
+
+
+@router.message(F.text == "ℹ️ Cтатус", flags={"throttling": "cheap"})
+async def handle_status(message: Message):
+    await message.delete()
+
+    user_info, is_stale = await get_user_view(f"tg{message.from_user.id}")
+    await message.answer(
+        _status_text(user_info, is_stale),
+        reply_markup=status_keyboard(),
+        parse_mode="HTML",
+    )
+
+
+@router.callback_query(F.data == "status_refresh", flags={"throttling": "expensive"})
+async def refresh_status(callback: CallbackQuery):
+    user_info, is_stale = await get_user_view(f"tg{callback.from_user.id}", refresh=True)
+    try:
+        await callback.message.edit_text(
+            _status_text(user_info, is_stale),
+            reply_markup=status_keyboard(),
+            parse_mode="HTML",
+        )
+    except TelegramBadRequest:
+        # message is not modified: данные не изменились с прошлого показа.
+        pass
+    await callback.answer("Обновлено")
+
+
+
+@router.callback_query(F.data.in_({f"usage_{days}" for days in USAGE_PERIODS}), flags={"throttling": "cheap"})
+async def show_usage(callback: CallbackQuery):
+    days = int(callback.data.removeprefix("usage_"))
+    usage = await get_daily_usage(callback.from_user.id, days)
+    await callback.message.edit_text(_usage_text(usage, days), reply_markup=usage_keyboard(), parse_mode="HTML")
+    await callback.answer()
+
+
+@router.callback_query(F.data == "status_back", flags={"throttling": "cheap"})
+async def back_to_status(callback: CallbackQuery):
+    user_info, is_stale = await get_user_view(f"tg{callback.from_user.id}")
+    await callback.message.edit_text(
+        _status_text(user_info, is_stale),
+        reply_markup=status_keyboard(),
+        parse_mode="HTML",
+    )
+    await callback.answer()
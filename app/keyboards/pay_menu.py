@@ -39,4 +39,9 @@ def get_payment_keyboard(tariff_code: str):
             InlineKeyboardButton(text="Звёздами ⭐️", callback_data=f"pay_stars_{tariff_code}")
         ]
     ]
-    return InlineKeyboardMarkup(inline_keyboard=buttons)
\ No newline at end of file
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+def get_renew_keyboard(tariff_code: str):
+    # Кнопка ведёт в тот же обработчик buy_, что и меню покупки, — сразу к get_payment_keyboard.
+    buttons = [[InlineKeyboardButton(text=f"🔄 Продлить: {TARIFS[tariff_code]['title']}", callback_data=f"buy_{tariff_code}")]]
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
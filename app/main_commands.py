@@ -1,3 +1,4 @@
+import logging
 from aiogram import Router, F
 from aiogram.filters import Command
 from aiogram.types import Message, InlineKeyboardButton, InlineKeyboardMarkup
@@ -5,69 +6,47 @@ from aiogram.types import CallbackQuery, Message
 from app.keyboards.main_menu import main_menu_keyboard
 from app.db.models import User, Subscription 
 from app.db.database import get_db_session
-from app.services.marzban_api import marzban_client
+from app.services.marzban_pool import marzban_client
+from app.services.panel_sync import forget_panel_user
 from .handlers.help import router as help_router
 from .handlers.buy import router as buy_router
 from .handlers.connect import router as connect_router
 from .handlers.status import router as status_router
+from .handlers.admin import router as admin_router
 from datetime import datetime, timedelta
-from sqlalchemy import select
+from sqlalchemy import select, exists
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from .keyboards.pay_menu import TARIFS, TRIAL_TARIFF, TRIAL_TARIFF_CODE
+from .middlewares.throttling import ThrottlingMiddleware
+from .middlewares.metrics import HandlerMetricsMiddleware
+
+logger = logging.getLogger(__name__)
 
 router = Router()
 inputs = {}
 
+handler_metrics = HandlerMetricsMiddleware()
+router.message.middleware(handler_metrics)
+router.callback_query.middleware(handler_metrics)
+router.pre_checkout_query.middleware(handler_metrics)
+
+throttling = ThrottlingMiddleware()
+router.message.middleware(throttling)
+router.callback_query.middleware(throttling)
+
 router.include_router(help_router)
 router.include_router(buy_router)
 router.include_router(connect_router)
 router.include_router(status_router)
+router.include_router(admin_router)
 
-@router.message(Command("start"))
+@router.message(Command("start"), flags={"throttling": "expensive"})
 async def start_cmd(message: Message):
-    user_id = message.from_user.id
-    TRIAL_CODE = TRIAL_TARIFF_CODE
-
-    async with await get_db_session() as session:
-        user_in_db = await session.get(User, user_id)
-        if not user_in_db:
-            new_user = User(
-                id=user_id, 
-                username=message.from_user.username,
-                registration_date=datetime.utcnow()
-            )
-            session.add(new_user)
-
-        trial_check_result = await session.execute(
-            select(Subscription).where(
-                Subscription.user_id == user_id,
-                Subscription.tariff_code == TRIAL_CODE
-            )
-        )
-        trial_subscription_exists = trial_check_result.scalars().first()
-
-        
-        if trial_subscription_exists:
-            start_message = ("👋 Приветствую!\n\n"
-                             "Вы уже использовали бесплатный тестовый доступ (3 дня / 5 GB).\n"
-                             "Для начала работы нажмите Подключиться ↓" 
-                            )
-            
-        else:
-            link = await _issue_trial_subscription(user_id, session, TRIAL_TARIFF)
-            
-            if link:
-                start_message = (f"🎉 Добро пожаловать, {message.from_user.full_name}!\n\n"
-                                 f"Мы активировали для вас **бесплатный тестовый доступ** на 3 дня и 5 GB.\n\n"
-                                 f"🔑 Ваша ссылка:\n`{link}`\n\n"
-                                 f"Для начала работы нажмите Подключиться ↓" 
-                                )
-            else:
-                start_message = ("⚠️ Ошибка при создании тестового ключа.\n\n"
-                                 "Попробуйте позже или свяжитесь с поддержкой: @truelinkmanager \n\n"
-                                 "Для начала работы нажмите Подключиться ↓" 
-                                )
-                
-        await session.commit()
+    start_message = await register_start(
+        user_id=message.from_user.id,
+        username=message.from_user.username,
+        full_name=message.from_user.full_name,
+    )
     
     await message.answer(
         text=start_message,
@@ -75,14 +54,66 @@ async def start_cmd(message: Message):
         parse_mode="Markdown"
     )
 
-async def _issue_trial_subscription(user_id: int, session, tariff_data: dict) -> str | None:
+async def register_start(user_id: int, username: str | None, full_name: str) -> str:
+    """Логика /start без Telegram: регистрация, проверка и выдача пробного доступа.
+
+    Соединение с БД держится только на время коротких транзакций и
+    возвращается в пул до обращения к Marzban.
+    """
+    async with await get_db_session() as session:
+        trial_subscription_exists = await _upsert_user_and_check_trial(session, user_id, username)
+        await session.commit()
+
+    if trial_subscription_exists:
+        return ("👋 Приветствую!\n\n"
+                "Вы уже использовали бесплатный тестовый доступ (3 дня / 5 GB).\n"
+                "Для начала работы нажмите Подключиться ↓" 
+               )
+
+    link = await _issue_trial_subscription(user_id, TRIAL_TARIFF)
+    
+    if link:
+        return (f"🎉 Добро пожаловать, {full_name}!\n\n"
+                f"Мы активировали для вас **бесплатный тестовый доступ** на 3 дня и 5 GB.\n\n"
+                f"🔑 Ваша ссылка:\n`{link}`\n\n"
+                f"Для начала работы нажмите Подключиться ↓" 
+               )
+    return ("⚠️ Ошибка при создании тестового ключа.\n\n"
+            "Попробуйте позже или свяжитесь с поддержкой: @truelinkmanager \n\n"
+            "Для начала работы нажмите Подключиться ↓" 
+           )
+
+async def _upsert_user_and_check_trial(session, user_id: int, username: str | None) -> bool:
+    """Одним запросом регистрирует пользователя (если он новый) и проверяет, брал ли он пробный доступ.
+
+    /start от пользователя, ранее заблокировавшего бота, возвращает его в рассылки.
+    """
+    inserted_user = (
+        pg_insert(User)
+        .values(id=user_id, username=username, registration_date=datetime.utcnow())
+        .on_conflict_do_update(
+            index_elements=[User.id], set_={"blocked_at": None}, where=User.blocked_at.is_not(None),
+        )
+        .returning(User.id)
+        .cte("inserted_user")
+    )
+    trial_exists = exists().where(
+        Subscription.user_id == user_id,
+        Subscription.tariff_code == TRIAL_TARIFF_CODE,
+    )
+    result = await session.execute(
+        select(trial_exists.label("has_trial"), exists(select(inserted_user.c.id)).label("created"))
+    )
+    return result.one().has_trial
+
+async def _issue_trial_subscription(user_id: int, tariff_data: dict) -> str | None:
     tariff_code = TRIAL_TARIFF_CODE 
 
     days_duration = tariff_data.get("days") 
     limit_gb = tariff_data.get("limit_gb")
 
     if days_duration == 0 or limit_gb is None:
-        print(f"❌ Ошибка конфигурации тарифа '{tariff_code}': не удалось определить срок или лимит трафика.")
+        logger.error(f"❌ Ошибка конфигурации тарифа '{tariff_code}': не удалось определить срок или лимит трафика.")
         return None
     
     try:
@@ -92,22 +123,26 @@ async def _issue_trial_subscription(user_id: int, session, tariff_data: dict) ->
             user_data={}
         )
     except Exception as e:
-        print(f"Ошибка Marzban при выдаче пробного ключа: {e}")
+        logger.exception(f"Ошибка Marzban при выдаче пробного ключа: {e}")
         return None
     
     if link:
-        new_sub = Subscription(
-            tariff_code=tariff_code,
-            expires_at=datetime.utcnow() + timedelta(days=days_duration),
-            data_limit_gb=limit_gb, 
-            status="active",
-            created_at=datetime.utcnow(),
-            user_id=user_id,
-            invoice_id=None, 
-            is_paid=True,
-            vpn_link=link
-        )
-        session.add(new_sub)
+        async with await get_db_session() as session:
+            new_sub = Subscription(
+                tariff_code=tariff_code,
+                expires_at=datetime.utcnow() + timedelta(days=days_duration),
+                data_limit_gb=limit_gb, 
+                status="active",
+                created_at=datetime.utcnow(),
+                user_id=user_id,
+                invoice_id=None, 
+                is_paid=True,
+                vpn_link=link,
+                panel=await marzban_client.panel_for(user_id),
+            )
+            session.add(new_sub)
+            await session.commit()
+        await forget_panel_user(f"tg{user_id}")
         return link
     
-    return None
\ No newline at end of file
+    return None
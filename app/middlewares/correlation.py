@@ -0,0 +1,23 @@
+from typing import Any, Awaitable, Callable, Dict
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+from app.services.logging_setup import request_id_var, user_id_var
+
+
+class CorrelationMiddleware(BaseMiddleware):
+    """Проставляет request_id (по update_id) и user_id для всех логов апдейта."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        request_token = request_id_var.set(f"upd-{event.update_id}" if isinstance(event, Update) else None)
+        user_token = user_id_var.set(user.id if user else None)
+        try:
+            return await handler(event, data)
+        finally:
+            request_id_var.reset(request_token)
+            user_id_var.reset(user_token)
@@ -0,0 +1,105 @@
+import time
+from array import array
+from typing import Any, Awaitable, Callable, Dict
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import CallbackQuery, Message, TelegramObject
+from config import THROTTLE_SLOTS
+
+# Бюджеты на класс хендлеров: (скорость токенов в секунду, ёмкость бакета).
+USER_BUDGETS = {
+    "cheap": (1.0, 5),
+    "default": (0.5, 4),
+    "expensive": (0.2, 3),
+}
+GLOBAL_BUDGETS = {
+    "cheap": (200.0, 400),
+    "default": (60.0, 120),
+    "expensive": (30.0, 60),
+}
+
+THROTTLED_TEXT = "⏳ Слишком много запросов. Подождите несколько секунд и попробуйте снова."
+# Не чаще одного предупреждения на слот за этот интервал, остальное молча отбрасывается.
+NOTICE_INTERVAL_S = 10.0
+
+_HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+
+
+class TokenBuckets:
+    """Токен-бакеты в массивах фиксированного размера.
+
+    Пользователь хешируется в один из slots слотов, поэтому память не растёт
+    с числом пользователей; коллизия лишь делит бюджет между двумя ID.
+    """
+
+    def __init__(self, slots: int, rate: float, burst: int):
+        self.mask = slots - 1
+        self.rate = rate
+        self.burst = float(burst)
+        self.tokens = array("f", [self.burst]) * slots
+        self.updated = array("d", [0.0]) * slots
+        self.noticed = array("d", [0.0]) * slots
+
+    def slot(self, key: int) -> int:
+        return ((key * _HASH_MULTIPLIER) >> 16) & self.mask
+
+    def refill(self, slot: int, now: float) -> bool:
+        """Пополняет бакет слота к моменту now; True — в нём есть целый токен."""
+        tokens = min(self.burst, self.tokens[slot] + (now - self.updated[slot]) * self.rate)
+        self.tokens[slot] = tokens
+        self.updated[slot] = now
+        return tokens >= 1.0
+
+    def take(self, slot: int):
+        self.tokens[slot] -= 1.0
+
+    def should_notice(self, slot: int, now: float) -> bool:
+        if now - self.noticed[slot] < NOTICE_INTERVAL_S:
+            return False
+        self.noticed[slot] = now
+        return True
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Ограничивает частоту апдейтов на пользователя и в целом по боту.
+
+    Класс хендлера берётся из флага throttling ("cheap", "expensive",
+    "exempt"); без флага действует бюджет "default". Отсечённый апдейт не
+    доходит до хендлера и получает заранее заготовленный ответ.
+    """
+
+    def __init__(self, slots: int = THROTTLE_SLOTS):
+        if slots & (slots - 1):
+            raise ValueError("THROTTLE_SLOTS должен быть степенью двойки.")
+        self.user_buckets = {name: TokenBuckets(slots, *budget) for name, budget in USER_BUDGETS.items()}
+        self.global_buckets = {name: TokenBuckets(1, *budget) for name, budget in GLOBAL_BUDGETS.items()}
+        self.throttled = {name: 0 for name in USER_BUDGETS}
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        handler_class = get_flag(data, "throttling", default="default")
+        user = data.get("event_from_user")
+        if handler_class == "exempt" or user is None:
+            return await handler(event, data)
+
+        now = time.monotonic()
+        buckets = self.user_buckets[handler_class]
+        global_buckets = self.global_buckets[handler_class]
+        slot = buckets.slot(user.id)
+        # Токены списываются, только если пропускают оба бакета: отказ по общему лимиту не тратит бюджет пользователя.
+        user_ok = buckets.refill(slot, now)
+        if global_buckets.refill(0, now) and user_ok:
+            buckets.take(slot)
+            global_buckets.take(0)
+            return await handler(event, data)
+
+        self.throttled[handler_class] += 1
+        if isinstance(event, CallbackQuery):
+            await event.answer(THROTTLED_TEXT)
+        elif isinstance(event, Message) and buckets.should_notice(slot, now):
+            await event.answer(THROTTLED_TEXT)
+        return None
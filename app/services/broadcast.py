@@ -0,0 +1,277 @@
+"""Рассылки всем пользователям в пределах лимитов Telegram.
+
+Получатели читаются страницами по ключу (users.id > cursor), без загрузки
+всей таблицы. После каждой страницы курсор и счётчики сохраняются в
+broadcasts, а аренда продлевается, поэтому упавший или передеплоенный
+процесс продолжит с последней сохранённой страницы: повторно сообщение
+может получить не больше одной страницы получателей.
+"""
+import asyncio
+import logging
+import time
+import uuid
+from datetime import datetime, timedelta
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+from sqlalchemy import func, select, update
+from app.db.database import get_db_session
+from app.db.models import Broadcast, User
+from app.services.logging_setup import new_request_id
+from app.services.metrics import BROADCAST_MESSAGES
+from config import (
+    BROADCAST_RATE, BROADCAST_CONCURRENCY, BROADCAST_PAGE_SIZE, BROADCAST_LEASE_S,
+    BROADCAST_POLL_INTERVAL, BROADCAST_PROGRESS_INTERVAL,
+)
+
+logger = logging.getLogger(__name__)
+
+SENT, FAILED, BLOCKED = "sent", "failed", "blocked"
+SEND_ATTEMPTS = 5
+
+# Владелец аренды: один на процесс.
+_OWNER = uuid.uuid4().hex
+_wakeup = asyncio.Event()
+
+
+class Pacer:
+    """Равномерный темп отправки, общий для всех корутин рассылки.
+
+    Каждой отправке выдаётся свой слот через 1/rate секунды после
+    предыдущего. retry_after от Telegram останавливает все отправки,
+    включая уже получившие слот, и снижает темп до конца рассылки.
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self.next_slot = 0.0
+        self.paused_until = 0.0
+
+    @property
+    def rate(self) -> float:
+        return 1 / self.interval
+
+    async def wait(self):
+        now = time.monotonic()
+        slot = max(now, self.next_slot, self.paused_until)
+        self.next_slot = slot + self.interval
+        await asyncio.sleep(slot - now)
+        while (delay := self.paused_until - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds: float, slow_down: bool = False):
+        now = time.monotonic()
+        if slow_down and self.paused_until <= now:
+            self.interval *= 1.25
+        self.paused_until = max(self.paused_until, now + seconds)
+        self.next_slot = max(self.next_slot, self.paused_until)
+
+
+async def create_broadcast(text: str, created_by: int, report_message_id: int | None = None) -> Broadcast:
+    async with await get_db_session() as session:
+        total = await session.scalar(select(func.count()).select_from(User).where(User.blocked_at.is_(None)))
+        broadcast = Broadcast(
+            text=text, status="running", created_by=created_by, report_message_id=report_message_id,
+            total=total, created_at=datetime.utcnow(),
+        )
+        session.add(broadcast)
+        await session.commit()
+    _wakeup.set()
+    return broadcast
+
+
+async def cancel_broadcast(broadcast_id: int) -> bool:
+    async with await get_db_session() as session:
+        result = await session.execute(
+            update(Broadcast).where(Broadcast.id == broadcast_id, Broadcast.status == "running")
+            .values(status="cancelled", finished_at=datetime.utcnow(), owner=None, lease_until=None)
+        )
+        await session.commit()
+    return result.rowcount > 0
+
+
+async def get_broadcast(broadcast_id: int | None = None) -> Broadcast | None:
+    """Рассылка по id или последняя созданная."""
+    async with await get_db_session() as session:
+        if broadcast_id is not None:
+            return await session.get(Broadcast, broadcast_id)
+        return await session.scalar(select(Broadcast).order_by(Broadcast.id.desc()).limit(1))
+
+
+def format_progress(broadcast: Broadcast, rate: float | None = None) -> str:
+    done = broadcast.sent + broadcast.failed + broadcast.blocked
+    titles = {"running": "⏳ идёт", "done": "✅ завершена", "cancelled": "⛔ отменена"}
+    text = (
+        f"📣 Рассылка #{broadcast.id}: {titles.get(broadcast.status, broadcast.status)}\n\n"
+        f"├ Обработано: {done} / {broadcast.total}\n"
+        f"├ Доставлено: {broadcast.sent}\n"
+        f"├ Заблокировали бота: {broadcast.blocked}\n"
+        f"└ Ошибки: {broadcast.failed}"
+    )
+    if rate:
+        eta_s = max(broadcast.total - done, 0) / rate
+        text += f"\n\n🚀 {rate:.1f} сообщ./с, осталось ~{timedelta(seconds=int(eta_s))}"
+    return text
+
+
+async def _claim() -> Broadcast | None:
+    """Берёт аренду на активную рассылку без живого владельца."""
+    now = datetime.utcnow()
+    runnable = (
+        select(Broadcast.id)
+        .where(
+            Broadcast.status == "running",
+            (Broadcast.lease_until.is_(None)) | (Broadcast.lease_until < now),
+        )
+        .order_by(Broadcast.id)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+    )
+    async with await get_db_session() as session:
+        broadcast = await session.scalar(
+            update(Broadcast).where(Broadcast.id.in_(runnable))
+            .values(owner=_OWNER, lease_until=now + timedelta(seconds=BROADCAST_LEASE_S))
+            .returning(Broadcast)
+        )
+        await session.commit()
+        return broadcast
+
+
+async def send_paced(bot: Bot, pacer: Pacer, user_id: int, text: str, reply_markup=None) -> str:
+    """Отправляет одно сообщение в темпе pacer; возвращает SENT, FAILED или BLOCKED."""
+    for attempt in range(1, SEND_ATTEMPTS + 1):
+        await pacer.wait()
+        try:
+            await bot.send_message(
+                user_id, text, parse_mode="HTML", disable_web_page_preview=True, reply_markup=reply_markup,
+            )
+            return SENT
+        except TelegramRetryAfter as e:
+            # Флуд-лимит действует на бота целиком: притормаживают все отправки.
+            if pacer.paused_until <= time.monotonic():
+                logger.warning(f"Отправка упёрлась во флуд-лимит: пауза {e.retry_after} с, темп {pacer.rate / 1.25:.1f} сообщ./с.")
+            pacer.pause(e.retry_after, slow_down=True)
+        except TelegramForbiddenError:
+            return BLOCKED
+        except TelegramBadRequest as e:
+            logger.warning(f"Сообщение пользователю {user_id} отклонено: {e.message}")
+            return FAILED
+        except (TelegramNetworkError, TelegramServerError) as e:
+            logger.warning(f"Ошибка отправки пользователю {user_id} (попытка {attempt}): {e}")
+            pacer.pause(attempt)
+    return FAILED
+
+
+async def mark_blocked(session, user_ids: list[int]):
+    """Отмечает заблокировавших бота, чтобы рассылки и напоминания их пропускали."""
+    if user_ids:
+        await session.execute(
+            update(User).where(User.id.in_(user_ids), User.blocked_at.is_(None)).values(blocked_at=datetime.utcnow())
+        )
+
+
+async def _checkpoint(broadcast: Broadcast, cursor: int, counts: dict, blocked_ids: list[int], finished: bool) -> bool:
+    """Сохраняет курсор после страницы; False — аренда потеряна или рассылку отменили."""
+    now = datetime.utcnow()
+    values = {
+        "cursor": cursor,
+        "sent": Broadcast.sent + counts[SENT],
+        "failed": Broadcast.failed + counts[FAILED],
+        "blocked": Broadcast.blocked + counts[BLOCKED],
+        "lease_until": now + timedelta(seconds=BROADCAST_LEASE_S),
+    }
+    if finished:
+        values.update(status="done", finished_at=now, owner=None, lease_until=None)
+    async with await get_db_session() as session:
+        await mark_blocked(session, blocked_ids)
+        current = await session.scalar(
+            update(Broadcast)
+            .where(Broadcast.id == broadcast.id, Broadcast.status == "running", Broadcast.owner == _OWNER)
+            .values(**values)
+            .returning(Broadcast)
+        )
+        if current is None:
+            await session.rollback()
+            return False
+        await session.commit()
+    for field in ("cursor", "sent", "failed", "blocked", "status"):
+        setattr(broadcast, field, getattr(current, field))
+    return True
+
+
+async def _report(bot: Bot, broadcast: Broadcast, rate: float | None):
+    if not broadcast.report_message_id:
+        return
+    try:
+        await bot.edit_message_text(
+            format_progress(broadcast, rate), chat_id=broadcast.created_by, message_id=broadcast.report_message_id,
+        )
+    except Exception as e:
+        logger.debug(f"Не удалось обновить отчёт рассылки #{broadcast.id}: {e}")
+
+
+async def run_broadcast(bot: Bot, broadcast: Broadcast, rate: float = BROADCAST_RATE,
+                        concurrency: int = BROADCAST_CONCURRENCY, page_size: int = BROADCAST_PAGE_SIZE) -> Broadcast:
+    """Отправляет рассылку с сохранённого курсора до конца, отмены или потери аренды."""
+    pacer = Pacer(rate)
+    semaphore = asyncio.Semaphore(concurrency)
+    started, processed = time.monotonic(), 0
+    last_report = 0.0
+    logger.info(f"📣 Рассылка #{broadcast.id}: старт с курсора {broadcast.cursor}.", extra={"broadcast_id": broadcast.id})
+
+    async def deliver(user_id: int) -> str:
+        async with semaphore:
+            return await send_paced(bot, pacer, user_id, broadcast.text)
+
+    while True:
+        async with await get_db_session() as session:
+            user_ids = (await session.scalars(
+                select(User.id)
+                .where(User.id > broadcast.cursor, User.blocked_at.is_(None))
+                .order_by(User.id)
+                .limit(page_size)
+            )).all()
+
+        results = await asyncio.gather(*(deliver(user_id) for user_id in user_ids))
+        counts = {SENT: 0, FAILED: 0, BLOCKED: 0}
+        for result in results:
+            counts[result] += 1
+            BROADCAST_MESSAGES.labels(result).inc()
+        blocked_ids = [user_id for user_id, result in zip(user_ids, results) if result == BLOCKED]
+
+        finished = len(user_ids) < page_size
+        cursor = user_ids[-1] if user_ids else broadcast.cursor
+        if not await _checkpoint(broadcast, cursor, counts, blocked_ids, finished):
+            logger.warning(f"Рассылка #{broadcast.id} остановлена: отменена или перехвачена другим процессом.")
+            return broadcast
+
+        processed += len(user_ids)
+        rate_now = processed / (time.monotonic() - started) if processed else None
+        if finished:
+            logger.info(
+                f"✅ Рассылка #{broadcast.id} завершена: доставлено {broadcast.sent}, "
+                f"заблокировали {broadcast.blocked}, ошибок {broadcast.failed}.",
+                extra={"broadcast_id": broadcast.id},
+            )
+            await _report(bot, broadcast, None)
+            return broadcast
+        if time.monotonic() - last_report >= BROADCAST_PROGRESS_INTERVAL:
+            last_report = time.monotonic()
+            await _report(bot, broadcast, rate_now)
+
+
+async def run_broadcasts(bot: Bot):
+    """Фоновый цикл: подхватывает новые рассылки и брошенные упавшими процессами."""
+    while True:
+        try:
+            broadcast = await _claim()
+            if broadcast is not None:
+                new_request_id(f"broadcast{broadcast.id}")
+                await run_broadcast(bot, broadcast)
+                continue
+        except Exception as e:
+            logger.exception(f"Ошибка рассылки: {e}")
+        _wakeup.clear()
+        try:
+            await asyncio.wait_for(_wakeup.wait(), BROADCAST_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
@@ -0,0 +1,69 @@
+import hashlib
+import hmac
+import json
+import logging
+from aiohttp import web
+from sqlalchemy import select
+from app.db.database import get_db_session
+from app.db.models import Subscription
+from app.handlers.buy import claim_paid_invoice
+from app.services.logging_setup import new_request_id, user_id_var
+from config import CRYPTO_TOKEN
+
+SIGNATURE_HEADER = "crypto-pay-api-signature"
+
+logger = logging.getLogger(__name__)
+
+
+def compute_signature(token: str, body: bytes) -> str:
+    """Подпись Crypto Pay: HMAC-SHA256 тела запроса с ключом SHA256(токена)."""
+    secret = hashlib.sha256(token.encode()).digest()
+    return hmac.new(secret, body, hashlib.sha256).hexdigest()
+
+
+def verify_signature(token: str, body: bytes, signature: str | None) -> bool:
+    if not token or not signature:
+        return False
+    return hmac.compare_digest(compute_signature(token, body), signature)
+
+
+async def crypto_webhook_handler(request: web.Request) -> web.Response:
+    """Принимает invoice_paid от Crypto Pay и сразу выдаёт ключ."""
+    new_request_id("crypto-webhook")
+    body = await request.read()
+
+    if not verify_signature(CRYPTO_TOKEN, body, request.headers.get(SIGNATURE_HEADER)):
+        logger.warning("❌ CryptoPay webhook: неверная подпись.")
+        return web.Response(status=401)
+
+    try:
+        update = json.loads(body)
+    except json.JSONDecodeError:
+        return web.Response(status=400)
+
+    if update.get("update_type") != "invoice_paid":
+        return web.Response(text="ok")
+
+    invoice = update.get("payload") or {}
+    invoice_id = invoice.get("invoice_id")
+    if invoice_id is None:
+        return web.Response(status=400)
+
+    async with await get_db_session() as session:
+        result = await session.execute(
+            select(Subscription).where(
+                Subscription.invoice_id == str(invoice_id),
+                Subscription.is_paid == False,
+            )
+        )
+        sub = result.scalars().first()
+
+    if not sub:
+        # Уже обработан опросом или повторная доставка.
+        return web.Response(text="ok")
+
+    user_id_var.set(sub.user_id)
+    await claim_paid_invoice(sub)
+
+    # Crypto Pay повторяет доставку при не-200, а недоставленное подберёт опрос.
+    return web.Response(text="ok")
@@ -0,0 +1,123 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+from sqlalchemy import bindparam, select, update, tuple_
+from app.db.database import get_db_session
+from app.db.models import Subscription
+from app.services.marzban_pool import marzban_client
+from app.services.logging_setup import new_request_id
+from config import EXPIRY_SWEEP_INTERVAL, EXPIRY_SWEEP_BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+async def _panel_expiry(user_ids: set[int]) -> dict[int, int] | None:
+    """Текущий expire пользователей из панели одной страницей api/users."""
+    page = await marzban_client.get_users_page(
+        usernames=[f"tg{user_id}" for user_id in user_ids],
+        limit=len(user_ids),
+    )
+    if page is None:
+        return None
+    return {
+        int(user["username"].removeprefix("tg")): int(user.get("expire") or 0)
+        for user in page.get("users", [])
+        if user.get("username", "").removeprefix("tg").isdigit()
+    }
+
+
+async def sweep_expired_subscriptions(batch_size: int = EXPIRY_SWEEP_BATCH_SIZE) -> dict:
+    """Один проход: переводит истёкшие активные подписки в status="expired".
+
+    Строки выбираются диапазоном по индексу
+    ix_subscriptions_status_expires_at и обходятся keyset-пагинацией по
+    (expires_at, id), так что проход стоит O(истёкших строк). Перед
+    обновлением сверяемся с панелью: если подписку продлили в Marzban,
+    последняя строка пользователя получает новый expires_at и остаётся активной.
+    Пачка читается короткой транзакцией, панель опрашивается без открытой
+    сессии, а UPDATE трогает только строки, которые всё ещё активны и
+    истекли: начисление, прошедшее за это время, не затирается.
+    """
+    stats = {"expired": 0, "extended": 0, "skipped": 0, "batches": 0, "elapsed_s": 0.0}
+    started = time.perf_counter()
+    now = datetime.utcnow()
+    cursor = None
+
+    while True:
+        async with await get_db_session() as session:
+            query = (
+                select(Subscription.id, Subscription.expires_at, Subscription.user_id)
+                .where(Subscription.status == "active", Subscription.expires_at < now)
+                .order_by(Subscription.expires_at, Subscription.id)
+                .limit(batch_size)
+            )
+            if cursor is not None:
+                query = query.where(tuple_(Subscription.expires_at, Subscription.id) > cursor)
+            rows = (await session.execute(query)).all()
+        if not rows:
+            break
+
+        cursor = (rows[-1].expires_at, rows[-1].id)
+        stats["batches"] += 1
+
+        latest_row = {}
+        for row in rows:
+            latest_row[row.user_id] = max(row.id, latest_row.get(row.user_id, 0))
+
+        panel_expiry = await _panel_expiry(set(latest_row))
+        if panel_expiry is None:
+            # Панель недоступна: не трогаем пачку, её подберёт следующий проход.
+            stats["skipped"] += len(rows)
+        else:
+            now_s = int(time.time())
+            extended = [
+                {"b_id": latest_row[user_id], "b_expires_at": datetime.utcfromtimestamp(expire_s)}
+                for user_id, expire_s in panel_expiry.items()
+                if expire_s > now_s and user_id in latest_row
+            ]
+            extended_ids = {item["b_id"] for item in extended}
+            expired_ids = [row.id for row in rows if row.id not in extended_ids]
+            still_expired = (Subscription.status == "active", Subscription.expires_at < now)
+
+            async with await get_db_session() as session:
+                if expired_ids:
+                    result = await session.execute(
+                        update(Subscription)
+                        .where(Subscription.id.in_(expired_ids), *still_expired)
+                        .values(status="expired")
+                    )
+                    stats["expired"] += result.rowcount
+                if extended:
+                    await session.execute(
+                        update(Subscription.__table__)
+                        .where(Subscription.id == bindparam("b_id"), *still_expired)
+                        .values(expires_at=bindparam("b_expires_at")),
+                        extended,
+                    )
+                    stats["extended"] += len(extended)
+                await session.commit()
+
+        if len(rows) < batch_size:
+            break
+
+    stats["elapsed_s"] = time.perf_counter() - started
+    return stats
+
+
+async def run_expiry_sweeper():
+    while True:
+        new_request_id("expiry-sweep")
+        try:
+            stats = await sweep_expired_subscriptions()
+            if stats["batches"]:
+                logger.info(
+                    f"Свипер подписок: истекло {stats['expired']}, продлено по данным панели {stats['extended']}, "
+                    f"отложено {stats['skipped']}, "
+                    f"пачек {stats['batches']}, {stats['elapsed_s']:.2f} с.",
+                    extra={"sweep_stats": stats},
+                )
+        except Exception as e:
+            logger.exception(f"Ошибка свипера истёкших подписок: {e}")
+
+        await asyncio.sleep(EXPIRY_SWEEP_INTERVAL)
@@ -0,0 +1,84 @@
+import asyncio
+import aiohttp
+from typing import Dict, Any
+
+
+class PoolStats:
+    """Счётчики пула соединений, собираемые через aiohttp.TraceConfig."""
+
+    def __init__(self):
+        self.requests = 0
+        self.queued = 0
+        self.queue_wait_total_s = 0.0
+        self.queue_wait_max_s = 0.0
+        self.created = 0
+        self.create_time_total_s = 0.0
+        self.reused = 0
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        trace = aiohttp.TraceConfig()
+        loop_time = lambda: asyncio.get_running_loop().time()
+
+        async def on_request_start(session, ctx, params):
+            self.requests += 1
+
+        async def on_queued_start(session, ctx, params):
+            ctx.queued_at = loop_time()
+
+        async def on_queued_end(session, ctx, params):
+            waited = loop_time() - ctx.queued_at
+            self.queued += 1
+            self.queue_wait_total_s += waited
+            self.queue_wait_max_s = max(self.queue_wait_max_s, waited)
+
+        async def on_create_start(session, ctx, params):
+            ctx.create_started_at = loop_time()
+
+        async def on_create_end(session, ctx, params):
+            self.created += 1
+            self.create_time_total_s += loop_time() - ctx.create_started_at
+
+        async def on_reuse(session, ctx, params):
+            self.reused += 1
+
+        trace.on_request_start.append(on_request_start)
+        trace.on_connection_queued_start.append(on_queued_start)
+        trace.on_connection_queued_end.append(on_queued_end)
+        trace.on_connection_create_start.append(on_create_start)
+        trace.on_connection_create_end.append(on_create_end)
+        trace.on_connection_reuseconn.append(on_reuse)
+        return trace
+
+    def snapshot(self, connector: aiohttp.TCPConnector | None = None) -> Dict[str, Any]:
+        acquired = len(getattr(connector, "_acquired", ())) if connector else 0
+        connections = self.created + self.reused
+        return {
+            "in_use": acquired,
+            "limit": connector.limit if connector else 0,
+            "limit_per_host": connector.limit_per_host if connector else 0,
+            "requests": self.requests,
+            "queued": self.queued,
+            "queue_wait_avg_ms": self.queue_wait_total_s / self.queued * 1000 if self.queued else 0.0,
+            "queue_wait_max_ms": self.queue_wait_max_s * 1000,
+            "created": self.created,
+            "create_avg_ms": self.create_time_total_s / self.created * 1000 if self.created else 0.0,
+            "reused": self.reused,
+            "reuse_ratio": self.reused / connections if connections else 0.0,
+        }
+
+
+def build_session(stats: PoolStats, limit: int, limit_per_host: int, dns_cache_ttl: int,
+                  keepalive_timeout: float, total_timeout: float) -> aiohttp.ClientSession:
+    """Создаёт ClientSession с явно настроенным пулом соединений."""
+    connector = aiohttp.TCPConnector(
+        limit=limit,
+        limit_per_host=limit_per_host,
+        ttl_dns_cache=dns_cache_ttl,
+        use_dns_cache=True,
+        keepalive_timeout=keepalive_timeout,
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=total_timeout),
+        trace_configs=[stats.trace_config()],
+    )
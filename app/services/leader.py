@@ -0,0 +1,113 @@
+"""Выбор лидера для фоновых задач, которые должны идти в одном экземпляре.
+
+Каждая такая задача привязана к сессионному advisory-lock Postgres. Все
+блокировки реплики держит одно выделенное соединение: задачу запускает
+та реплика, которой достался её ключ. Если реплика падает, Postgres
+снимает блокировки при разрыве её соединения, и другая реплика забирает
+задачу на следующем тике (не позже LEADER_HEARTBEAT_S). Лидер, потерявший
+связь с базой, сам останавливает свои задачи.
+
+Задачи-очереди (outbox, свипер подписок) в лидере не нуждаются: они
+делят строки между репликами через FOR UPDATE SKIP LOCKED.
+"""
+import asyncio
+import logging
+import zlib
+from typing import Awaitable, Callable, Dict
+from sqlalchemy import func, select, text
+from sqlalchemy.ext.asyncio import AsyncConnection
+from app.db.database import engine
+from app.services.metrics import Gauge
+from config import LEADER_HEARTBEAT_S
+
+logger = logging.getLogger(__name__)
+
+# Пространство ключей лидерства: выше ключей пользователей из payments (1 << 40 + user_id).
+_LOCK_BASE = 1 << 41
+
+# Без keepalive сервер держит блокировку зависшей реплики до таймаута TCP.
+_KEEPALIVE_SETTINGS = {"tcp_keepalives_idle": 10, "tcp_keepalives_interval": 5, "tcp_keepalives_count": 3}
+
+
+def leader_lock_key(name: str) -> int:
+    return _LOCK_BASE + zlib.crc32(name.encode())
+
+
+class LeaderElection:
+    def __init__(self, heartbeat_s: float = LEADER_HEARTBEAT_S):
+        self.heartbeat_s = heartbeat_s
+        self._jobs: Dict[str, Callable[[], Awaitable[None]]] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._conn: AsyncConnection | None = None
+
+    def singleton(self, name: str, job: Callable[[], Awaitable[None]]):
+        """Регистрирует задачу: job() запускается только на реплике-лидере по ключу name."""
+        self._jobs[name] = job
+
+    def is_leader(self, name: str) -> bool:
+        task = self._tasks.get(name)
+        return task is not None and not task.done()
+
+    @property
+    def leading(self) -> int:
+        return sum(self.is_leader(name) for name in self._jobs)
+
+    async def _connect(self) -> AsyncConnection:
+        conn = await engine.connect()
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        for setting, value in _KEEPALIVE_SETTINGS.items():
+            await conn.execute(text(f"SET {setting} = {value}"))
+        return conn
+
+    async def _tick(self):
+        if self._conn is None:
+            self._conn = await self._connect()
+        await self._conn.execute(text("SELECT 1"))
+
+        for name, job in self._jobs.items():
+            key = leader_lock_key(name)
+            task = self._tasks.get(name)
+            if task is not None and task.done():
+                # Задача завершилась или упала: отпускаем ключ, пусть её перезапустит любая реплика.
+                if not task.cancelled() and task.exception():
+                    logger.error(f"Задача {name} упала: {task.exception()!r}")
+                del self._tasks[name]
+                await self._conn.execute(select(func.pg_advisory_unlock(key)))
+                continue
+            if task is None and await self._conn.scalar(select(func.pg_try_advisory_lock(key))):
+                logger.info(f"👑 Реплика стала лидером задачи {name}.")
+                self._tasks[name] = asyncio.create_task(job(), name=f"leader:{name}")
+
+    async def _step_down(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if tasks:
+            logger.warning(f"Лидерство снято с задач: {', '.join(self._tasks)}.")
+        self._tasks.clear()
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            try:
+                await conn.invalidate()
+                await conn.close()
+            except Exception:
+                pass
+
+    async def run(self):
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self._tick(), self.heartbeat_s)
+                except Exception as e:
+                    # Без живого соединения блокировки уже могли перейти к другой реплике.
+                    logger.warning(f"Нет связи с Postgres для выбора лидера: {e!r}")
+                    await self._step_down()
+                await asyncio.sleep(self.heartbeat_s)
+        finally:
+            await self._step_down()
+
+
+leader_election = LeaderElection()
+
+Gauge("leader_jobs", "Фоновые задачи, для которых эта реплика сейчас лидер.", lambda: leader_election.leading)
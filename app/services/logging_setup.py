@@ -0,0 +1,127 @@
+"""Неблокирующее логирование: запись в stdout вынесена в фоновый поток.
+
+Вызов logger.info() в event loop только собирает LogRecord, подставляет
+корреляционные ID из contextvars и кладёт запись в очередь. Форматирование
+(JSON или текст) и запись в поток делает QueueListener в отдельном потоке.
+"""
+import contextvars
+import itertools
+import json
+import logging
+import queue
+import sys
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional, TextIO
+
+request_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("request_id", default=None)
+user_id_var: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar("user_id", default=None)
+
+_request_counter = itertools.count(1)
+
+# Атрибуты, которые есть у любого LogRecord; всё остальное пришло через extra=.
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "request_id", "user_id"}
+
+_listener: Optional[QueueListener] = None
+
+
+def new_request_id(prefix: str) -> str:
+    """Выставляет в текущем контексте новый request_id вида prefix-N и возвращает его."""
+    request_id = f"{prefix}-{next(_request_counter)}"
+    request_id_var.set(request_id)
+    return request_id
+
+
+class ContextQueueHandler(QueueHandler):
+    """QueueHandler, который фиксирует контекст и сообщение в потоке вызова.
+
+    contextvars не видны из потока слушателя, поэтому request_id/user_id
+    копируются в запись здесь. Само форматирование остаётся слушателю.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.request_id = request_id_var.get()
+        record.user_id = user_id_var.get()
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        request_id = getattr(record, "request_id", None)
+        user_id = getattr(record, "user_id", None)
+        if request_id is not None:
+            payload["request_id"] = request_id
+        if user_id is not None:
+            payload["user_id"] = user_id
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS:
+                payload[key] = value
+        if record.exc_text:
+            payload["exc"] = record.exc_text
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s [%(request_id)s user=%(user_id)s] %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        record.request_id = getattr(record, "request_id", None) or "-"
+        record.user_id = getattr(record, "user_id", None) or "-"
+        return super().format(record)
+
+
+def parse_levels(spec: str) -> dict[str, int]:
+    """Разбирает LOG_LEVELS вида "app.services.marzban_api=DEBUG,aiogram=WARNING"."""
+    levels = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, level = item.partition("=")
+        if not level:
+            raise ValueError(f"Некорректный элемент LOG_LEVELS: '{item}', ожидается logger=LEVEL")
+        levels[name.strip()] = logging.getLevelName(level.strip().upper())
+    return levels
+
+
+def setup_logging(level: str = "INFO", levels: str = "", fmt: str = "json", stream: TextIO | None = None) -> QueueListener:
+    """Настраивает корневой логгер на очередь и запускает поток-слушатель.
+
+    level — уровень корневого логгера, levels — уровни отдельных подсистем
+    (по именам логгеров), fmt — "json" или "text".
+    """
+    global _listener
+    stop_logging()
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter())
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(ContextQueueHandler(log_queue))
+    root.setLevel(level.upper())
+    for name, subsystem_level in parse_levels(levels).items():
+        logging.getLogger(name).setLevel(subsystem_level)
+
+    _listener = QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def stop_logging():
+    """Останавливает слушатель, дописывая всё, что осталось в очереди."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
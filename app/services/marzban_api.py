@@ -1,17 +1,79 @@
 import aiohttp
+import asyncio
+import base64
 import json
+import os
 import time 
-from urllib.parse import urljoin 
-from config import MARZBAN_API_URL, MARZBAN_USERNAME, MARZBAN_PASSWORD
-from typing import Optional, Dict, Any
-from datetime import datetime
+import logging
+from urllib.parse import urljoin, urlencode
+from config import (
+    MARZBAN_API_URL, MARZBAN_USERNAME, MARZBAN_PASSWORD, MARZBAN_USER_CACHE_SIZE, MARZBAN_USER_CACHE_TTL,
+    MARZBAN_TOKEN_STATE_FILE, MARZBAN_TOKEN_REFRESH_MARGIN,
+    MARZBAN_BREAKER_THRESHOLD, MARZBAN_BREAKER_RESET_S, MARZBAN_MAX_INFLIGHT, MARZBAN_STALE_TTL,
+    MARZBAN_API_URLS, MARZBAN_POOL_LIMIT, MARZBAN_POOL_LIMIT_PER_HOST, MARZBAN_DNS_CACHE_TTL,
+    MARZBAN_KEEPALIVE_TIMEOUT, MARZBAN_BULK_CONCURRENCY, MARZBAN_BULK_PAGE_SIZE,
+    MARZBAN_HEALTH_INTERVAL, MARZBAN_DEFAULT_INBOUND, MARZBAN_INBOUND_TAGS, MARZBAN_INBOUND_NODES,
+    MARZBAN_INBOUND_STICKINESS,
+)
+from app.services.cache import TTLCache
+from app.services.resilience import CircuitBreaker, IDEMPOTENT_METHODS, policy_for, path_template
+from app.services.metrics import MARZBAN_REQUEST_LATENCY, MARZBAN_REQUEST_ERRORS
+from app.services.http_transport import PoolStats, build_session
+from app.services.panel_health import PanelHealth
+from typing import Optional, Dict, Any, Iterable, AsyncIterable, AsyncIterator, Awaitable, Callable
 import sys
 
+AUTH_PATHS = ["api/admin/token", "admin/token", "token"]
+
+logger = logging.getLogger(__name__)
+
+
+def decode_token_expiry(token: str) -> Optional[float]:
+    """Достаёт exp из JWT без проверки подписи (она нужна только панели)."""
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
 class MarzbanAPI:
-    def __init__(self):
-        self.base_url = MARZBAN_API_URL.rstrip('/')
+    def __init__(self, name: str = "main", base_urls: Optional[list[str]] = None,
+                 username: Optional[str] = MARZBAN_USERNAME, password: Optional[str] = MARZBAN_PASSWORD,
+                 token_state_file: Optional[str] = MARZBAN_TOKEN_STATE_FILE,
+                 inbound_nodes: Optional[Dict[str, list[str]]] = None):
+        urls = base_urls or MARZBAN_API_URLS or [MARZBAN_API_URL]
+        self.name = name
+        self.base_urls = [url.rstrip('/') for url in urls]
+        self.username = username
+        self.password = password
+        self.token_state_file = token_state_file
+        self._base_url_index = 0
+        self.pool_stats = PoolStats()
         self.auth_token: Optional[str] = None
+        self.token_expires_at: Optional[float] = None
+        self.token_path: Optional[str] = None
+        self._auth_lock = asyncio.Lock()
         self.session: Optional[aiohttp.ClientSession] = None
+
+        self._user_cache = TTLCache(maxsize=MARZBAN_USER_CACHE_SIZE, ttl=MARZBAN_USER_CACHE_TTL)
+        self._user_inflight: Dict[str, asyncio.Future] = {}
+        self.coalesced_lookups = 0
+        # Последние известные данные для деградированного режима, когда панель недоступна.
+        self._last_known = TTLCache(maxsize=MARZBAN_USER_CACHE_SIZE, ttl=MARZBAN_STALE_TTL)
+
+        self.breaker = CircuitBreaker(failure_threshold=MARZBAN_BREAKER_THRESHOLD, reset_timeout=MARZBAN_BREAKER_RESET_S)
+        # Свой breaker у фонового снимка здоровья: медленный api/nodes/usage не размыкает цепь пользователям.
+        self.health_breaker = CircuitBreaker(failure_threshold=MARZBAN_BREAKER_THRESHOLD, reset_timeout=MARZBAN_BREAKER_RESET_S)
+        self._inflight_requests = 0
+        self.shed_requests = 0
+
+        self.health = PanelHealth(
+            name, "vless", MARZBAN_DEFAULT_INBOUND, MARZBAN_INBOUND_TAGS,
+            MARZBAN_INBOUND_NODES if inbound_nodes is None else inbound_nodes,
+            stale_after=3 * MARZBAN_HEALTH_INTERVAL, stickiness=MARZBAN_INBOUND_STICKINESS,
+        )
  
         self.metadata_presets = {
             'free': {'expire': 259200, 'data_limit': 5368709120}, # 5 GB
@@ -21,12 +83,39 @@ class MarzbanAPI:
         }
 
     async def initialize(self):
+        self._ensure_session()
+        if not self.auth_token:
+            self._load_token_state()
+        await self._ensure_token()
+
+    @property
+    def base_url(self) -> str:
+        return self.base_urls[0]
+
+    @base_url.setter
+    def base_url(self, value: str):
+        self.base_urls = [value.rstrip('/')]
+
+    def _next_base_url(self) -> str:
+        """Перебирает адреса панели по кругу, чтобы повтор шёл на другой адрес."""
+        url = self.base_urls[self._base_url_index % len(self.base_urls)]
+        self._base_url_index += 1
+        return url
+
+    def _ensure_session(self):
         if self.session is None or self.session.closed:
-            timeout = aiohttp.ClientTimeout(total=15)
-            self.session = aiohttp.ClientSession(timeout=timeout)
+            self.session = build_session(
+                self.pool_stats,
+                limit=MARZBAN_POOL_LIMIT,
+                limit_per_host=MARZBAN_POOL_LIMIT_PER_HOST,
+                dns_cache_ttl=MARZBAN_DNS_CACHE_TTL,
+                keepalive_timeout=MARZBAN_KEEPALIVE_TIMEOUT,
+                total_timeout=15,
+            )
 
-        if not self.auth_token:
-            await self._authenticate()
+    def transport_stats(self) -> Dict[str, Any]:
+        connector = self.session.connector if self.session and not self.session.closed else None
+        return {**self.pool_stats.snapshot(connector), "base_urls": len(self.base_urls)}
         
     async def close(self):
         if self.session and not self.session.closed:
@@ -42,63 +131,114 @@ class MarzbanAPI:
              headers["Content-Type"] = "application/json"
         return headers
 
-    async def _request(self, method: str, path: str, data: Optional[Dict[str, Any]] = None, is_form_data: bool = False) -> Optional[Dict[str, Any]]:
-        """Общий асинхронный метод для выполнения HTTP-запросов."""
-        
-        if self.session is None or self.session.closed:
-            try:
-                 await self.initialize() 
-            except Exception as e:
-                 print(f"Ошибка инициализации в _request: {e}")
-                 return None
+    async def _request(self, method: str, path: str, data: Optional[Dict[str, Any]] = None, is_form_data: bool = False,
+                       breaker: Optional[CircuitBreaker] = None) -> Optional[Dict[str, Any]]:
+        """Общий асинхронный метод для выполнения HTTP-запросов.
 
-        target_base_url = self.base_url
+        Весь запрос укладывается в дедлайн эндпоинта, повторяются только
+        идемпотентные методы (экспоненциальная задержка с джиттером), а при
+        разомкнутом circuit breaker запрос сразу отклоняется. Фоновые запросы
+        передают свой breaker, чтобы их сбои не отсекали запросы пользователей.
+        """
         
-        url = f"{target_base_url.rstrip('/')}/{path.lstrip('/')}"
-        
-        is_auth_path = path in ["api/admin/token", "admin/token", "token"] 
-        headers = self._get_headers(is_json=not is_form_data and not is_auth_path) 
+        try:
+            self._ensure_session()
+        except Exception as e:
+            logger.error(f"Ошибка инициализации в _request: {e}")
+            return None
+
+        is_auth_path = path in AUTH_PATHS
+        if not is_auth_path and not await self._ensure_token():
+            return None
+
+        endpoint = path_template(path)
+        breaker = breaker or self.breaker
+        if not breaker.allow_request():
+            MARZBAN_REQUEST_ERRORS.labels(self.name, method, endpoint, "circuit_open").inc()
+            logger.warning(f"⚡ Marzban {self.name} недоступен (circuit breaker разомкнут), {method} {path} отклонён.")
+            return None
         
         if is_form_data:
             request_kwargs = {'data': data}
         else:
             request_kwargs = {'json': data}
         
+        policy = policy_for(method, path)
+        max_attempts = policy.max_attempts if method in IDEMPOTENT_METHODS else 1
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + policy.deadline
+        reauthenticated = False
+        attempt = 0
+
+        self._inflight_requests += 1
+        started = loop.time()
         try:
-            for attempt in range(3):
-                async with self.session.request(
-                    method, 
-                    url, 
-                    headers=headers, 
-                    **request_kwargs
-                ) as response:
-                    
-                    response_text = await response.text()
-                    
-                    if response.status in [200, 201]:
-                        try:
-                            return await response.json()
-                        except json.JSONDecodeError:
-                            return {} 
-                    
-                    if method == "GET" and response.status == 404 and "api/user/" in path:
-                        return None
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    breaker.record_failure()
+                    MARZBAN_REQUEST_ERRORS.labels(self.name, method, endpoint, "deadline").inc()
+                    logger.error(f"❌ Marzban API Error ({method} {path}): дедлайн {policy.deadline} с исчерпан.")
+                    return None
+
+                url = f"{self._next_base_url()}/{path.lstrip('/')}"
+                used_token = self.auth_token
+                headers = self._get_headers(is_json=not is_form_data and not is_auth_path)
+                try:
+                    async with self.session.request(
+                        method, 
+                        url, 
+                        headers=headers, 
+                        timeout=aiohttp.ClientTimeout(total=remaining),
+                        **request_kwargs
+                    ) as response:
+                        
+                        response_text = await response.text()
+                        
+                        if response.status == 401 and not is_auth_path and not reauthenticated:
+                            reauthenticated = True
+                            if await self._ensure_token(force=True, stale_token=used_token):
+                                continue
+                            return None
                         
-                    if response.status >= 500 and attempt < 2:
-                        await time.sleep(2 ** attempt) 
-                        continue
+                        if response.status in [200, 201]:
+                            breaker.record_success()
+                            try:
+                                return json.loads(response_text) if response_text else {}
+                            except json.JSONDecodeError:
+                                return {} 
                         
-                    print(f"❌ Marzban API Error ({method} {path}): Status {response.status}. URL: {url}. Response: {response_text}")
+                        if method == "GET" and response.status == 404 and "api/user/" in path:
+                            breaker.record_success()
+                            return None
+
+                        if response.status < 500:
+                            # 4xx — ошибка запроса, а не панели: не повторяем и не размыкаем цепь.
+                            breaker.record_success()
+                            MARZBAN_REQUEST_ERRORS.labels(self.name, method, endpoint, "http_4xx").inc()
+                            logger.warning(f"❌ Marzban API Error ({method} {path}): Status {response.status}. URL: {url}. Response: {response_text}")
+                            return None
+
+                        error = f"Status {response.status}. URL: {url}. Response: {response_text}"
+                        error_kind = "http_5xx"
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    error = f"{type(e).__name__}: {e}"
+                    error_kind = "network"
+
+                breaker.record_failure()
+                MARZBAN_REQUEST_ERRORS.labels(self.name, method, endpoint, error_kind).inc()
+                attempt += 1
+                delay = policy.backoff(attempt)
+                if attempt >= max_attempts or delay >= deadline - loop.time() or not breaker.allow_request():
+                    logger.error(f"❌ Marzban API Error ({method} {path}) после {attempt} попыток: {error}")
                     return None
-                    
-        except aiohttp.ClientError as e:
-            print(f"❌ Marzban Network Error ({method} {path}): {e}")
-            return None
-        
-        return None
+                await asyncio.sleep(delay)
+        finally:
+            self._inflight_requests -= 1
+            MARZBAN_REQUEST_LATENCY.labels(self.name, method, endpoint).observe(loop.time() - started)
 
-    async def _get(self, path: str) -> Optional[Dict[str, Any]]:
-        return await self._request("GET", path)
+    async def _get(self, path: str, breaker: Optional[CircuitBreaker] = None) -> Optional[Dict[str, Any]]:
+        return await self._request("GET", path, breaker=breaker)
 
     async def _post(self, path: str, data: Optional[Dict[str, Any]] = None, is_form_data: bool = False) -> Optional[Dict[str, Any]]:
         return await self._request("POST", path, data=data, is_form_data=is_form_data)
@@ -106,67 +246,248 @@ class MarzbanAPI:
     async def _put(self, path: str, data: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
         return await self._request("PUT", path, data=data)
 
+    def _token_is_fresh(self) -> bool:
+        if not self.auth_token:
+            return False
+        if self.token_expires_at is None:
+            return True
+        return self.token_expires_at - time.time() > MARZBAN_TOKEN_REFRESH_MARGIN
+
+    async def _ensure_token(self, force: bool = False, stale_token: Optional[str] = None) -> bool:
+        """Гарантирует действующий токен; параллельные вызовы делят одну аутентификацию.
+
+        force=True используется после 401: если другой запрос уже сменил
+        stale_token, повторно аутентифицироваться не нужно.
+        """
+        if not force and self._token_is_fresh():
+            return True
+
+        async with self._auth_lock:
+            if force and self.auth_token and self.auth_token != stale_token:
+                return True
+            if not force and self._token_is_fresh():
+                return True
+            return await self._authenticate()
+
     async def _authenticate(self) -> bool:
-        """Получает токен аутентификации Marzban, пробуя разные пути."""
+        """Получает токен аутентификации Marzban, пробуя разные пути.
+
+        Сначала пробует путь, сработавший в прошлый раз.
+        """
         data = {
-            "username": MARZBAN_USERNAME,
-            "password": MARZBAN_PASSWORD
+            "username": self.username,
+            "password": self.password
         }
         
-        paths_to_try = ["api/admin/token", "admin/token", "token"]
+        paths_to_try = AUTH_PATHS
+        if self.token_path in AUTH_PATHS:
+            paths_to_try = [self.token_path] + [p for p in AUTH_PATHS if p != self.token_path]
         
         for path in paths_to_try:
-            print(f"Попытка аутентификации, используя путь '{path}'...")
+            logger.debug(f"Попытка аутентификации, используя путь '{path}'...")
             response = await self._post(path, data=data, is_form_data=True)
             
             if response and "access_token" in response:
                 self.auth_token = response["access_token"]
-                print(f"Marzban: Аутентификация успешна (использован путь '{path}').")
+                self.token_expires_at = decode_token_expiry(self.auth_token)
+                self.token_path = path
+                self._save_token_state()
+                logger.info(f"Marzban {self.name}: Аутентификация успешна (использован путь '{path}').")
                 return True
         
-        print("Marzban: Аутентификация не удалась. Проверьте логин/пароль/URL.")
+        self.auth_token = None
+        self.token_expires_at = None
+        logger.error(f"Marzban {self.name}: Аутентификация не удалась. Проверьте логин/пароль/URL.")
         return False
 
-    async def get_user_info(self, username: str) -> Optional[Dict[str, Any]]:
-        if not self.auth_token and not await self._authenticate():
-             return None
+    def _load_token_state(self):
+        """Восстанавливает токен и рабочий путь аутентификации после рестарта."""
+        if not self.token_state_file or not os.path.exists(self.token_state_file):
+            return
+        try:
+            with open(self.token_state_file, encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Marzban: не удалось прочитать сохранённый токен: {e}")
+            return
+
+        if state.get("base_url") != self.base_url or state.get("username") != self.username:
+            return
+        self.token_path = state.get("token_path")
+        self.auth_token = state.get("access_token")
+        self.token_expires_at = decode_token_expiry(self.auth_token) if self.auth_token else None
+
+    def _save_token_state(self):
+        if not self.token_state_file:
+            return
+        state = {
+            "base_url": self.base_url,
+            "username": self.username,
+            "token_path": self.token_path,
+            "access_token": self.auth_token,
+        }
+        tmp_path = f"{self.token_state_file}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(state, f)
+            os.chmod(tmp_path, 0o600)
+            os.replace(tmp_path, self.token_state_file)
+        except OSError as e:
+            logger.warning(f"Marzban: не удалось сохранить токен: {e}")
+
+    async def get_user_info(self, username: str, fresh: bool = False) -> Optional[Dict[str, Any]]:
+        """Возвращает пользователя из кэша или панели; одинаковые параллельные запросы делят один GET."""
+        if not fresh:
+            cached = self._user_cache.get(username)
+            if cached is not None:
+                return dict(cached)
+
+        inflight = self._user_inflight.get(username)
+        if inflight is not None:
+            self.coalesced_lookups += 1
+        else:
+            inflight = asyncio.ensure_future(self._fetch_user_info(username))
+            self._user_inflight[username] = inflight
+            inflight.add_done_callback(lambda task: self._on_user_fetched(username, task))
+
+        result = await asyncio.shield(inflight)
+        return dict(result) if result else None
+
+    async def _fetch_user_info(self, username: str) -> Optional[Dict[str, Any]]:
         return await self._get(f"api/user/{username}")
 
+    def _on_user_fetched(self, username: str, task: asyncio.Future):
+        # Результат кладём в кэш, только если запись не инвалидировали во время запроса.
+        if self._user_inflight.get(username) is not task:
+            return
+        del self._user_inflight[username]
+        if not task.cancelled() and task.exception() is None and task.result():
+            self._user_cache.set(username, task.result())
+            self._last_known.set(username, task.result())
+
+    def _invalidate_user(self, username: str, fresh_info: Optional[Dict[str, Any]] = None):
+        self._user_inflight.pop(username, None)
+        if fresh_info and fresh_info.get("username") == username:
+            self._user_cache.set(username, fresh_info)
+            self._last_known.set(username, fresh_info)
+        else:
+            self._user_cache.invalidate(username)
+
+    async def get_user_snapshot(self, username: str, fresh: bool = False) -> tuple[Optional[Dict[str, Any]], bool]:
+        """Данные пользователя для экранов статуса и подключения.
+
+        Пока панель нездорова или перегружена, не ставит новые запросы
+        в очередь, а отдаёт последние известные данные. Возвращает (данные, устарели_ли_они).
+        """
+        if self.breaker.is_open or self._inflight_requests >= MARZBAN_MAX_INFLIGHT:
+            if not self.breaker.is_open:
+                self.shed_requests += 1
+            stale = self._last_known.get(username)
+            return (dict(stale) if stale else None), True
+
+        info = await self.get_user_info(username, fresh=fresh)
+        if info is None and self.breaker.state != CircuitBreaker.CLOSED:
+            stale = self._last_known.get(username)
+            if stale:
+                return dict(stale), True
+        return info, False
+
+    def cache_stats(self) -> Dict[str, int]:
+        return {**self._user_cache.stats(), "coalesced": self.coalesced_lookups}
+
+    async def refresh_health(self) -> bool:
+        """Обновляет снимок здоровья нод и нагрузки инбаундов; False — панель не ответила, снимок прежний."""
+        since = self.health.usage_since.strftime("%Y-%m-%dT%H:%M:%S")
+        paths = ["api/inbounds", "api/hosts", "api/nodes", f"api/nodes/usage?{urlencode({'start': since})}", "api/system"]
+        inbounds, hosts, nodes, usage, system = await asyncio.gather(
+            *(self._get(path, breaker=self.health_breaker) for path in paths)
+        )
+        if inbounds is None or nodes is None or usage is None:
+            return False
+        self.health.update(inbounds, hosts, nodes, usage, system)
+        return True
+
     async def create_user(self, telegram_user_id: int, tariff_code: str, user_data: Dict[str, Any]) -> Optional[str]:
-        if not self.auth_token and not await self._authenticate():
-            print("Не удалось создать ключ: Ошибка аутентификации.")
+        if not await self._ensure_token():
+            logger.error("Не удалось создать ключ: Ошибка аутентификации.")
             return None
 
         username = f"tg{telegram_user_id}"
         
         metadata = self.metadata_presets.get(tariff_code)
         if not metadata:
-            print(f"Ошибка: метаданные для тарифа {tariff_code} не найдены.")
+            logger.error(f"Ошибка: метаданные для тарифа {tariff_code} не найдены.")
             return None
 
-        user_info = await self.get_user_info(username)
+        # PUT шлёт абсолютные expire/data_limit: читаем панель, а не кэш, чтобы не затереть чужое продление.
+        user_info = await self.get_user_info(username, fresh=True)
         
         if user_info:
-            print(f"Пользователь '{username}' существует. Обновление (продление) подписки...")
-            updated = await self._update_user(username, metadata, user_info)
-            if updated:
-                if updated.get("subscription_url"):
-                    return updated["subscription_url"]
-                links = updated.get("links", [])
-                for link in links:
-                    if link.get("subscription_url"):
-                        return link["subscription_url"]
-            return None
+            logger.info(f"Пользователь '{username}' существует. Обновление (продление) подписки...")
+            return _subscription_link(await self._update_user(username, metadata, user_info))
         else:
-            print(f"Пользователь '{username}' не существует. Создание нового ключа (POST)...")
+            logger.info(f"Пользователь '{username}' не существует. Создание нового ключа (POST)...")
             return await self._create_new_user(username, metadata)
 
-    async def _create_new_user(self, username: str, metadata: Dict[str, int]) -> Optional[str]:
-        """Создает нового пользователя и возвращает ссылку."""
-        
+    def plan_grant(self, tariff_code: str, current_info: Optional[Dict[str, Any]]) -> Optional[Dict[str, int]]:
+        """Абсолютные expire и data_limit после начисления тарифа поверх current_info.
+
+        Платёжный журнал сохраняет план до обращения к панели, и повторное
+        применение того же плана не начисляет тариф второй раз.
+        """
+        metadata = self.metadata_presets.get(tariff_code)
+        if not metadata:
+            return None
+        return self._plan(metadata, current_info)
+
+    def _plan(self, metadata: Dict[str, int], current_info: Optional[Dict[str, Any]]) -> Dict[str, int]:
         expire_duration_s = metadata.get('expire', 0)
+        current_time_s = int(time.time())
+        if not current_info:
+            return {"expire": current_time_s + expire_duration_s, "data_limit": metadata.get('data_limit')}
+
+        current_expire_raw = current_info.get('expire') or 0
+        current_expire_s = int(current_expire_raw)
+        start_time_s = max(current_expire_s, current_time_s)
+
+        future_expire_s = start_time_s + expire_duration_s
+        logger.debug(
+            "Продление %s: expire %s -> %s (%s, +%s с)",
+            current_info.get("username"), current_expire_raw, future_expire_s,
+            "с текущего момента" if start_time_s == current_time_s else "от даты истечения",
+            expire_duration_s,
+            extra={"current_expire_s": current_expire_s, "start_time_s": start_time_s, "now_s": current_time_s},
+        )
+        return {
+            "expire": future_expire_s,
+            "data_limit": (current_info.get('data_limit') or 0) + metadata.get('data_limit', 0),
+        }
+
+    async def apply_grant(self, telegram_user_id: int, tariff_code: str, grant: Dict[str, int]) -> Optional[str]:
+        """Выставляет пользователю expire/data_limit из плана plan_grant и возвращает ссылку.
+
+        Значения абсолютные, поэтому повтор после сбоя (ответ потерян, запись
+        о применении не сохранилась) оставляет пользователя в том же состоянии.
+        """
+        if not await self._ensure_token():
+            logger.error("Не удалось применить оплату: Ошибка аутентификации.")
+            return None
+
+        username = f"tg{telegram_user_id}"
+        metadata = self.metadata_presets.get(tariff_code)
+        if not metadata:
+            logger.error(f"Ошибка: метаданные для тарифа {tariff_code} не найдены.")
+            return None
+
+        user_info = await self.get_user_info(username, fresh=True)
+        if user_info:
+            return _subscription_link(await self._update_user(username, metadata, user_info, grant))
+        return await self._create_new_user(username, metadata, grant)
+
+    async def _create_new_user(self, username: str, metadata: Dict[str, int], grant: Optional[Dict[str, int]] = None) -> Optional[str]:
+        """Создает нового пользователя и возвращает ссылку."""
         
-        future_expire_s = int(time.time()) + expire_duration_s
+        grant = grant or self._plan(metadata, None)
         
         payload = {
             "username": username,
@@ -174,58 +495,37 @@ class MarzbanAPI:
                 "vless": {"flow": "xtls-rprx-vision"}
             },
             "status": "active",
-            "inbounds": {"vless": ["VLESS TCP REALITY"]}, 
-            "data_limit": metadata.get('data_limit'), 
+            "inbounds": {"vless": self.health.pick()}, 
+            "data_limit": grant["data_limit"], 
             "data_limit_reset_strategy": "day", 
-            "expire": future_expire_s, 
+            "expire": grant["expire"], 
             "note": f"TG ID: {username.lstrip('tg')}",
         }
         
         response = await self._post("api/user", data=payload)
+        self._invalidate_user(username, response)
         
         if response and response.get("subscription_url"):
-            print(f"Marzban: Пользователь '{username}' успешно создан.")
+            logger.info(f"Marzban: Пользователь '{username}' успешно создан.")
             return response["subscription_url"]
         return None
 
-    async def _update_user(self, username: str, metadata: Dict[str, int], current_info: Dict[str, Any]) -> Optional[Dict[str, Any]]:
-  
-        expire_duration_s = metadata.get('expire', 0)
-        current_expire_raw = current_info.get('expire') or 0
-        current_expire_s = int(current_expire_raw)
-        current_time_s = int(time.time())
-        start_time_s = max(current_expire_s, current_time_s)
-
-        print("--- DEBUG: Расчет продления подписки ---")
-        print(f"Текущее время (сек): {current_time_s} ({datetime.fromtimestamp(current_time_s).strftime('%Y-%m-%d %H:%M:%S')})")
-        print(f"Текущий expire (сек) от Marzban (НЕОБРАБОТАННЫЙ): {current_expire_raw}")
-
-        expire_date_str = datetime.fromtimestamp(current_expire_s).strftime('%Y-%m-%d %H:%M:%S') if current_expire_s > 0 else 'Нет данных / Истекла'
-        print(f"Текущий expire (обработанный, сек): {current_expire_s} ({expire_date_str})")
-        print(f"Длительность нового тарифа (сек): {expire_duration_s}")
-        print(f"Время отсчета (start_time_s): {start_time_s} ({datetime.fromtimestamp(start_time_s).strftime('%Y-%m-%d %H:%M:%S')})")
-        print("---------------------------------------")
+    async def _update_user(self, username: str, metadata: Dict[str, int], current_info: Dict[str, Any],
+                           grant: Optional[Dict[str, int]] = None) -> Optional[Dict[str, Any]]:
+        grant = grant or self._plan(metadata, current_info)
 
-        if start_time_s == current_time_s:
-             print("Marzban: Подписка истекла или отсутствовала, начинаем отсчет с текущего момента.")
-        else:
-             print("Marzban: Подписка активна, добавляем время к дате истечения.")
-            
-        future_expire_s = start_time_s + expire_duration_s
-
-        print(f"Новый expire (сек): {future_expire_s} ({datetime.fromtimestamp(future_expire_s).strftime('%Y-%m-%d %H:%M:%S')})")
-
-        new_data_limit = metadata.get('data_limit', 0) 
-        current_data_limit = current_info.get('data_limit', 0) 
-        cumulative_data_limit = current_data_limit + new_data_limit
+        inbounds = current_info.get("inbounds") or {}
+        if "vless" in (current_info.get("proxies") or {}):
+            # Продление — момент увести пользователя с больного или перегруженного инбаунда.
+            inbounds = {**inbounds, "vless": self.health.pick(inbounds)}
         
         payload = {
             "username": username, 
-            "expire": future_expire_s,
-            "data_limit": cumulative_data_limit,
+            "expire": grant["expire"],
+            "data_limit": grant["data_limit"],
             "status": current_info.get("status", "active"), 
             "proxies": current_info.get("proxies", {}), 
-            "inbounds": current_info.get("inbounds", {}),
+            "inbounds": inbounds,
             "data_limit_reset_strategy": current_info.get("data_limit_reset_strategy", "no_reset"),
             "note": current_info.get("note", f"TG ID: {username.lstrip('tg')}"),
         }
@@ -236,18 +536,16 @@ class MarzbanAPI:
                 del current_info[field]
         
         response = await self._put(f"api/user/{username}", data=payload)
+        self._invalidate_user(username, response)
         
         if response:
-            print(f"Marzban: Пользователь '{username}' успешно обновлен.")
+            logger.info(f"Marzban: Пользователь '{username}' успешно обновлен.")
             return response
         return None
     
-    async def disable_user(self, username: str) -> Optional[Dict[str, Any]]:
-        current_info = await self.get_user_info(username)
-        if not current_info: return None
-
+    def _status_payload(self, current_info: Dict[str, Any], status: str) -> Dict[str, Any]:
         payload = {
-            "status": "disabled",
+            "status": status,
             "expire": current_info.get('expire'), 
             "data_limit": current_info.get('data_limit'), 
             "proxies": current_info.get("proxies"), 
@@ -255,27 +553,108 @@ class MarzbanAPI:
             "data_limit_reset_strategy": current_info.get("data_limit_reset_strategy"),
             "note": current_info.get("note"),
         }
-        payload = {k: v for k, v in payload.items() if v is not None and k not in ["id", "data_usage", "links", "subscription_url"]}
+        return {k: v for k, v in payload.items() if v is not None and k not in ["id", "data_usage", "links", "subscription_url"]}
+
+    async def disable_user(self, username: str) -> Optional[Dict[str, Any]]:
+        current_info = await self.get_user_info(username, fresh=True)
+        if not current_info: return None
 
+        payload = self._status_payload(current_info, "disabled")
         response = await self._put(f"api/user/{username}", data=payload)
+        self._invalidate_user(username, response)
         return response
 
     async def enable_user(self, username: str) -> Optional[Dict[str, Any]]:
-        current_info = await self.get_user_info(username)
+        current_info = await self.get_user_info(username, fresh=True)
         if not current_info: return None
 
-        payload = {
-            "status": "active",
-            "expire": current_info.get('expire'), 
-            "data_limit": current_info.get('data_limit'), 
-            "proxies": current_info.get("proxies"), 
-            "inbounds": current_info.get("inbounds"),
-            "data_limit_reset_strategy": current_info.get("data_limit_reset_strategy"),
-            "note": current_info.get("note"),
-        }
-        payload = {k: v for k, v in payload.items() if v is not None and k not in ["id", "data_usage", "links", "subscription_url"]}
-        
+        payload = self._status_payload(current_info, "active")
         response = await self._put(f"api/user/{username}", data=payload)
+        self._invalidate_user(username, response)
         return response
 
-marzban_client = MarzbanAPI()
\ No newline at end of file
+    async def get_users_page(self, usernames: Optional[list[str]] = None, offset: int = 0, limit: int = 100) -> Optional[Dict[str, Any]]:
+        """Одна страница api/users; usernames фильтрует выдачу по конкретным пользователям."""
+        query = [("offset", offset), ("limit", limit)]
+        query += [("username", username) for username in usernames or []]
+        return await self._get(f"api/users?{urlencode(query)}")
+
+    async def bulk_disable_users(self, usernames: Iterable[str] | AsyncIterable[str], concurrency: int = MARZBAN_BULK_CONCURRENCY,
+                                 progress: Optional[Callable[[int], Awaitable[None]]] = None) -> Dict[str, str]:
+        return await self._bulk_set_status(usernames, "disabled", concurrency, progress)
+
+    async def bulk_enable_users(self, usernames: Iterable[str] | AsyncIterable[str], concurrency: int = MARZBAN_BULK_CONCURRENCY,
+                                progress: Optional[Callable[[int], Awaitable[None]]] = None) -> Dict[str, str]:
+        return await self._bulk_set_status(usernames, "active", concurrency, progress)
+
+    async def _bulk_set_status(self, usernames, status: str, concurrency: int,
+                               progress: Optional[Callable[[int], Awaitable[None]]]) -> Dict[str, str]:
+        """Меняет статус множества пользователей потоком: страница api/users -> очередь -> пул PUT.
+
+        Текущие данные берутся из страниц списка, поэтому отдельный GET на
+        пользователя не нужен. Возвращает отчёт {username: результат}, где
+        результат — ok, unchanged, not_found или error.
+        """
+        report: Dict[str, str] = {}
+        queue: asyncio.Queue = asyncio.Queue(maxsize=concurrency * 2)
+
+        async def produce():
+            async for chunk in _chunked(usernames, MARZBAN_BULK_PAGE_SIZE):
+                page = await self.get_users_page(usernames=chunk, limit=len(chunk))
+                if page is None:
+                    for username in chunk:
+                        report[username] = "error"
+                    continue
+                found = {user["username"]: user for user in page.get("users", [])}
+                for username in chunk:
+                    if username not in found:
+                        report[username] = "not_found"
+                    else:
+                        await queue.put(found[username])
+            for _ in range(concurrency):
+                await queue.put(None)
+
+        async def consume():
+            while (current_info := await queue.get()) is not None:
+                username = current_info["username"]
+                if current_info.get("status") == status:
+                    report[username] = "unchanged"
+                else:
+                    payload = self._status_payload(current_info, status)
+                    response = await self._put(f"api/user/{username}", data=payload)
+                    self._invalidate_user(username, response)
+                    report[username] = "ok" if response else "error"
+                if progress:
+                    await progress(len(report))
+
+        await asyncio.gather(produce(), *(consume() for _ in range(concurrency)))
+        return report
+
+
+def _subscription_link(user_info: Optional[Dict[str, Any]]) -> Optional[str]:
+    if not user_info:
+        return None
+    if user_info.get("subscription_url"):
+        return user_info["subscription_url"]
+    for link in user_info.get("links", []):
+        if isinstance(link, dict) and link.get("subscription_url"):
+            return link["subscription_url"]
+    return None
+
+
+async def _chunked(items: Iterable[str] | AsyncIterable[str], size: int) -> AsyncIterator[list[str]]:
+    chunk: list[str] = []
+    if hasattr(items, "__aiter__"):
+        async for item in items:
+            chunk.append(item)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+    else:
+        for item in items:
+            chunk.append(item)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
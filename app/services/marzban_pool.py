@@ -0,0 +1,360 @@
+"""Пул панелей Marzban за одним фасадом marzban_client.
+
+Пользователь tg{id} живёт на одной панели: она записывается в
+subscriptions.panel при выдаче ключа, и все чтения и изменения
+пользователя идут туда. Новых пользователей размещает MARZBAN_PLACEMENT:
+
+- hash — взвешенное rendezvous-хеширование по панелям, открытым для новых
+  пользователей: добавление панели забирает у остальных только свою долю;
+- least_loaded — панель с наименьшим числом пользователей (panel_users)
+  на единицу веса.
+
+Выбранная панель сразу записывается в users.panel (первая запись
+побеждает), поэтому другая реплика или повторное размещение после
+вытеснения из кэша не заведут пользователю второй аккаунт на другой
+панели. Ребалансировка касается только новых пользователей: смена весов или
+accepts_new меняет размещение, уже размещённые остаются на своих панелях.
+Подписки, созданные до пула (panel IS NULL), относятся к панели по
+умолчанию — первой в MARZBAN_PANELS. Панель, у которой по свежему снимку
+здоровья (panel_health) не осталось здоровых инбаундов, новых не получает.
+"""
+import asyncio
+import hashlib
+import logging
+import math
+import os
+import time
+from typing import Any, AsyncIterable, Awaitable, Callable, Dict, Iterable, Optional
+from sqlalchemy import bindparam, func, or_, select, update
+from app.db.database import get_db_session
+from app.db.models import PanelUser, Subscription, User
+from app.services.cache import TTLCache
+from app.services.marzban_api import MarzbanAPI, _chunked
+from config import (
+    MARZBAN_PANELS, MARZBAN_PLACEMENT, MARZBAN_PANEL_LOAD_TTL, MARZBAN_USERNAME, MARZBAN_PASSWORD,
+    MARZBAN_TOKEN_STATE_FILE, MARZBAN_USER_CACHE_SIZE, MARZBAN_STALE_TTL, MARZBAN_BULK_CONCURRENCY,
+    MARZBAN_BULK_PAGE_SIZE, MARZBAN_HEALTH_INTERVAL,
+)
+from app.services.logging_setup import new_request_id
+
+logger = logging.getLogger(__name__)
+
+PLACEMENTS = ("hash", "least_loaded")
+
+
+def user_id_of(username: str) -> Optional[int]:
+    tg_id = username.removeprefix("tg")
+    return int(tg_id) if username.startswith("tg") and tg_id.isdigit() else None
+
+
+class MarzbanPool:
+    def __init__(self, panels: list[MarzbanAPI], weights: Optional[Dict[str, float]] = None,
+                 accepting: Optional[Iterable[str]] = None, placement: str = "hash"):
+        if placement not in PLACEMENTS:
+            raise ValueError(f"Неизвестный MARZBAN_PLACEMENT '{placement}', ожидается один из: {', '.join(PLACEMENTS)}")
+        self.panels: Dict[str, MarzbanAPI] = {panel.name: panel for panel in panels}
+        self.default = panels[0].name
+        self.weights = {name: (weights or {}).get(name, 1.0) for name in self.panels}
+        self.accepting = [name for name in self.panels if accepting is None or name in set(accepting)]
+        if not self.accepting:
+            raise ValueError("Ни одна панель Marzban не принимает новых пользователей (accepts_new).")
+        self.placement = placement
+        # Размещение не меняется, пока жива подписка, поэтому кэш живёт долго.
+        self._assigned = TTLCache(maxsize=MARZBAN_USER_CACHE_SIZE, ttl=MARZBAN_STALE_TTL)
+        self._loads: Optional[Dict[str, int]] = None
+        self._loads_at = 0.0
+        self._loads_lock = asyncio.Lock()
+
+    async def initialize(self):
+        await asyncio.gather(*(panel.initialize() for panel in self.panels.values()))
+
+    async def close(self):
+        await asyncio.gather(*(panel.close() for panel in self.panels.values()))
+
+    @property
+    def metadata_presets(self) -> Dict[str, Dict[str, int]]:
+        return self.panels[self.default].metadata_presets
+
+    def plan_grant(self, tariff_code: str, current_info: Optional[Dict[str, Any]]) -> Optional[Dict[str, int]]:
+        return self.panels[self.default].plan_grant(tariff_code, current_info)
+
+    # Размещение
+
+    async def panel_for(self, user_id: int) -> str:
+        """Имя панели пользователя: из кэша, из его подписок или размещение нового."""
+        return (await self.panels_for([user_id]))[user_id]
+
+    async def panels_for(self, user_ids: Iterable[int]) -> Dict[int, str]:
+        user_ids = list(dict.fromkeys(user_ids))
+        if len(self.panels) == 1:
+            return {user_id: self.default for user_id in user_ids}
+
+        result: Dict[int, str] = {}
+        missing = []
+        for user_id in user_ids:
+            panel = self._assigned.get(user_id)
+            if panel is None:
+                missing.append(user_id)
+            else:
+                result[user_id] = panel
+
+        if missing:
+            async with await get_db_session() as session:
+                rows = await session.execute(
+                    select(Subscription.user_id, Subscription.panel)
+                    .where(
+                        Subscription.user_id.in_(missing),
+                        # Неоплаченный инвойс без панели — не ключ до пула, а ещё не размещённый пользователь.
+                        or_(Subscription.panel.is_not(None), Subscription.invoice_id.is_(None), Subscription.is_paid == True),
+                    )
+                    .order_by(Subscription.user_id, Subscription.panel.is_(None), Subscription.id.desc())
+                    .distinct(Subscription.user_id)
+                )
+                stored = dict(rows.all())
+                unsubscribed = [user_id for user_id in missing if user_id not in stored]
+                if unsubscribed:
+                    rows = await session.execute(
+                        select(User.id, User.panel).where(User.id.in_(unsubscribed), User.panel.is_not(None))
+                    )
+                    stored.update(rows.all())
+            for user_id, panel in stored.items():
+                if panel is not None and panel not in self.panels:
+                    logger.error(f"Панель {panel} пользователя {user_id} убрана из MARZBAN_PANELS, используем {self.default}.")
+                    panel = None
+                result[user_id] = panel or self.default
+                self._assigned.set(user_id, result[user_id])
+
+            new_users = [user_id for user_id in missing if user_id not in stored]
+            placed = await self._save_placement(await self._place(new_users))
+            for user_id, panel in placed.items():
+                result[user_id] = panel
+                self._assigned.set(user_id, panel)
+        return result
+
+    async def _save_placement(self, placed: Dict[int, str]) -> Dict[int, str]:
+        """Записывает размещение в users.panel и возвращает действующее.
+
+        Если другая реплика успела разместить пользователя раньше, её запись
+        остаётся, и возвращается её панель. Пользователь без строки в users
+        подписки иметь не может, и его размещение не сохраняется.
+        """
+        if not placed:
+            return placed
+        async with await get_db_session() as session:
+            # По возрастанию id, чтобы встречные пачки реплик не взаимоблокировались.
+            await session.execute(
+                update(User.__table__)
+                .where(User.id == bindparam("b_id"), User.panel.is_(None))
+                .values(panel=bindparam("b_panel")),
+                [{"b_id": user_id, "b_panel": panel} for user_id, panel in sorted(placed.items())],
+            )
+            rows = await session.execute(
+                select(User.id, User.panel).where(User.id.in_(list(placed)), User.panel.is_not(None))
+            )
+            saved = dict(rows.all())
+            await session.commit()
+        return {user_id: saved[user_id] if saved.get(user_id) in self.panels else panel for user_id, panel in placed.items()}
+
+    def _candidates(self) -> list[str]:
+        return [name for name in self.accepting if self.panels[name].health.accepts_new] or self.accepting
+
+    async def _place(self, user_ids: list[int]) -> Dict[int, str]:
+        if not user_ids:
+            return {}
+        if self.placement == "hash":
+            return {user_id: self._rendezvous(user_id) for user_id in user_ids}
+
+        loads = await self._panel_loads()
+        candidates = self._candidates()
+        placed = {}
+        for user_id in user_ids:
+            panel = min(candidates, key=lambda name: loads[name] / self.weights[name])
+            # Учитываем размещённых до следующего пересчёта, чтобы всплеск не ушёл на одну панель.
+            loads[panel] += 1
+            placed[user_id] = panel
+        return placed
+
+    def _rendezvous(self, user_id: int) -> str:
+        def score(name: str) -> float:
+            digest = hashlib.blake2b(f"{name}:{user_id}".encode(), digest_size=8).digest()
+            u = (int.from_bytes(digest, "big") + 0.5) / 2 ** 64
+            return self.weights[name] / -math.log(u)
+
+        return max(self._candidates(), key=score)
+
+    async def _panel_loads(self) -> Dict[str, int]:
+        """Число пользователей на панелях по panel_users; пересчитывается раз в MARZBAN_PANEL_LOAD_TTL."""
+        async with self._loads_lock:
+            if self._loads is None or time.monotonic() - self._loads_at >= MARZBAN_PANEL_LOAD_TTL:
+                async with await get_db_session() as session:
+                    rows = await session.execute(select(PanelUser.panel, func.count()).group_by(PanelUser.panel))
+                loads = {name: 0 for name in self.panels}
+                for panel, count in rows.all():
+                    panel = panel or self.default
+                    if panel in loads:
+                        loads[panel] += count
+                self._loads, self._loads_at = loads, time.monotonic()
+            return self._loads
+
+    async def panel_of(self, username: str) -> str:
+        user_id = user_id_of(username)
+        return self.default if user_id is None else await self.panel_for(user_id)
+
+    async def _client(self, username: str) -> MarzbanAPI:
+        return self.panels[await self.panel_of(username)]
+
+    async def _group(self, usernames: Iterable[str]) -> Dict[str, list[str]]:
+        usernames = list(usernames)
+        if len(self.panels) == 1:
+            return {self.default: usernames}
+        panels = await self.panels_for(user_id for username in usernames if (user_id := user_id_of(username)) is not None)
+        groups: Dict[str, list[str]] = {}
+        for username in usernames:
+            user_id = user_id_of(username)
+            groups.setdefault(panels[user_id] if user_id is not None else self.default, []).append(username)
+        return groups
+
+    # Операции над пользователем идут на его панель
+
+    async def get_user_info(self, username: str, fresh: bool = False) -> Optional[Dict[str, Any]]:
+        return await (await self._client(username)).get_user_info(username, fresh=fresh)
+
+    async def get_user_snapshot(self, username: str, fresh: bool = False) -> tuple[Optional[Dict[str, Any]], bool]:
+        return await (await self._client(username)).get_user_snapshot(username, fresh=fresh)
+
+    async def create_user(self, telegram_user_id: int, tariff_code: str, user_data: Dict[str, Any]) -> Optional[str]:
+        panel = self.panels[await self.panel_for(telegram_user_id)]
+        return await panel.create_user(telegram_user_id, tariff_code, user_data)
+
+    async def apply_grant(self, telegram_user_id: int, tariff_code: str, grant: Dict[str, int]) -> Optional[str]:
+        panel = self.panels[await self.panel_for(telegram_user_id)]
+        return await panel.apply_grant(telegram_user_id, tariff_code, grant)
+
+    async def disable_user(self, username: str) -> Optional[Dict[str, Any]]:
+        return await (await self._client(username)).disable_user(username)
+
+    async def enable_user(self, username: str) -> Optional[Dict[str, Any]]:
+        return await (await self._client(username)).enable_user(username)
+
+    async def get_users_page(self, usernames: Optional[list[str]] = None, offset: int = 0, limit: int = 100) -> Optional[Dict[str, Any]]:
+        """Страница api/users по конкретным пользователям: запросы расходятся по их панелям.
+
+        None, если недоступна хотя бы одна из нужных панелей. Полный список
+        без usernames читается по каждой панели из panels.
+        """
+        if usernames is None:
+            if len(self.panels) > 1:
+                raise ValueError("Без usernames страницы api/users читаются по каждой панели из panels.")
+            return await self.panels[self.default].get_users_page(offset=offset, limit=limit)
+
+        groups = await self._group(usernames)
+        pages = await asyncio.gather(*(
+            self.panels[name].get_users_page(usernames=group, limit=len(group)) for name, group in groups.items()
+        ))
+        if any(page is None for page in pages):
+            return None
+        users = [user for page in pages for user in page.get("users", [])]
+        return {"users": users, "total": len(users)}
+
+    async def bulk_disable_users(self, usernames: Iterable[str] | AsyncIterable[str], concurrency: int = MARZBAN_BULK_CONCURRENCY,
+                                 progress: Optional[Callable[[int], Awaitable[None]]] = None) -> Dict[str, str]:
+        return await self._bulk(usernames, False, concurrency, progress)
+
+    async def bulk_enable_users(self, usernames: Iterable[str] | AsyncIterable[str], concurrency: int = MARZBAN_BULK_CONCURRENCY,
+                                progress: Optional[Callable[[int], Awaitable[None]]] = None) -> Dict[str, str]:
+        return await self._bulk(usernames, True, concurrency, progress)
+
+    async def _bulk(self, usernames, enable: bool, concurrency: int,
+                    progress: Optional[Callable[[int], Awaitable[None]]]) -> Dict[str, str]:
+        """Разводит поток имён по очередям панелей; каждая панель обрабатывает свою с concurrency PUT."""
+        if len(self.panels) == 1:
+            panel = self.panels[self.default]
+            bulk = panel.bulk_enable_users if enable else panel.bulk_disable_users
+            return await bulk(usernames, concurrency=concurrency, progress=progress)
+
+        queues = {name: asyncio.Queue(maxsize=MARZBAN_BULK_PAGE_SIZE) for name in self.panels}
+        done = {name: 0 for name in self.panels}
+
+        async def route():
+            async for chunk in _chunked(usernames, MARZBAN_BULK_PAGE_SIZE):
+                for name, group in (await self._group(chunk)).items():
+                    for username in group:
+                        await queues[name].put(username)
+            for queue in queues.values():
+                await queue.put(None)
+
+        async def drain(queue: asyncio.Queue):
+            while (username := await queue.get()) is not None:
+                yield username
+
+        async def run(name: str) -> Dict[str, str]:
+            async def panel_progress(count: int):
+                done[name] = count
+                if progress:
+                    await progress(sum(done.values()))
+
+            panel = self.panels[name]
+            bulk = panel.bulk_enable_users if enable else panel.bulk_disable_users
+            return await bulk(drain(queues[name]), concurrency=concurrency, progress=panel_progress)
+
+        _, *reports = await asyncio.gather(route(), *(run(name) for name in self.panels))
+        return {username: result for report in reports for username, result in report.items()}
+
+    def cache_stats(self) -> Dict[str, Dict[str, int]]:
+        return {name: panel.cache_stats() for name, panel in self.panels.items()}
+
+    def transport_stats(self) -> Dict[str, Dict[str, Any]]:
+        return {name: panel.transport_stats() for name, panel in self.panels.items()}
+
+    # Снимок здоровья нод и инбаундов
+
+    def health_snapshot(self) -> Dict[str, Dict[str, Any]]:
+        return {name: panel.health.snapshot() for name, panel in self.panels.items()}
+
+    async def refresh_health(self) -> Dict[str, bool]:
+        results = await asyncio.gather(*(panel.refresh_health() for panel in self.panels.values()))
+        return dict(zip(self.panels, results))
+
+    async def run_health_refresh(self):
+        """Фоновое обновление снимка на каждой реплике: он живёт в памяти процесса."""
+        while True:
+            new_request_id("panel-health")
+            try:
+                failed = [name for name, ok in (await self.refresh_health()).items() if not ok]
+                if failed:
+                    logger.warning(f"Снимок здоровья не обновлён для панелей: {', '.join(failed)}.")
+            except Exception as e:
+                logger.exception(f"Ошибка обновления снимка здоровья панелей: {e}")
+            await asyncio.sleep(MARZBAN_HEALTH_INTERVAL)
+
+
+def _token_state_file(name: str) -> str:
+    """Свой файл токена на панель: .marzban_token.json -> .marzban_token.de1.json."""
+    if not MARZBAN_TOKEN_STATE_FILE:
+        return ""
+    root, ext = os.path.splitext(MARZBAN_TOKEN_STATE_FILE)
+    return f"{root}.{name}{ext}"
+
+
+def build_pool() -> MarzbanPool:
+    if not MARZBAN_PANELS:
+        return MarzbanPool([MarzbanAPI()], placement=MARZBAN_PLACEMENT)
+
+    panels, weights, accepting = [], {}, []
+    for spec in MARZBAN_PANELS:
+        name = spec["name"]
+        panels.append(MarzbanAPI(
+            name=name,
+            base_urls=spec.get("urls") or [spec["url"]],
+            username=spec.get("username", MARZBAN_USERNAME),
+            password=spec.get("password", MARZBAN_PASSWORD),
+            token_state_file=_token_state_file(name),
+            inbound_nodes=spec.get("inbound_nodes"),
+        ))
+        weights[name] = float(spec.get("weight", 1))
+        if spec.get("accepts_new", True):
+            accepting.append(name)
+    return MarzbanPool(panels, weights, accepting, MARZBAN_PLACEMENT)
+
+
+marzban_client = build_pool()
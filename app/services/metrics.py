@@ -0,0 +1,164 @@
+"""Минимальные метрики в текстовом формате Prometheus без внешних зависимостей.
+
+Корзины гистограмм выделяются один раз при создании дочерней серии,
+observe() лишь увеличивает счётчики, а вся сборка текста происходит при
+скрейпе /metrics.
+"""
+from bisect import bisect_left
+from typing import Callable, Iterable
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry: list = []
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class _HistogramSeries:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: dict[tuple, _HistogramSeries] = {}
+        _registry.append(self)
+
+    def labels(self, *values) -> _HistogramSeries:
+        series = self._series.get(values)
+        if series is None:
+            series = self._series[values] = _HistogramSeries(self.buckets)
+        return series
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for values, series in list(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series.counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, values, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, values, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {series.count}")
+            labels = _format_labels(self.labelnames, values)
+            lines.append(f"{self.name}_sum{labels} {series.sum}")
+            lines.append(f"{self.name}_count{labels} {series.count}")
+        return lines
+
+
+class _CounterSeries:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._series: dict[tuple, _CounterSeries] = {}
+        _registry.append(self)
+
+    def labels(self, *values) -> _CounterSeries:
+        series = self._series.get(values)
+        if series is None:
+            series = self._series[values] = _CounterSeries()
+        return series
+
+    def inc(self, amount: float = 1.0):
+        self.labels().inc(amount)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for values, series in list(self._series.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, values)} {series.value}")
+        return lines
+
+
+class Gauge:
+    """Значение задаётся через set()/inc()/dec() или вычисляется функцией при скрейпе."""
+
+    def __init__(self, name: str, documentation: str, function: Callable[[], float] | None = None):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self.value = 0.0
+        _registry.append(self)
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        self.value -= amount
+
+    def render(self) -> list[str]:
+        value = self.function() if self.function else self.value
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+
+def render_metrics() -> str:
+    lines: list[str] = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+HANDLER_LATENCY = Histogram(
+    "bot_handler_duration_seconds", "Время обработки апдейта хендлером aiogram.", ["handler"],
+)
+UPDATES_IN_FLIGHT = Gauge(
+    "bot_updates_in_flight", "Апдейты, принятые диспетчером и ещё не обработанные.",
+)
+MARZBAN_REQUEST_LATENCY = Histogram(
+    "marzban_request_duration_seconds", "Длительность MarzbanAPI._request с повторами.", ["panel", "method", "path"],
+)
+MARZBAN_REQUEST_ERRORS = Counter(
+    "marzban_request_errors_total", "Неуспешные запросы к Marzban по типу ошибки.", ["panel", "method", "path", "kind"],
+)
+CRYPTO_SWEEP_DURATION = Histogram(
+    "crypto_payments_sweep_duration_seconds", "Длительность прохода check_crypto_payments.",
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0),
+)
+CRYPTO_PENDING_INVOICES = Gauge(
+    "crypto_pending_invoices", "Неоплаченные крипто-инвойсы на последнем проходе.",
+)
+BROADCAST_MESSAGES = Counter(
+    "broadcast_messages_total", "Сообщения рассылок по результату отправки.", ["result"],
+)
+REMINDERS_SENT = Counter(
+    "reminders_sent_total", "Напоминания об окончании подписки и трафика по виду и результату.", ["kind", "result"],
+)
@@ -0,0 +1,228 @@
+"""Очередь фоновых заданий в Postgres (transactional outbox).
+
+Задание пишется enqueue() в транзакции, породившей его, и выполняется
+пулом воркеров вне обработчиков апдейтов. Забор через FOR UPDATE SKIP
+LOCKED позволяет делить очередь между воркерами и экземплярами бота;
+упавший воркер просто не продлевает аренду, и задание снова становится
+доступным после OUTBOX_LEASE_S.
+"""
+import asyncio
+import logging
+import random
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict
+from aiogram import Bot
+from sqlalchemy import delete, select, update
+from app.db.database import get_db_session
+from app.db.models import OutboxJob
+from app.services.logging_setup import new_request_id
+from config import (
+    OUTBOX_WORKERS, OUTBOX_POLL_INTERVAL, OUTBOX_LEASE_S, OUTBOX_MAX_ATTEMPTS, OUTBOX_MAX_POSTPONES,
+    OUTBOX_BACKOFF_BASE_S, OUTBOX_BACKOFF_MAX_S, OUTBOX_BACKOFF_JITTER, OUTBOX_RETENTION_DAYS,
+)
+
+logger = logging.getLogger(__name__)
+
+JobHandler = Callable[[Bot, OutboxJob], Awaitable[None]]
+_HANDLERS: Dict[str, JobHandler] = {}
+_wakeup = asyncio.Event()
+
+
+class RetryLater(Exception):
+    """Задание не выполнено, но и не сломано: повторить без трейсбека в логе.
+
+    С delay_s задание ждёт чужой работы, а не восстанавливается после сбоя:
+    оно повторяется через delay_s и не расходует попытку, но после
+    OUTBOX_MAX_POSTPONES таких откладываний уходит в dead-letter.
+    """
+
+    def __init__(self, reason: str = "retry", delay_s: float | None = None):
+        super().__init__(reason)
+        self.delay_s = delay_s
+
+
+def outbox_handler(kind: str):
+    """Регистрирует обработчик заданий вида kind. Исключение означает повтор."""
+    def register(handler: JobHandler) -> JobHandler:
+        _HANDLERS[kind] = handler
+        return handler
+    return register
+
+
+async def enqueue(session, kind: str, payload: Dict[str, Any], delay_s: float = 0) -> OutboxJob:
+    """Добавляет задание в текущую транзакцию; видно воркерам после её коммита."""
+    now = datetime.utcnow()
+    job = OutboxJob(kind=kind, payload=payload, status="pending", attempts=0,
+                    available_at=now + timedelta(seconds=delay_s), created_at=now)
+    session.add(job)
+    return job
+
+
+def wake_workers():
+    """Будит воркеры этого процесса сразу после коммита нового задания."""
+    _wakeup.set()
+
+
+async def _claim() -> OutboxJob | None:
+    now = datetime.utcnow()
+    ready = (
+        select(OutboxJob.id)
+        .where(OutboxJob.status == "pending", OutboxJob.available_at <= now)
+        .order_by(OutboxJob.available_at)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+    )
+    async with await get_db_session() as session:
+        job = await session.scalar(
+            update(OutboxJob)
+            .where(OutboxJob.id.in_(ready))
+            .values(available_at=now + timedelta(seconds=OUTBOX_LEASE_S), attempts=OutboxJob.attempts + 1)
+            .returning(OutboxJob)
+        )
+        await session.commit()
+        return job
+
+
+async def _complete(job: OutboxJob):
+    async with await get_db_session() as session:
+        await session.execute(
+            update(OutboxJob).where(OutboxJob.id == job.id)
+            .values(status="done", finished_at=datetime.utcnow(), last_error=None)
+        )
+        await session.commit()
+
+
+async def _postpone(job: OutboxJob, reason: str, delay_s: float):
+    if job.postpones >= OUTBOX_MAX_POSTPONES:
+        await _bury(job, f"{reason} (отложено {job.postpones} раз)")
+        return
+    async with await get_db_session() as session:
+        await session.execute(
+            update(OutboxJob).where(OutboxJob.id == job.id).values(
+                available_at=datetime.utcnow() + timedelta(seconds=delay_s),
+                attempts=OutboxJob.attempts - 1,
+                postpones=OutboxJob.postpones + 1,
+                last_error=reason,
+            )
+        )
+        await session.commit()
+
+
+async def _bury(job: OutboxJob, error: str):
+    logger.error(f"☠️ Задание outbox {job.id} ({job.kind}) в dead-letter после {job.attempts} попыток "
+                 f"и {job.postpones} откладываний: {error}", extra={"job_id": job.id})
+    async with await get_db_session() as session:
+        await session.execute(
+            update(OutboxJob).where(OutboxJob.id == job.id)
+            .values(status="dead", finished_at=datetime.utcnow(), last_error=error[:2000])
+        )
+        await session.commit()
+
+
+def _retry_delay(attempts: int) -> float:
+    """Задержка перед повтором задания после attempts неудачных попыток, секунды.
+
+    Экспонента от OUTBOX_BACKOFF_BASE_S до OUTBOX_BACKOFF_MAX_S, случайна
+    только доля OUTBOX_BACKOFF_JITTER: в отличие от полного джиттера
+    запросов к панели, задержка не схлопывается к нулю и растёт с попытками.
+    """
+    delay_s = min(OUTBOX_BACKOFF_MAX_S, OUTBOX_BACKOFF_BASE_S * 2 ** max(attempts - 1, 0))
+    return delay_s * (1 - OUTBOX_BACKOFF_JITTER * random.random())
+
+
+async def _fail(job: OutboxJob, error: str):
+    if job.attempts >= OUTBOX_MAX_ATTEMPTS:
+        await _bury(job, error)
+        return
+    delay_s = _retry_delay(job.attempts)
+    logger.warning(f"Задание outbox {job.id} ({job.kind}) повторим через {delay_s:.0f} с: {error}",
+                   extra={"job_id": job.id})
+    async with await get_db_session() as session:
+        await session.execute(
+            update(OutboxJob).where(OutboxJob.id == job.id).values(
+                available_at=datetime.utcnow() + timedelta(seconds=delay_s), last_error=error[:2000],
+            )
+        )
+        await session.commit()
+
+
+async def run_one(bot: Bot) -> bool:
+    """Забирает и выполняет одно задание; False — готовых заданий нет."""
+    job = await _claim()
+    if job is None:
+        return False
+
+    new_request_id(f"job{job.id}")
+    handler = _HANDLERS.get(job.kind)
+    try:
+        if handler is None:
+            raise RuntimeError(f"нет обработчика для {job.kind}")
+        await handler(bot, job)
+    except RetryLater as e:
+        if e.delay_s is not None:
+            await _postpone(job, str(e), e.delay_s)
+        else:
+            await _fail(job, str(e))
+    except Exception as e:
+        logger.exception(f"Ошибка задания outbox {job.id} ({job.kind}): {e}")
+        await _fail(job, f"{type(e).__name__}: {e}")
+    else:
+        await _complete(job)
+    return True
+
+
+async def _worker(bot: Bot):
+    while True:
+        try:
+            if await run_one(bot):
+                continue
+        except Exception as e:
+            logger.exception(f"Ошибка воркера outbox: {e}")
+        _wakeup.clear()
+        try:
+            await asyncio.wait_for(_wakeup.wait(), OUTBOX_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def purge_finished(retention_days: int = OUTBOX_RETENTION_DAYS) -> int:
+    async with await get_db_session() as session:
+        result = await session.execute(
+            delete(OutboxJob).where(
+                OutboxJob.status == "done",
+                OutboxJob.finished_at < datetime.utcnow() - timedelta(days=retention_days),
+            )
+        )
+        await session.commit()
+        return result.rowcount
+
+
+async def requeue_dead(kind: str | None = None) -> int:
+    """Возвращает задания из dead-letter в очередь с обнулёнными счётчиками попыток и откладываний."""
+    query = update(OutboxJob).where(OutboxJob.status == "dead")
+    if kind:
+        query = query.where(OutboxJob.kind == kind)
+    async with await get_db_session() as session:
+        result = await session.execute(
+            query.values(status="pending", attempts=0, postpones=0, available_at=datetime.utcnow(), finished_at=None)
+        )
+        await session.commit()
+    wake_workers()
+    return result.rowcount
+
+
+async def run_outbox_workers(bot: Bot, workers: int = OUTBOX_WORKERS):
+    """Пул из workers воркеров; каждый держит не больше одного задания одновременно."""
+    tasks = [asyncio.create_task(_worker(bot)) for _ in range(workers)]
+    try:
+        while True:
+            await asyncio.sleep(3600)
+            try:
+                purged = await purge_finished()
+                if purged:
+                    logger.info(f"Outbox: удалено выполненных заданий {purged}.")
+            except Exception as e:
+                logger.exception(f"Ошибка очистки outbox: {e}")
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,150 @@
+"""Снимок здоровья нод и нагрузки инбаундов одной панели Marzban.
+
+Marzban назначает пользователю инбаунды, а не ноды: в подписку попадают
+хосты инбаунда, и трафик идёт через ноды с этими адресами. Поэтому тег
+инбаунда связывается с нодами — по MARZBAN_INBOUND_NODES или по
+совпадению адреса хоста с адресом ноды, иначе это ядро самой панели
+(Master). Инбаунд здоров, пока подключена хотя бы одна его нода, а его
+нагрузка — средняя скорость трафика этих нод (байт/с) по приросту
+api/nodes/usage между обновлениями.
+
+Снимок обновляется в фоне, и выбор инбаунда при создании или продлении
+пользователя не делает запросов к панели. Пока снимка нет или он
+устарел, выдаётся MARZBAN_DEFAULT_INBOUND, как раньше.
+"""
+import logging
+import time
+from datetime import datetime
+from typing import Any, Dict, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+MASTER = "Master"
+HEALTHY_NODE_STATUSES = {"connected"}
+
+
+class InboundState:
+    __slots__ = ("tag", "nodes", "healthy", "load", "pending")
+
+    def __init__(self, tag: str, nodes: list[str], healthy: bool, load: float):
+        self.tag = tag
+        self.nodes = nodes
+        self.healthy = healthy
+        self.load = load
+        # Выдано с последнего обновления: всплеск регистраций не уходит целиком на один инбаунд.
+        self.pending = 0
+
+
+class PanelHealth:
+    def __init__(self, panel: str, protocol: str, default_tag: str, tags: Optional[Iterable[str]] = None,
+                 inbound_nodes: Optional[Dict[str, list[str]]] = None, stale_after: float = 90,
+                 stickiness: float = 1.5):
+        self.panel = panel
+        self.protocol = protocol
+        self.default_tag = default_tag
+        self.tags = set(tags or ())
+        self.inbound_nodes = inbound_nodes or {}
+        self.stale_after = stale_after
+        self.stickiness = stickiness
+        self.inbounds: Dict[str, InboundState] = {}
+        self.nodes: Dict[str, Dict[str, Any]] = {}
+        # Оценка трафика одного активного пользователя, байт/с: цена выдачи инбаунда до следующего обновления.
+        self.user_rate = 1.0
+        self.updated_at: Optional[float] = None
+        # Счётчики api/nodes/usage накопительные с этого момента, скорость — по их приросту.
+        self.usage_since = datetime.utcnow().replace(microsecond=0)
+        self._usage: Dict[str, tuple[float, int]] = {}
+
+    @property
+    def fresh(self) -> bool:
+        return self.updated_at is not None and time.monotonic() - self.updated_at < self.stale_after
+
+    @property
+    def accepts_new(self) -> bool:
+        """Есть ли куда поселить нового пользователя; без свежего снимка считаем, что есть."""
+        return not self.fresh or any(state.healthy for state in self.inbounds.values())
+
+    def update(self, inbounds: Dict[str, list], hosts: Optional[Dict[str, list]], nodes: list,
+               usage: Dict[str, Any], system: Optional[Dict[str, Any]], now: Optional[float] = None):
+        """Пересобирает снимок из ответов api/inbounds, api/hosts, api/nodes, api/nodes/usage и api/system."""
+        now = time.monotonic() if now is None else now
+        states = {MASTER: {"status": "connected", "address": None, "message": None}}
+        for node in nodes:
+            states[node["name"]] = {
+                "status": node.get("status"), "address": node.get("address"), "message": node.get("message"),
+            }
+        for record in usage.get("usages", []):
+            name = MASTER if record.get("node_id") is None else record.get("node_name")
+            if name not in states:
+                continue
+            total = (record.get("uplink") or 0) + (record.get("downlink") or 0)
+            previous = self._usage.get(name)
+            if previous and now > previous[0] and total >= previous[1]:
+                states[name]["load"] = (total - previous[1]) / (now - previous[0])
+            self._usage[name] = (now, total)
+        for name, state in states.items():
+            state.setdefault("load", self.nodes.get(name, {}).get("load", 0.0))
+
+        by_address = {state["address"]: name for name, state in states.items() if state["address"]}
+        snapshot: Dict[str, InboundState] = {}
+        for inbound in inbounds.get(self.protocol, []):
+            tag = inbound["tag"]
+            if self.tags and tag not in self.tags:
+                continue
+            names = self.inbound_nodes.get(tag) or [
+                by_address[host["address"]] for host in (hosts or {}).get(tag, []) if host.get("address") in by_address
+            ] or [MASTER]
+            names = [name for name in dict.fromkeys(names) if name in states]
+            up = [name for name in names if states[name]["status"] in HEALTHY_NODE_STATUSES]
+            load = sum(states[name]["load"] for name in up) / len(up) if up else 0.0
+            snapshot[tag] = InboundState(tag, names, bool(up), load)
+
+        for tag, state in snapshot.items():
+            was = self.inbounds.get(tag)
+            if was and was.healthy and not state.healthy:
+                logger.warning(f"Marzban {self.panel}: инбаунд '{tag}' без живых нод ({', '.join(state.nodes) or 'нет нод'}), новых не выдаём.")
+            elif was and not was.healthy and state.healthy:
+                logger.info(f"Marzban {self.panel}: инбаунд '{tag}' снова здоров.")
+
+        total_load = sum(state["load"] for state in states.values())
+        users_active = (system or {}).get("users_active") or 0
+        self.user_rate = max(total_load / max(users_active, 1), 1.0)
+        self.nodes = states
+        self.inbounds = snapshot
+        self.updated_at = now
+
+    def _score(self, state: InboundState) -> float:
+        return state.load + state.pending * self.user_rate
+
+    def pick(self, current: Optional[Dict[str, list[str]]] = None) -> list[str]:
+        """Теги инбаундов протокола для пользователя с инбаундами current (None — новый пользователь).
+
+        Новый получает наименее нагруженный здоровый инбаунд. Продлеваемый
+        остаётся на своих, пока они здоровы и нагружены не сильнее чем в
+        stickiness раз от лучшего: лишняя смена инбаунда меняет ссылки клиента.
+        """
+        current_tags = list((current or {}).get(self.protocol) or [])
+        if not self.fresh:
+            return current_tags or [self.default_tag]
+        healthy = [state for state in self.inbounds.values() if state.healthy]
+        if not healthy:
+            return current_tags or [self.default_tag]
+
+        best = min(healthy, key=self._score)
+        if current_tags:
+            states = [self.inbounds.get(tag) for tag in current_tags]
+            if all(state is not None and state.healthy for state in states) \
+                    and max(map(self._score, states)) <= self._score(best) * self.stickiness + self.user_rate:
+                return current_tags
+        best.pending += 1
+        return [best.tag]
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "fresh": self.fresh,
+            "age_s": None if self.updated_at is None else round(time.monotonic() - self.updated_at, 1),
+            "nodes": {name: {"status": state["status"], "load": state["load"], "message": state["message"]}
+                      for name, state in self.nodes.items()},
+            "inbounds": {tag: {"nodes": state.nodes, "healthy": state.healthy, "load": state.load,
+                               "pending": state.pending} for tag, state in self.inbounds.items()},
+        }
@@ -0,0 +1,174 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Any, Dict, Optional
+from sqlalchemy import exists, or_, select, update
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from app.db.database import get_db_session
+from app.db.models import PanelUser, Subscription
+from app.services.marzban_pool import marzban_client
+from app.services.logging_setup import new_request_id
+from app.services.traffic_history import record_usage_deltas
+from config import PANEL_SYNC_INTERVAL, PANEL_SYNC_PAGE_SIZE
+
+logger = logging.getLogger(__name__)
+
+_SYNCED_FIELDS = ("user_id", "status", "expire", "data_limit", "used_traffic", "subscription_url", "panel")
+
+
+def _panel_row(info: Dict[str, Any], panel: str) -> Dict[str, Any]:
+    username = info["username"]
+    tg_id = username.removeprefix("tg")
+    return {
+        "username": username,
+        "user_id": int(tg_id) if username.startswith("tg") and tg_id.isdigit() else None,
+        "status": info.get("status") or "unknown",
+        "expire": int(info.get("expire") or 0),
+        "data_limit": int(info.get("data_limit") or 0),
+        "used_traffic": int(info.get("used_traffic") or info.get("data_usage") or 0),
+        "subscription_url": info.get("subscription_url") or info.get("link"),
+        "panel": panel,
+        "synced_at": datetime.utcnow(),
+    }
+
+
+def _row_view(row: PanelUser) -> Dict[str, Any]:
+    """Строка panel_users в том же виде, что и ответ api/user/{username}."""
+    return {
+        "username": row.username,
+        "status": row.status,
+        "expire": row.expire,
+        "data_limit": row.data_limit,
+        "used_traffic": row.used_traffic,
+        "subscription_url": row.subscription_url,
+    }
+
+
+async def _upsert_rows(session, rows: list[Dict[str, Any]]) -> int:
+    """Пишет только изменившиеся строки и приросты трафика; возвращает число изменённых строк.
+
+    Прежние used_traffic читаются под FOR UPDATE, чтобы синхронизация и
+    ручное обновление не записали один и тот же прирост дважды. Приросты
+    пишутся в savepoint: сбой истории трафика не откатывает panel_users.
+    """
+    if not rows:
+        return 0
+    previous = dict((await session.execute(
+        select(PanelUser.username, PanelUser.used_traffic)
+        .where(PanelUser.username.in_([row["username"] for row in rows]))
+        .order_by(PanelUser.username)
+        .with_for_update()
+    )).all())
+    stmt = pg_insert(PanelUser).values(rows)
+    excluded = stmt.excluded
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[PanelUser.username],
+        set_={field: excluded[field] for field in (*_SYNCED_FIELDS, "synced_at")},
+        where=or_(
+            PanelUser.synced_at.is_(None),
+            *(getattr(PanelUser, field).is_distinct_from(excluded[field]) for field in _SYNCED_FIELDS),
+        ),
+    ).returning(PanelUser.username)
+    changed = len((await session.execute(stmt)).all())
+    try:
+        async with session.begin_nested():
+            await record_usage_deltas(session, previous, rows, rows[0]["synced_at"])
+    except DBAPIError as e:
+        logger.error(f"Приросты трафика для {len(rows)} пользователей не записаны: {e}")
+    return changed
+
+
+async def store_panel_user(info: Dict[str, Any], panel: str):
+    async with await get_db_session() as session:
+        await _upsert_rows(session, [_panel_row(info, panel)])
+        await session.commit()
+
+
+async def forget_panel_user(username: str):
+    """Помечает локальную копию устаревшей, чтобы следующий экран взял свежие данные из панели.
+
+    Строка не удаляется: её used_traffic — база прироста для следующей
+    синхронизации, без неё трафик вокруг начисления выпал бы из истории.
+    """
+    async with await get_db_session() as session:
+        await session.execute(update(PanelUser).where(PanelUser.username == username).values(synced_at=None))
+        await session.commit()
+
+
+async def get_user_view(username: str, refresh: bool = False) -> tuple[Optional[Dict[str, Any]], bool]:
+    """Данные для экранов статуса и подключения: (данные, устарели_ли_они).
+
+    Обычно читает panel_users. В панель идёт только для пользователя, которого
+    синхронизация ещё не видела, или при явном обновлении; свежий ответ сразу
+    сохраняется локально. Без единой подписки в БД ключа в панели быть не
+    может, такие пользователи панель не нагружают.
+    """
+    if not refresh:
+        async with await get_db_session() as session:
+            row = await session.get(PanelUser, username)
+            if row is not None and row.synced_at is not None:
+                return _row_view(row), False
+            tg_id = username.removeprefix("tg")
+            if row is None and tg_id.isdigit() and not await session.scalar(
+                select(exists().where(Subscription.user_id == int(tg_id)))
+            ):
+                return None, False
+
+    info, is_stale = await marzban_client.get_user_snapshot(username, fresh=refresh)
+    if info and not is_stale:
+        await store_panel_user(info, await marzban_client.panel_of(username))
+    return info, is_stale
+
+
+async def _sync_panel(name: str, panel, page_size: int, stats: dict) -> bool:
+    """Постранично читает api/users одной панели; False, если панель недоступна."""
+    offset = 0
+    while True:
+        page = await panel.get_users_page(offset=offset, limit=page_size)
+        if page is None:
+            logger.warning(f"Синхронизация panel_users панели {name} прервана на offset={offset}: панель недоступна.")
+            return False
+
+        users = [info for info in page.get("users", []) if info.get("username")]
+        stats["pages"] += 1
+        stats["seen"] += len(users)
+        async with await get_db_session() as session:
+            stats["changed"] += await _upsert_rows(session, [_panel_row(info, name) for info in users])
+            await session.commit()
+
+        offset += page_size
+        if len(page.get("users", [])) < page_size or offset >= page.get("total", offset + 1):
+            return True
+
+
+async def sync_panel_users(page_size: int = PANEL_SYNC_PAGE_SIZE) -> dict:
+    """Один проход: читает api/users каждой панели пула и обновляет изменившиеся строки panel_users.
+
+    Недоступная панель не останавливает остальные; complete — прочитаны все панели.
+    """
+    stats = {"pages": 0, "seen": 0, "changed": 0, "complete": True, "elapsed_s": 0.0}
+    started = time.perf_counter()
+    for name, panel in marzban_client.panels.items():
+        if not await _sync_panel(name, panel, page_size, stats):
+            stats["complete"] = False
+
+    stats["elapsed_s"] = time.perf_counter() - started
+    return stats
+
+
+async def run_panel_sync():
+    while True:
+        new_request_id("panel-sync")
+        try:
+            stats = await sync_panel_users()
+            logger.info(
+                f"Синхронизация panel_users: просмотрено {stats['seen']}, изменено {stats['changed']}, "
+                f"страниц {stats['pages']}, {stats['elapsed_s']:.2f} с.",
+                extra={"sync_stats": stats},
+            )
+        except Exception as e:
+            logger.exception(f"Ошибка синхронизации panel_users: {e}")
+
+        await asyncio.sleep(PANEL_SYNC_INTERVAL)
@@ -0,0 +1,299 @@
+"""Идемпотентное начисление оплат Stars и CryptoPay через журнал payments.
+
+Повторная доставка successful_payment, вебхук вместе с опросом или несколько
+экземпляров бота приходят к одной строке журнала по (provider, charge_id).
+Обращаться к панели может только держатель аренды, а план начисления
+фиксируется до запроса, так что тариф начисляется ровно один раз.
+
+Обработчики апдейтов только заявляют платёж: вместе с новой строкой журнала
+в той же транзакции ставится задание outbox, которое доводит платёж до
+applied в пуле воркеров и повторяется с отступом, пока панель недоступна.
+"""
+import logging
+from datetime import datetime, timedelta
+from typing import Optional
+from aiogram import Bot
+from sqlalchemy import and_, exists, func, or_, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from app.db.database import get_db_session
+from app.db.models import Payment, Subscription
+from app.keyboards.pay_menu import TARIFS
+from app.services.marzban_pool import marzban_client
+from app.services.panel_sync import forget_panel_user
+from app.services.outbox import RetryLater, enqueue, outbox_handler, wake_workers
+from app.services.logging_setup import user_id_var
+from config import PAYMENT_LEASE_S, OUTBOX_BACKOFF_BASE_S, OUTBOX_MAX_ATTEMPTS, OUTBOX_MAX_POSTPONES
+
+logger = logging.getLogger(__name__)
+
+# Результаты apply_payment.
+APPLIED = "applied"                  # начислено этим вызовом
+ALREADY_APPLIED = "already_applied"  # повторная доставка уже применённого платежа
+IN_PROGRESS = "in_progress"          # аренду держит другой обработчик
+DEFERRED = "deferred"                # ждёт незавершённый платёж того же пользователя
+RETRY = "retry"                      # панель недоступна, задание повторится
+FAILED = "failed"
+
+PROVISION_JOB = "provision_payment"
+
+# Пространство ключей advisory-lock на пользователя, не пересекается с MIGRATION_LOCK_KEY.
+_USER_LOCK_BASE = 1 << 40
+
+
+async def claim_payment(provider: str, charge_id: str, user_id: int, tariff_code: str,
+                        amount: int | None = None, currency: str | None = None,
+                        subscription_id: int | None = None) -> tuple[int, bool]:
+    """Заявляет платёж в журнале: (id строки, новая ли она).
+
+    Для новой строки в той же транзакции ставится задание начисления,
+    так что заявленный платёж не может остаться без исполнителя.
+    """
+    async with await get_db_session() as session:
+        stmt = pg_insert(Payment).values(
+            provider=provider, charge_id=str(charge_id), user_id=user_id, tariff_code=tariff_code,
+            amount=amount, currency=currency, subscription_id=subscription_id,
+            status="claimed", attempts=0, created_at=datetime.utcnow(),
+        )
+        payment_id = await session.scalar(
+            stmt.on_conflict_do_nothing(index_elements=["provider", "charge_id"]).returning(Payment.id)
+        )
+        created = payment_id is not None
+        if created:
+            await enqueue(session, PROVISION_JOB, {"payment_id": payment_id, "user_id": user_id})
+        else:
+            payment_id = await session.scalar(
+                select(Payment.id).where(Payment.provider == provider, Payment.charge_id == str(charge_id))
+            )
+        await session.commit()
+    if created:
+        wake_workers()
+    return payment_id, created
+
+
+async def _acquire(payment_id: int) -> tuple[Optional[str], Optional[Payment]]:
+    """Берёт аренду на платёж; без неё возвращает итог, который видит вызывающий."""
+    now = datetime.utcnow()
+    async with await get_db_session() as session:
+        payment = await session.scalar(
+            update(Payment)
+            .where(
+                Payment.id == payment_id,
+                or_(
+                    Payment.status == "claimed",
+                    and_(Payment.status == "provisioning", Payment.lease_until < now),
+                ),
+            )
+            .values(status="provisioning", lease_until=now + timedelta(seconds=PAYMENT_LEASE_S), attempts=Payment.attempts + 1)
+            .returning(Payment)
+        )
+        await session.commit()
+        if payment is not None:
+            return None, payment
+
+        current = await session.get(Payment, payment_id)
+        if current.status == "applied":
+            return ALREADY_APPLIED, current
+        if current.status == "failed":
+            return FAILED, current
+        return IN_PROGRESS, current
+
+
+async def _release(payment_id: int):
+    """Отпускает аренду сразу, чтобы повтор задания не ждал её истечения."""
+    async with await get_db_session() as session:
+        await session.execute(
+            update(Payment).where(Payment.id == payment_id, Payment.status == "provisioning")
+            .values(lease_until=datetime.utcnow())
+        )
+        await session.commit()
+
+
+async def _plan_state(session, payment: Payment) -> tuple[bool, int, list[int]]:
+    """Под advisory-lock пользователя: (ждёт ли он чужой план, сколько его платежей уже с планом,
+    брошенные платежи с планом).
+
+    Ждать стоит только платёж с живой арендой. План с истёкшей арендой
+    брошен: его задание повторится позже или уже в dead-letter, и такой
+    платёж доводится перед построением нового плана.
+    """
+    await session.execute(select(func.pg_advisory_xact_lock(_USER_LOCK_BASE + payment.user_id)))
+    others = (Payment.user_id == payment.user_id, Payment.id != payment.id, Payment.grant_expire.is_not(None))
+    rows = await session.execute(
+        select(Payment.id, Payment.lease_until).where(*others, Payment.status == "provisioning").order_by(Payment.id)
+    )
+    now = datetime.utcnow()
+    unfinished = rows.all()
+    blocked = any(lease_until is not None and lease_until >= now for _, lease_until in unfinished)
+    orphaned = [payment_id for payment_id, lease_until in unfinished if lease_until is None or lease_until < now]
+    planned = await session.scalar(select(func.count()).select_from(Payment).where(*others))
+    return blocked, planned, orphaned
+
+
+async def _defer(session, payment: Payment) -> str:
+    await session.execute(
+        update(Payment).where(Payment.id == payment.id).values(status="claimed", lease_until=None)
+    )
+    await session.commit()
+    return DEFERRED
+
+
+async def _plan(payment: Payment) -> Optional[str]:
+    """Фиксирует абсолютные expire/data_limit для платежа; None — план готов.
+
+    Планы одного пользователя строятся по очереди, каждый поверх уже
+    применённых. Очередь проверяется под advisory-lock пользователя в двух
+    коротких транзакциях — до и после запроса к панели, — а сам запрос идёт
+    без открытой сессии. Если за это время другой платёж пользователя успел
+    получить план, снимок панели мог устареть, и платёж откладывается.
+    """
+    if payment.grant_expire is not None:
+        return None
+
+    username = f"tg{payment.user_id}"
+    async with await get_db_session() as session:
+        blocked, planned, orphaned = await _plan_state(session, payment)
+        if blocked:
+            return await _defer(session, payment)
+        await session.commit()
+
+    # Брошенный план мог уже дойти до панели: применяем его тем же абсолютным планом, а не строим поверх.
+    for orphan_id in orphaned:
+        outcome, _ = await apply_payment(orphan_id)
+        logger.info(f"Платёж {payment.id}: брошенный платёж {orphan_id} того же пользователя доведён: {outcome}.")
+        if outcome == RETRY:
+            return RETRY
+        if outcome == IN_PROGRESS:
+            async with await get_db_session() as session:
+                return await _defer(session, payment)
+
+    # Страница списка отличает «пользователя нет» от недоступной панели, GET api/user — нет.
+    page = await marzban_client.get_users_page(usernames=[username], limit=1)
+    if page is None:
+        return RETRY
+    current = next((user for user in page.get("users", []) if user.get("username") == username), None)
+    grant = marzban_client.plan_grant(payment.tariff_code, current)
+
+    async with await get_db_session() as session:
+        if grant is None:
+            logger.error(f"❌ Тариф {payment.tariff_code} платежа {payment.id} не найден.")
+            await session.execute(update(Payment).where(Payment.id == payment.id).values(status="failed", lease_until=None))
+            await session.commit()
+            return FAILED
+
+        blocked, planned_now, _ = await _plan_state(session, payment)
+        if blocked or planned_now != planned:
+            return await _defer(session, payment)
+        saved = await session.scalar(
+            update(Payment)
+            .where(Payment.id == payment.id, Payment.status == "provisioning", Payment.grant_expire.is_(None))
+            .values(grant_expire=grant["expire"], grant_data_limit=grant["data_limit"])
+            .returning(Payment.id)
+        )
+        await session.commit()
+    if saved is None:
+        # Аренда истекла, и платёж подхватил другой обработчик.
+        return IN_PROGRESS
+    payment.grant_expire, payment.grant_data_limit = grant["expire"], grant["data_limit"]
+    return None
+
+
+async def _finish(payment: Payment, link: str, panel: str) -> bool:
+    """Отмечает платёж применённым и обновляет подписку в одной транзакции."""
+    async with await get_db_session() as session:
+        current = await session.get(Payment, payment.id, with_for_update=True)
+        if current.status != "provisioning":
+            # Аренда истекла, и платёж довёл другой обработчик с тем же планом.
+            return False
+
+        expires_at = datetime.utcfromtimestamp(current.grant_expire)
+        sub = await session.get(Subscription, current.subscription_id) if current.subscription_id else None
+        if sub is None:
+            sub = Subscription(
+                tariff_code=current.tariff_code,
+                data_limit_gb=TARIFS[current.tariff_code]["limit_gb"],
+                user_id=current.user_id,
+                created_at=datetime.utcnow(),
+            )
+            session.add(sub)
+        sub.expires_at = expires_at
+        sub.is_paid = True
+        sub.vpn_link = link
+        sub.status = "active"
+        sub.panel = panel
+        await session.flush()
+
+        current.subscription_id = sub.id
+        current.status = "applied"
+        current.applied_at = datetime.utcnow()
+        current.lease_until = None
+        current.vpn_link = link
+        await session.commit()
+    return True
+
+
+async def apply_payment(payment_id: int) -> tuple[str, Optional[str]]:
+    """Доводит заявленный платёж до applied. Возвращает (результат, ссылка)."""
+    outcome, payment = await _acquire(payment_id)
+    if outcome is not None:
+        return outcome, payment.vpn_link
+
+    outcome = await _plan(payment)
+    if outcome == RETRY:
+        await _release(payment.id)
+    if outcome is not None:
+        return outcome, None
+
+    panel = await marzban_client.panel_for(payment.user_id)
+    link = await marzban_client.apply_grant(
+        payment.user_id, payment.tariff_code,
+        {"expire": payment.grant_expire, "data_limit": payment.grant_data_limit},
+    )
+    if not link:
+        # План уже зафиксирован, повтор задания применит его же.
+        logger.warning(f"Платёж {payment.provider}:{payment.charge_id}: панель не применила план, повторим позже.")
+        await _release(payment.id)
+        return RETRY, None
+
+    if not await _finish(payment, link, panel):
+        return ALREADY_APPLIED, link
+    await forget_panel_user(f"tg{payment.user_id}")
+    logger.info(f"✅ Платёж {payment.provider}:{payment.charge_id} применён.", extra={"payment_id": payment.id})
+    return APPLIED, link
+
+
+async def notify_applied(bot: Bot, user_id: int, link: str):
+    await bot.send_message(
+        user_id,
+        f"🎉 Оплата прошла успешно!\n\n🔑 Ваша ссылка:\n\n{link}\n",
+    )
+
+
+async def notify_failed(bot: Bot, user_id: int):
+    await bot.send_message(
+        user_id,
+        "⚠️ Оплата прошла, но не удалось создать ключ VPN. Пожалуйста, свяжитесь с поддержкой.",
+    )
+
+
+@outbox_handler(PROVISION_JOB)
+async def provision_payment_job(bot: Bot, job):
+    payment_id, user_id = job.payload["payment_id"], job.payload["user_id"]
+    user_token = user_id_var.set(user_id)
+    try:
+        outcome, link = await apply_payment(payment_id)
+        if outcome == APPLIED:
+            await notify_applied(bot, user_id, link)
+        elif outcome == FAILED:
+            await notify_failed(bot, user_id)
+        elif outcome in (DEFERRED, IN_PROGRESS):
+            # Ждём платёж того же пользователя или чужую аренду — это не сбой, пока ожидание не затянулось.
+            if job.postpones >= OUTBOX_MAX_POSTPONES:
+                await notify_failed(bot, user_id)
+            raise RetryLater(f"платёж {payment_id}: {outcome}", delay_s=OUTBOX_BACKOFF_BASE_S)
+        elif outcome == RETRY:
+            if job.attempts >= OUTBOX_MAX_ATTEMPTS:
+                # Платёж остаётся заявленным: после /requeue_dead задание доведёт его тем же планом.
+                await notify_failed(bot, user_id)
+            raise RetryLater(f"платёж {payment_id}: {outcome}")
+    finally:
+        user_id_var.reset(user_token)
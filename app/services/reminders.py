@@ -0,0 +1,202 @@
+"""Напоминания об окончании подписки и трафика с кнопкой продления.
+
+Кандидаты выбираются из panel_users диапазонами по индексам
+ix_panel_users_expire и ix_panel_users_usage_ratio; окна не пересекаются,
+поэтому пользователь получает одно напоминание на окно. Перед отправкой
+напоминание заявляется в reminders_sent (INSERT ... ON CONFLICT DO NOTHING),
+так что параллельные проходы и экземпляры бота не шлют его дважды.
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict
+from aiogram import Bot
+from sqlalchemy import Float, String, delete, exists, func, select, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from app.db.database import get_db_session
+from app.db.models import PanelUser, ReminderSent, Subscription, User
+from app.handlers.status import format_bytes
+from app.keyboards.pay_menu import PAID_TARIFS, get_renew_keyboard
+from app.services.broadcast import BLOCKED, FAILED, Pacer, mark_blocked, send_paced
+from app.services.logging_setup import new_request_id
+from app.services.metrics import REMINDERS_SENT
+from config import (
+    REMINDER_INTERVAL, REMINDER_BATCH_SIZE, REMINDER_EXPIRY_DAYS, REMINDER_EXPIRED_LOOKBACK_DAYS,
+    REMINDER_QUOTA_THRESHOLDS, REMINDER_RATE, REMINDER_RETENTION_DAYS,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RENEW_TARIFF = next(iter(PAID_TARIFS))
+SEND_CONCURRENCY = 5
+
+USAGE_RATIO = func.cast(PanelUser.used_traffic, Float) / PanelUser.data_limit
+EXPIRY_CYCLE = func.cast(PanelUser.expire, String)
+QUOTA_CYCLE = func.concat(PanelUser.expire, ":", PanelUser.data_limit)
+
+
+def expiry_windows(now_s: int) -> list[tuple[str, int, int]]:
+    """(kind, from, to] по expire: «истекла» и по окну на каждое число дней, без пересечений."""
+    windows = [("expired", now_s - REMINDER_EXPIRED_LOOKBACK_DAYS * 86400, now_s)]
+    lower = now_s
+    for days in REMINDER_EXPIRY_DAYS:
+        upper = now_s + days * 86400
+        windows.append((f"expire_{days}d", lower, upper))
+        lower = upper
+    return windows
+
+
+def quota_windows() -> list[tuple[str, float, float | None]]:
+    """[kind, from, to) по доле израсходованного трафика; последний порог без верхней границы."""
+    bounds = [p / 100 for p in REMINDER_QUOTA_THRESHOLDS] + [None]
+    return [(f"quota_{p}", bounds[i], bounds[i + 1]) for i, p in enumerate(REMINDER_QUOTA_THRESHOLDS)]
+
+
+def reminder_text(kind: str, row: Dict[str, Any]) -> str:
+    expire_at = datetime.utcfromtimestamp(row["expire"]).strftime("%d.%m.%Y %H:%M")
+    if kind == "expired":
+        return (
+            "⛔ <b>Подписка закончилась</b>, VPN отключён.\n\n"
+            "Продлите её, чтобы снова подключиться, — ссылка останется прежней."
+        )
+    if kind.startswith("expire_"):
+        days = kind.removeprefix("expire_").removesuffix("d")
+        return (
+            f"⏳ <b>Подписка закончится в ближайшие {days} дн.</b>: {expire_at} UTC.\n\n"
+            "Продлите заранее: новый срок добавится к оставшимся дням."
+        )
+    used, limit = format_bytes(row["used_traffic"]), format_bytes(row["data_limit"])
+    percent = int(kind.removeprefix("quota_"))
+    if percent >= 100:
+        return f"🚫 <b>Трафик исчерпан</b>: {used} из {limit}.\n\nПродлите подписку, чтобы получить новый лимит."
+    return f"📊 <b>Израсходовано {percent}% трафика</b>: {used} из {limit}.\n\nЛимит обновится при продлении подписки."
+
+
+async def _renew_tariffs(session, user_ids: list[int]) -> Dict[int, str]:
+    """Последний платный тариф каждого пользователя."""
+    rows = await session.execute(
+        select(Subscription.user_id, Subscription.tariff_code)
+        .where(Subscription.user_id.in_(user_ids), Subscription.tariff_code.in_(list(PAID_TARIFS)))
+        .order_by(Subscription.user_id, Subscription.id.desc())
+        .distinct(Subscription.user_id)
+    )
+    return dict(rows.all())
+
+
+async def _claim_batch(kind: str, window, cycle, batch_size: int) -> list[Dict[str, Any]]:
+    """Выбирает ещё не напомненных пользователей окна и заявляет им напоминание."""
+    already_sent = exists().where(
+        ReminderSent.user_id == PanelUser.user_id, ReminderSent.kind == kind, ReminderSent.cycle == cycle,
+    )
+    blocked = exists().where(User.id == PanelUser.user_id, User.blocked_at.is_not(None))
+    async with await get_db_session() as session:
+        rows = (await session.execute(
+            select(PanelUser.user_id, PanelUser.expire, PanelUser.data_limit, PanelUser.used_traffic, cycle.label("cycle"))
+            .where(
+                *window, PanelUser.user_id.is_not(None), PanelUser.status != "disabled",
+                # Строка, устаревшая после начисления, ещё хранит прежние expire/data_limit.
+                PanelUser.synced_at.is_not(None), ~already_sent, ~blocked,
+            )
+            .limit(batch_size)
+        )).mappings().all()
+        if not rows:
+            return []
+
+        claimed = set((await session.execute(
+            pg_insert(ReminderSent)
+            .values([{"user_id": row["user_id"], "kind": kind, "cycle": row["cycle"], "sent_at": datetime.utcnow()} for row in rows])
+            .on_conflict_do_nothing()
+            .returning(ReminderSent.user_id)
+        )).scalars().all())
+        tariffs = await _renew_tariffs(session, list(claimed)) if claimed else {}
+        await session.commit()
+
+    return [
+        {**row, "tariff_code": tariffs.get(row["user_id"], DEFAULT_RENEW_TARIFF)}
+        for row in rows if row["user_id"] in claimed
+    ]
+
+
+async def _deliver(bot: Bot, pacer: Pacer, kind: str, rows: list[Dict[str, Any]], failed: list) -> Dict[str, int]:
+    """Отправляет заявленную пачку; неотправленные добавляет в failed как (kind, user_id, cycle)."""
+    semaphore = asyncio.Semaphore(SEND_CONCURRENCY)
+
+    async def one(row):
+        async with semaphore:
+            return await send_paced(
+                bot, pacer, row["user_id"], reminder_text(kind, row), reply_markup=get_renew_keyboard(row["tariff_code"]),
+            )
+
+    results = await asyncio.gather(*(one(row) for row in rows))
+    counts: Dict[str, int] = {}
+    for result in results:
+        counts[result] = counts.get(result, 0) + 1
+        REMINDERS_SENT.labels(kind, result).inc()
+
+    failed.extend((kind, row["user_id"], row["cycle"]) for row, result in zip(rows, results) if result == FAILED)
+    blocked_ids = [row["user_id"] for row, result in zip(rows, results) if result == BLOCKED]
+    if blocked_ids:
+        async with await get_db_session() as session:
+            await mark_blocked(session, blocked_ids)
+            await session.commit()
+    return counts
+
+
+async def send_reminders(bot: Bot, batch_size: int = REMINDER_BATCH_SIZE, rate: float = REMINDER_RATE) -> dict:
+    """Один проход по всем окнам; возвращает число отправок по видам напоминаний."""
+    stats: Dict[str, Any] = {"elapsed_s": 0.0}
+    started = time.perf_counter()
+    pacer = Pacer(rate)
+
+    windows = [
+        (kind, (PanelUser.expire > lower, PanelUser.expire <= upper), EXPIRY_CYCLE)
+        for kind, lower, upper in expiry_windows(int(time.time()))
+    ]
+    for kind, lower, upper in quota_windows():
+        bounds = (PanelUser.data_limit > 0, USAGE_RATIO >= lower)
+        if upper is not None:
+            bounds += (USAGE_RATIO < upper,)
+        windows.append((kind, bounds, QUOTA_CYCLE))
+
+    failed: list[tuple[str, int, str]] = []
+    for kind, window, cycle in windows:
+        while True:
+            rows = await _claim_batch(kind, window, cycle, batch_size)
+            if not rows:
+                break
+            for result, count in (await _deliver(bot, pacer, kind, rows, failed)).items():
+                stats[f"{kind}_{result}"] = stats.get(f"{kind}_{result}", 0) + count
+            if len(rows) < batch_size:
+                break
+
+    async with await get_db_session() as session:
+        if failed:
+            # Заявки снимаются в конце прохода: неотправленное повторится на следующем.
+            await session.execute(delete(ReminderSent).where(
+                tuple_(ReminderSent.kind, ReminderSent.user_id, ReminderSent.cycle).in_(failed),
+            ))
+        await session.execute(
+            delete(ReminderSent).where(ReminderSent.sent_at < datetime.utcnow() - timedelta(days=REMINDER_RETENTION_DAYS))
+        )
+        await session.commit()
+
+    stats["elapsed_s"] = time.perf_counter() - started
+    return stats
+
+
+async def run_reminders(bot: Bot):
+    while True:
+        new_request_id("reminders")
+        try:
+            stats = await send_reminders(bot)
+            if len(stats) > 1:
+                logger.info(
+                    "Напоминания: " + ", ".join(f"{key} {value}" for key, value in stats.items() if key != "elapsed_s")
+                    + f", {stats['elapsed_s']:.2f} с.",
+                    extra={"reminder_stats": stats},
+                )
+        except Exception as e:
+            logger.exception(f"Ошибка отправки напоминаний: {e}")
+
+        await asyncio.sleep(REMINDER_INTERVAL)
@@ -0,0 +1,108 @@
+import random
+import re
+import time
+
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE"}
+
+_USER_PATH_RE = re.compile(r"^(api/user)/[^/]+")
+
+
+def path_template(path: str) -> str:
+    """Сводит путь к шаблону эндпоинта: api/user/tg123 -> api/user/{username}."""
+    return _USER_PATH_RE.sub(r"\1/{username}", path.lstrip("/").split("?", 1)[0])
+
+
+class EndpointPolicy:
+    """Дедлайн и параметры повторов для одного эндпоинта панели."""
+
+    def __init__(self, deadline: float, max_attempts: int = 3, base_delay: float = 0.2, max_delay: float = 2.0):
+        self.deadline = deadline
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff(self, attempt: int) -> float:
+        """Экспоненциальная задержка с полным джиттером перед попыткой attempt (с 1)."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+DEFAULT_POLICY = EndpointPolicy(deadline=15)
+
+ENDPOINT_POLICIES = {
+    ("GET", "api/user/{username}"): EndpointPolicy(deadline=5),
+    ("PUT", "api/user/{username}"): EndpointPolicy(deadline=10),
+    ("POST", "api/user"): EndpointPolicy(deadline=10),
+    ("GET", "api/users"): EndpointPolicy(deadline=30),
+    # Фоновый снимок здоровья: одна попытка, следующая — в очередном обновлении.
+    ("GET", "api/inbounds"): EndpointPolicy(deadline=10, max_attempts=1),
+    ("GET", "api/hosts"): EndpointPolicy(deadline=10, max_attempts=1),
+    ("GET", "api/nodes"): EndpointPolicy(deadline=10, max_attempts=1),
+    ("GET", "api/nodes/usage"): EndpointPolicy(deadline=10, max_attempts=1),
+    ("GET", "api/system"): EndpointPolicy(deadline=10, max_attempts=1),
+    ("POST", "api/admin/token"): EndpointPolicy(deadline=10),
+    ("POST", "admin/token"): EndpointPolicy(deadline=10),
+    ("POST", "token"): EndpointPolicy(deadline=10),
+}
+
+
+def policy_for(method: str, path: str) -> EndpointPolicy:
+    return ENDPOINT_POLICIES.get((method, path_template(path)), DEFAULT_POLICY)
+
+
+class CircuitBreaker:
+    """Размыкается после failure_threshold ошибок подряд и держит панель закрытой reset_timeout секунд.
+
+    После паузы пропускает один пробный запрос (half_open): успех замыкает
+    цепь, ошибка снова размыкает её.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_started_at: float | None = None
+        self.rejected = 0
+
+    @property
+    def is_open(self) -> bool:
+        return self.state == self.OPEN and time.monotonic() - self.opened_at < self.reset_timeout
+
+    def allow_request(self) -> bool:
+        now = time.monotonic()
+        if self.state == self.CLOSED:
+            return True
+
+        if self.state == self.OPEN:
+            if now - self.opened_at < self.reset_timeout:
+                self.rejected += 1
+                return False
+            self.state = self.HALF_OPEN
+            self.probe_started_at = None
+
+        # Пробный запрос, зависший дольше reset_timeout, не должен блокировать цепь навсегда.
+        if self.probe_started_at is not None and now - self.probe_started_at < self.reset_timeout:
+            self.rejected += 1
+            return False
+        self.probe_started_at = now
+        return True
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.probe_started_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self.probe_started_at = None
+
+    def stats(self) -> dict:
+        return {"state": self.state, "failures": self.failures, "rejected": self.rejected}
@@ -0,0 +1,60 @@
+import logging
+import re
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import web
+from config import TELEGRAM_WEBHOOK_URL, TELEGRAM_WEBHOOK_PATH, TELEGRAM_WEBHOOK_SECRET
+
+logger = logging.getLogger(__name__)
+
+# Допустимый secret_token по документации Bot API.
+_SECRET_RE = re.compile(r"^[A-Za-z0-9_-]{1,256}$")
+
+
+def check_webhook_secret(secret_token: str | None) -> str:
+    """Без секрета SimpleRequestHandler не проверяет X-Telegram-Bot-Api-Secret-Token,
+    и любой, кто узнал путь, может подсунуть апдейты, в том числе successful_payment.
+    """
+    if not secret_token:
+        raise RuntimeError("TELEGRAM_WEBHOOK_SECRET не задан: режим webhook без проверки секрета не запускается.")
+    if not _SECRET_RE.match(secret_token):
+        raise RuntimeError("TELEGRAM_WEBHOOK_SECRET: допустимы 1–256 символов A-Z, a-z, 0-9, _ и -.")
+    return secret_token
+
+
+def mount_telegram_webhook(app: web.Application, dp: Dispatcher, bot: Bot,
+                           path: str = TELEGRAM_WEBHOOK_PATH,
+                           secret_token: str | None = TELEGRAM_WEBHOOK_SECRET):
+    """Подключает обработчик обновлений aiogram к существующему web.Application.
+
+    Обновления обрабатываются в фоне (handle_in_background), поэтому медленный
+    хендлер не задерживает ответ Telegram и остальные обновления. Запросы без
+    верного секрета отклоняются.
+    """
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=check_webhook_secret(secret_token),
+        handle_in_background=True,
+    ).register(app, path=path)
+
+
+async def set_telegram_webhook(bot: Bot, dp: Dispatcher,
+                               base_url: str | None = TELEGRAM_WEBHOOK_URL,
+                               path: str = TELEGRAM_WEBHOOK_PATH,
+                               secret_token: str | None = TELEGRAM_WEBHOOK_SECRET):
+    if not base_url:
+        raise RuntimeError("TELEGRAM_WEBHOOK_URL не задан для режима webhook.")
+
+    url = f"{base_url.rstrip('/')}/{path.lstrip('/')}"
+    await bot.set_webhook(
+        url=url,
+        secret_token=check_webhook_secret(secret_token),
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+    logger.info(f"🔗 Telegram webhook установлен: {url}")
+
+
+async def delete_telegram_webhook(bot: Bot):
+    await bot.delete_webhook()
+    logger.info("🔗 Telegram webhook удалён.")
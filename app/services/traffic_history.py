@@ -0,0 +1,245 @@
+"""История трафика: приросты из синхронизации панели и их свёртка по часам и дням.
+
+traffic_samples (сырые приросты) и traffic_hourly секционированы по дням,
+поэтому срок хранения соблюдается удалением целых секций. Строки на день
+без своей секции (обслуживание отстало) попадают в секцию DEFAULT и
+переносятся в дневную секцию, когда та создаётся. traffic_daily
+хранится дольше и чистится по индексу на day. Экран статуса читает только
+traffic_daily и traffic_hourly.
+"""
+import asyncio
+import logging
+from datetime import date, datetime, timedelta
+from typing import Any, Dict
+from sqlalchemy import delete, func, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncConnection
+from app.db.database import engine, get_db_session
+from app.db.models import RollupState, TrafficDaily, TrafficHourly, TrafficSample
+from app.services.logging_setup import new_request_id
+from config import (
+    TRAFFIC_ROLLUP_INTERVAL, TRAFFIC_RAW_RETENTION_DAYS, TRAFFIC_HOURLY_RETENTION_DAYS,
+    TRAFFIC_DAILY_RETENTION_DAYS, TRAFFIC_PARTITIONS_AHEAD_DAYS,
+)
+
+logger = logging.getLogger(__name__)
+
+# Проход синхронизации пишет приросты с ts своего начала и может закоммитить их
+# уже после границы часа; час сворачивается только с таким запасом.
+ROLLUP_LAG = timedelta(minutes=15)
+# Запас не гарантия: свёрнутое окно такой длины пересчитывается на каждом
+# проходе, и приросты, закоммиченные после свёртки своего часа, не теряются.
+# Пересчёт идемпотентен — бакет целиком перезаписывается суммой из источника.
+ROLLUP_REROLL = timedelta(hours=1)
+
+# Секционированная таблица -> (ключ секционирования, срок хранения в днях,
+# свёртка, которая должна её покрыть перед удалением).
+PARTITIONED_TABLES = {
+    "traffic_samples": ("ts", TRAFFIC_RAW_RETENTION_DAYS, "hourly"),
+    "traffic_hourly": ("hour", TRAFFIC_HOURLY_RETENTION_DAYS, "daily"),
+}
+
+
+def _partition_name(table: str, day: date) -> str:
+    return f"{table}_p{day:%Y%m%d}"
+
+
+def _default_partition(table: str) -> str:
+    return f"{table}_default"
+
+
+async def ensure_partitions(conn: AsyncConnection, today: date, days_ahead: int = TRAFFIC_PARTITIONS_AHEAD_DAYS):
+    """Создаёт дневные секции на сегодня и days_ahead дней вперёд.
+
+    Если строки дня уже лежат в секции DEFAULT, секция собирается отдельно
+    и подключается через ATTACH: иначе CREATE ... PARTITION OF упадёт на
+    проверке DEFAULT.
+    """
+    for table, (column, *_) in PARTITIONED_TABLES.items():
+        default = _default_partition(table)
+        has_default = await conn.scalar(text("SELECT to_regclass(:name) IS NOT NULL"), {"name": default})
+        for offset in range(days_ahead + 1):
+            day = today + timedelta(days=offset)
+            name = _partition_name(table, day)
+            bounds = {"start": datetime.combine(day, datetime.min.time()),
+                      "end": datetime.combine(day + timedelta(days=1), datetime.min.time())}
+            if await conn.scalar(text("SELECT to_regclass(:name) IS NOT NULL"), {"name": name}):
+                continue
+            spilled = has_default and await conn.scalar(text(
+                f"SELECT EXISTS (SELECT 1 FROM {default} WHERE {column} >= :start AND {column} < :end)"
+            ), bounds)
+            if not spilled:
+                await conn.execute(text(
+                    f"CREATE TABLE {name} PARTITION OF {table} "
+                    f"FOR VALUES FROM ('{day.isoformat()}') TO ('{(day + timedelta(days=1)).isoformat()}')"
+                ))
+                continue
+            await conn.execute(text(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"))
+            await conn.execute(text(
+                f"WITH moved AS (DELETE FROM {default} WHERE {column} >= :start AND {column} < :end RETURNING *) "
+                f"INSERT INTO {name} SELECT * FROM moved"
+            ), bounds)
+            await conn.execute(text(
+                f"ALTER TABLE {table} ATTACH PARTITION {name} "
+                f"FOR VALUES FROM ('{day.isoformat()}') TO ('{(day + timedelta(days=1)).isoformat()}')"
+            ))
+            logger.warning(f"История трафика: строки за {day} перенесены из {default} в новую секцию {name}.")
+
+
+async def drop_expired_partitions(conn: AsyncConnection, today: date, watermarks: Dict[str, datetime]) -> int:
+    """Удаляет секции старше срока хранения, если их данные уже свёрнуты.
+
+    Из секции DEFAULT такие строки удаляются построчно.
+    """
+    dropped = 0
+    for table, (column, retention_days, rollup) in PARTITIONED_TABLES.items():
+        cutoff = today - timedelta(days=retention_days)
+        rolled_until = watermarks.get(rollup)
+        if rolled_until is None:
+            continue
+        await conn.execute(text(f"DELETE FROM {_default_partition(table)} WHERE {column} < :until"), {
+            "until": min(datetime.combine(cutoff, datetime.min.time()), rolled_until),
+        })
+        result = await conn.execute(text(
+            "SELECT c.relname FROM pg_inherits i"
+            " JOIN pg_class c ON c.oid = i.inhrelid"
+            " JOIN pg_class p ON p.oid = i.inhparent"
+            " WHERE p.relname = :table AND c.relname <> :default"
+        ), {"table": table, "default": _default_partition(table)})
+        for (name,) in result.all():
+            day = datetime.strptime(name.rsplit("_p", 1)[1], "%Y%m%d").date()
+            day_end = datetime.combine(day + timedelta(days=1), datetime.min.time())
+            if day < cutoff and day_end <= rolled_until:
+                await conn.execute(text(f"DROP TABLE IF EXISTS {name}"))
+                dropped += 1
+    return dropped
+
+
+async def record_usage_deltas(session, previous: Dict[str, int], rows: list[Dict[str, Any]], sampled_at: datetime) -> int:
+    """Пишет приросты used_traffic одним многострочным INSERT.
+
+    previous — used_traffic до обновления panel_users. Первое появление
+    пользователя задаёт только базу; уменьшение счётчика означает сброс
+    лимита в панели, и приростом считается новое значение целиком.
+    """
+    samples = []
+    for row in rows:
+        old = previous.get(row["username"])
+        if row["user_id"] is None or old is None:
+            continue
+        new = row["used_traffic"]
+        delta = new - old if new >= old else new
+        if delta > 0:
+            samples.append({"user_id": row["user_id"], "ts": sampled_at, "bytes": delta})
+    if samples:
+        stmt = pg_insert(TrafficSample).values(samples)
+        await session.execute(stmt.on_conflict_do_update(
+            index_elements=[TrafficSample.user_id, TrafficSample.ts],
+            set_={"bytes": TrafficSample.bytes + stmt.excluded.bytes},
+        ))
+    return len(samples)
+
+
+async def _rollup(session, name: str, source, source_col, target, target_col: str, unit: str, until: datetime,
+                  reroll_from: datetime | None = None) -> datetime:
+    """Досчитывает target за [done_until, until) из source; until и reroll_from выровнены на unit.
+
+    С reroll_from уже свёрнутые бакеты начиная с него считаются заново.
+    """
+    state = await session.get(RollupState, name)
+    if state is not None:
+        start = state.done_until if reroll_from is None else min(state.done_until, reroll_from)
+    else:
+        start = await session.scalar(select(func.date_trunc(unit, func.min(source_col))))
+    if start is None or start >= until:
+        return state.done_until if state else until
+
+    bucket = func.date_trunc(unit, source_col)
+    stmt = pg_insert(target).from_select(
+        ["user_id", target_col, "bytes"],
+        select(source.user_id, bucket, func.sum(source.bytes))
+        .where(source_col >= start, source_col < until)
+        .group_by(source.user_id, bucket),
+    )
+    await session.execute(stmt.on_conflict_do_update(
+        index_elements=[target.user_id, getattr(target, target_col)],
+        set_={"bytes": stmt.excluded.bytes},
+    ))
+    await session.execute(
+        pg_insert(RollupState).values(name=name, done_until=until)
+        .on_conflict_do_update(index_elements=[RollupState.name], set_={"done_until": until})
+    )
+    return until
+
+
+async def rollup_traffic(now: datetime | None = None) -> Dict[str, datetime]:
+    """Сворачивает законченные часы в traffic_hourly и законченные дни в traffic_daily."""
+    now = now or datetime.utcnow()
+    hour_start = (now - ROLLUP_LAG).replace(minute=0, second=0, microsecond=0)
+    day_start = hour_start.replace(hour=0)
+
+    async with await get_db_session() as session:
+        state = await session.get(RollupState, "hourly")
+        hourly_reroll = state.done_until - ROLLUP_REROLL if state is not None else None
+        hourly_until = await _rollup(
+            session, "hourly", TrafficSample, TrafficSample.ts, TrafficHourly, "hour", "hour", hour_start,
+            reroll_from=hourly_reroll,
+        )
+        # День сворачивается, только когда все его часы уже в traffic_hourly,
+        # и пересчитывается, если пересчитан какой-то его час.
+        daily_until = min(day_start, hourly_until.replace(hour=0, minute=0, second=0, microsecond=0))
+        daily_until = await _rollup(
+            session, "daily", TrafficHourly, TrafficHourly.hour, TrafficDaily, "day", "day", daily_until,
+            reroll_from=hourly_reroll.replace(hour=0) if hourly_reroll is not None else None,
+        )
+        await session.execute(
+            delete(TrafficDaily).where(TrafficDaily.day < day_start - timedelta(days=TRAFFIC_DAILY_RETENTION_DAYS))
+        )
+        await session.commit()
+    return {"hourly": hourly_until, "daily": daily_until}
+
+
+async def get_daily_usage(user_id: int, days: int) -> list[tuple[date, int]]:
+    """Трафик по дням за последние days дней (включая сегодня) из свёрнутых таблиц."""
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    start = today - timedelta(days=days - 1)
+    usage = {(start + timedelta(days=i)).date(): 0 for i in range(days)}
+
+    async with await get_db_session() as session:
+        state = await session.get(RollupState, "daily")
+        hourly_from = max(start, state.done_until) if state else start
+
+        daily = await session.execute(
+            select(TrafficDaily.day, TrafficDaily.bytes).where(
+                TrafficDaily.user_id == user_id, TrafficDaily.day >= start, TrafficDaily.day < hourly_from,
+            )
+        )
+        day_bucket = func.date_trunc("day", TrafficHourly.hour)
+        recent = await session.execute(
+            select(day_bucket, func.sum(TrafficHourly.bytes))
+            .where(TrafficHourly.user_id == user_id, TrafficHourly.hour >= hourly_from)
+            .group_by(day_bucket)
+        )
+        for day, used in [*daily.all(), *recent.all()]:
+            if day.date() in usage:
+                usage[day.date()] += int(used)
+
+    return sorted(usage.items())
+
+
+async def run_traffic_rollup():
+    while True:
+        new_request_id("traffic-rollup")
+        try:
+            today = datetime.utcnow().date()
+            async with engine.begin() as conn:
+                await ensure_partitions(conn, today)
+            watermarks = await rollup_traffic()
+            async with engine.begin() as conn:
+                dropped = await drop_expired_partitions(conn, today, watermarks)
+            if dropped:
+                logger.info(f"История трафика: удалено устаревших секций {dropped}.")
+        except Exception as e:
+            logger.exception(f"Ошибка свёртки истории трафика: {e}")
+
+        await asyncio.sleep(TRAFFIC_ROLLUP_INTERVAL)
@@ -3,23 +3,51 @@ import logging
 import os 
 from aiogram import Bot, Dispatcher
 from aiohttp import web 
-from config import BOT_TOKEN
+from config import BOT_TOKEN, BOT_MODE, TELEGRAM_WEBHOOK_SECRET, CRYPTO_WEBHOOK_ENABLED, CRYPTO_WEBHOOK_PATH, LOG_LEVEL, LOG_LEVELS, LOG_FORMAT
 from app.main_commands import router as commands_router
-from app.services.marzban_api import marzban_client
+from app.services.marzban_pool import marzban_client
 from app.handlers.buy import check_crypto_payments 
+from app.services.expiry_sweeper import run_expiry_sweeper
+from app.services.panel_sync import run_panel_sync
+from app.services.traffic_history import run_traffic_rollup
+from app.services.outbox import run_outbox_workers
+from app.services.broadcast import run_broadcasts
+from app.services.reminders import run_reminders
+from app.services.leader import leader_election
+from app.services.crypto_webhook import crypto_webhook_handler
+from app.services.telegram_webhook import (
+    check_webhook_secret, mount_telegram_webhook, set_telegram_webhook, delete_telegram_webhook,
+)
 from app.db.database import init_db 
+from app.middlewares.metrics import UpdateBacklogMiddleware
+from app.middlewares.correlation import CorrelationMiddleware
+from app.services.logging_setup import setup_logging, stop_logging
+from app.services.metrics import render_metrics
 
-logging.basicConfig(level=logging.INFO)
+setup_logging(LOG_LEVEL, LOG_LEVELS, LOG_FORMAT)
 
 dp = Dispatcher()
+dp.update.outer_middleware(CorrelationMiddleware())
+dp.update.outer_middleware(UpdateBacklogMiddleware())
 dp.include_router(commands_router)
 
 async def health_check(request):
-    return web.Response(text="Bot is running via Long Polling.", status=200)
+    mode = "Webhook" if BOT_MODE == "webhook" else "Long Polling"
+    return web.Response(text=f"Bot is running via {mode}.", status=200)
 
-async def start_web_server():
+async def metrics_handler(request):
+    return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8",
+                        headers={"X-Prometheus-Format": "0.0.4"})
+
+async def start_web_server(bot: Bot):
     app = web.Application()
-    app.add_routes([web.get('/health', health_check)]) 
+    app["bot"] = bot
+    app.add_routes([web.get('/health', health_check), web.get('/metrics', metrics_handler)]) 
+    if CRYPTO_WEBHOOK_ENABLED:
+        app.add_routes([web.post(CRYPTO_WEBHOOK_PATH, crypto_webhook_handler)])
+        logging.info(f"💎 CryptoPay webhook принимается на {CRYPTO_WEBHOOK_PATH}.")
+    if BOT_MODE == "webhook":
+        mount_telegram_webhook(app, dp, bot)
     port = int(os.environ.get("PORT", 8080)) 
     host = '0.0.0.0'
 
@@ -39,6 +67,8 @@ async def start_web_server():
 async def shutdown(bot: Bot):
     logging.info("🛑 Начинается корректное закрытие ресурсов...")
     try:
+        if BOT_MODE == "webhook":
+            await delete_telegram_webhook(bot)
         await marzban_client.close() 
         await bot.session.close()
     except Exception as e:
@@ -57,19 +87,46 @@ async def run_bot_tasks(bot: Bot):
         logging.error(f"❌ Критическая ошибка инициализации: {e}. Проверьте ENV VARIABLES!")
         return
     
-    asyncio.create_task(check_crypto_payments(bot)) 
-    logging.info("✅ Фоновая задача проверки платежей запущена.")
-    logging.info("🚀 Бот запускает Long Polling...")
-    await dp.start_polling(bot)
+    # Задачи-очереди идут на каждой реплике и делят строки через SKIP LOCKED.
+    asyncio.create_task(run_outbox_workers(bot))
+    logging.info("✅ Воркеры outbox запущены.")
+    # Снимок здоровья нод у каждой реплики свой: выбор инбаунда читает его из памяти.
+    asyncio.create_task(marzban_client.run_health_refresh())
+    logging.info("✅ Фоновое обновление здоровья нод Marzban запущено.")
+
+    # Опросы внешних API и отправки в лимитах бота — только на реплике-лидере.
+    leader_election.singleton("crypto-poller", check_crypto_payments)
+    leader_election.singleton("panel-sync", run_panel_sync)
+    # Свипер не держит блокировок во время запросов к панели, поэтому один на все реплики.
+    leader_election.singleton("expiry-sweeper", run_expiry_sweeper)
+    leader_election.singleton("traffic-rollup", run_traffic_rollup)
+    leader_election.singleton("broadcasts", lambda: run_broadcasts(bot))
+    leader_election.singleton("reminders", lambda: run_reminders(bot))
+    asyncio.create_task(leader_election.run())
+    logging.info("✅ Выбор лидера для фоновых задач запущен.")
+
+    if BOT_MODE == "webhook":
+        await set_telegram_webhook(bot, dp)
+        logging.info("🚀 Бот принимает обновления через Webhook.")
+        await asyncio.Event().wait()
+    else:
+        logging.info("🚀 Бот запускает Long Polling...")
+        await dp.start_polling(bot)
 
 
 async def main():
     if not BOT_TOKEN:
         logging.error("BOT_TOKEN не установлен. Завершение.")
         return
+    if BOT_MODE == "webhook":
+        try:
+            check_webhook_secret(TELEGRAM_WEBHOOK_SECRET)
+        except RuntimeError as e:
+            logging.error(f"{e} Завершение.")
+            return
 
     bot = Bot(token=BOT_TOKEN)
-    web_server_task = asyncio.create_task(start_web_server())
+    web_server_task = asyncio.create_task(start_web_server(bot))
     polling_task = asyncio.create_task(run_bot_tasks(bot))
     
     try:
@@ -87,3 +144,5 @@ if __name__ == "__main__":
         logging.info("Bot stopped by KeyboardInterrupt (Local).")
     except Exception as e:
         logging.error(f"Непредвиденная ошибка при выполнении main: {e}")
+    finally:
+        stop_logging()
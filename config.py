@@ -1,3 +1,4 @@
+import json
 import os
 from dotenv import load_dotenv
 
@@ -9,4 +10,126 @@ MARZBAN_PASSWORD = os.getenv("MARZBAN_PASSWORD")
 DATABASE_URL = os.getenv("DATABASE_URL")
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 PROVIDER_TOKEN = os.getenv("PROVIDER_TOKEN")
-CRYPTO_TOKEN = os.getenv("CRYPTO_TOKEN")
\ No newline at end of file
+CRYPTO_TOKEN = os.getenv("CRYPTO_TOKEN")
+# Адрес Crypto Pay API; по умолчанию mainnet, для testnet — https://testnet-pay.crypt.bot.
+CRYPTO_API_URL = os.getenv("CRYPTO_API_URL", "https://pay.crypt.bot")
+CRYPTO_INVOICE_BATCH_SIZE = int(os.getenv("CRYPTO_INVOICE_BATCH_SIZE", 100))
+CRYPTO_INVOICE_FETCH_CONCURRENCY = int(os.getenv("CRYPTO_INVOICE_FETCH_CONCURRENCY", 4))
+CRYPTO_POLL_INTERVAL = int(os.getenv("CRYPTO_POLL_INTERVAL", 30))
+
+CRYPTO_WEBHOOK_ENABLED = os.getenv("CRYPTO_WEBHOOK_ENABLED", "false").lower() == "true"
+CRYPTO_WEBHOOK_PATH = os.getenv("CRYPTO_WEBHOOK_PATH", "/crypto/webhook")
+CRYPTO_WEBHOOK_POLL_INTERVAL = int(os.getenv("CRYPTO_WEBHOOK_POLL_INTERVAL", 300))
+CRYPTO_WEBHOOK_GRACE_S = int(os.getenv("CRYPTO_WEBHOOK_GRACE_S", 120))
+
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()  # polling | webhook
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL")
+TELEGRAM_WEBHOOK_PATH = os.getenv("TELEGRAM_WEBHOOK_PATH", "/telegram/webhook")
+# Обязателен в режиме webhook: Telegram шлёт его в X-Telegram-Bot-Api-Secret-Token.
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET")
+
+MARZBAN_USER_CACHE_SIZE = int(os.getenv("MARZBAN_USER_CACHE_SIZE", 10000))
+MARZBAN_USER_CACHE_TTL = float(os.getenv("MARZBAN_USER_CACHE_TTL", 30))
+
+MARZBAN_TOKEN_STATE_FILE = os.getenv("MARZBAN_TOKEN_STATE_FILE", ".marzban_token.json")
+MARZBAN_TOKEN_REFRESH_MARGIN = int(os.getenv("MARZBAN_TOKEN_REFRESH_MARGIN", 300))
+
+MARZBAN_BREAKER_THRESHOLD = int(os.getenv("MARZBAN_BREAKER_THRESHOLD", 5))
+MARZBAN_BREAKER_RESET_S = float(os.getenv("MARZBAN_BREAKER_RESET_S", 30))
+MARZBAN_MAX_INFLIGHT = int(os.getenv("MARZBAN_MAX_INFLIGHT", 100))
+MARZBAN_STALE_TTL = float(os.getenv("MARZBAN_STALE_TTL", 86400))
+
+# Несколько адресов одной панели через запятую (необязательно).
+MARZBAN_API_URLS = [url.strip() for url in os.getenv("MARZBAN_API_URLS", "").split(",") if url.strip()]
+MARZBAN_POOL_LIMIT = int(os.getenv("MARZBAN_POOL_LIMIT", 100))
+MARZBAN_POOL_LIMIT_PER_HOST = int(os.getenv("MARZBAN_POOL_LIMIT_PER_HOST", 50))
+MARZBAN_DNS_CACHE_TTL = int(os.getenv("MARZBAN_DNS_CACHE_TTL", 300))
+MARZBAN_KEEPALIVE_TIMEOUT = float(os.getenv("MARZBAN_KEEPALIVE_TIMEOUT", 30))
+
+MARZBAN_BULK_CONCURRENCY = int(os.getenv("MARZBAN_BULK_CONCURRENCY", 10))
+MARZBAN_BULK_PAGE_SIZE = int(os.getenv("MARZBAN_BULK_PAGE_SIZE", 100))
+# Страница выборки когорты тарифа для массовых операций: одна короткая сессия на страницу.
+BULK_COHORT_PAGE_SIZE = int(os.getenv("BULK_COHORT_PAGE_SIZE", 500))
+
+# Пул панелей Marzban, JSON-список: [{"name": "de1", "url": "https://...", "username": "...",
+# "password": "...", "weight": 1, "accepts_new": true}]. Без него — одна панель "main"
+# из MARZBAN_API_URL(S) / MARZBAN_USERNAME / MARZBAN_PASSWORD.
+MARZBAN_PANELS = json.loads(os.getenv("MARZBAN_PANELS") or "[]")
+# Размещение новых пользователей: hash (взвешенное rendezvous-хеширование) или least_loaded.
+MARZBAN_PLACEMENT = os.getenv("MARZBAN_PLACEMENT", "hash").lower()
+MARZBAN_PANEL_LOAD_TTL = float(os.getenv("MARZBAN_PANEL_LOAD_TTL", 60))
+
+# Фоновый снимок здоровья нод и нагрузки инбаундов для выбора инбаунда новым и продлеваемым пользователям.
+MARZBAN_HEALTH_INTERVAL = float(os.getenv("MARZBAN_HEALTH_INTERVAL", 30))
+# Инбаунд, пока снимка нет или он старше трёх интервалов.
+MARZBAN_DEFAULT_INBOUND = os.getenv("MARZBAN_DEFAULT_INBOUND", "VLESS TCP REALITY")
+# Из каких vless-инбаундов выбирать, через запятую; пусто — из всех.
+MARZBAN_INBOUND_TAGS = [tag.strip() for tag in os.getenv("MARZBAN_INBOUND_TAGS", "").split(",") if tag.strip()]
+# Ноды инбаундов, JSON {"тег": ["нода", ...]}, если их не связать по адресам хостов.
+# В MARZBAN_PANELS задаётся ключом "inbound_nodes" у панели.
+MARZBAN_INBOUND_NODES = json.loads(os.getenv("MARZBAN_INBOUND_NODES") or "{}")
+# Продлеваемый пользователь меняет инбаунд, если его нагрузка больше лучшей во столько раз.
+MARZBAN_INBOUND_STICKINESS = float(os.getenv("MARZBAN_INBOUND_STICKINESS", 1.5))
+
+# Telegram ID администраторов через запятую.
+ADMIN_IDS = {int(admin_id) for admin_id in os.getenv("ADMIN_IDS", "").split(",") if admin_id.strip()}
+
+EXPIRY_SWEEP_INTERVAL = int(os.getenv("EXPIRY_SWEEP_INTERVAL", 300))
+EXPIRY_SWEEP_BATCH_SIZE = int(os.getenv("EXPIRY_SWEEP_BATCH_SIZE", 500))
+
+DB_PROFILE = os.getenv("DB_PROFILE", "prod").lower()  # dev | prod | benchmark
+DB_POOL_WAIT_WARN_MS = float(os.getenv("DB_POOL_WAIT_WARN_MS", 100))
+DB_AUTO_MIGRATE = os.getenv("DB_AUTO_MIGRATE", "true").lower() == "true"
+
+# Размер таблицы бакетов троттлинга на класс хендлеров (степень двойки).
+THROTTLE_SLOTS = int(os.getenv("THROTTLE_SLOTS", 65536))
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+# Уровни подсистем: "app.services.marzban_api=DEBUG,aiogram.event=WARNING,sqlalchemy.engine=INFO".
+LOG_LEVELS = os.getenv("LOG_LEVELS", "aiogram.event=WARNING")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()  # json | text
+
+PANEL_SYNC_INTERVAL = int(os.getenv("PANEL_SYNC_INTERVAL", 120))
+PANEL_SYNC_PAGE_SIZE = int(os.getenv("PANEL_SYNC_PAGE_SIZE", 500))
+
+TRAFFIC_ROLLUP_INTERVAL = int(os.getenv("TRAFFIC_ROLLUP_INTERVAL", 600))
+TRAFFIC_RAW_RETENTION_DAYS = int(os.getenv("TRAFFIC_RAW_RETENTION_DAYS", 2))
+TRAFFIC_HOURLY_RETENTION_DAYS = int(os.getenv("TRAFFIC_HOURLY_RETENTION_DAYS", 35))
+TRAFFIC_DAILY_RETENTION_DAYS = int(os.getenv("TRAFFIC_DAILY_RETENTION_DAYS", 400))
+TRAFFIC_PARTITIONS_AHEAD_DAYS = int(os.getenv("TRAFFIC_PARTITIONS_AHEAD_DAYS", 3))
+
+PAYMENT_LEASE_S = int(os.getenv("PAYMENT_LEASE_S", 120))
+
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", 4))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", 2))
+OUTBOX_LEASE_S = int(os.getenv("OUTBOX_LEASE_S", 120))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 12))
+# Сколько раз задание может отложиться, ожидая чужой работы (около часа при OUTBOX_BACKOFF_BASE_S=5).
+OUTBOX_MAX_POSTPONES = int(os.getenv("OUTBOX_MAX_POSTPONES", 720))
+OUTBOX_BACKOFF_BASE_S = float(os.getenv("OUTBOX_BACKOFF_BASE_S", 5))
+OUTBOX_BACKOFF_MAX_S = float(os.getenv("OUTBOX_BACKOFF_MAX_S", 600))
+# Доля задержки повтора outbox, которая случайна: разводит одновременно упавшие задания.
+OUTBOX_BACKOFF_JITTER = float(os.getenv("OUTBOX_BACKOFF_JITTER", 0.5))
+OUTBOX_RETENTION_DAYS = int(os.getenv("OUTBOX_RETENTION_DAYS", 7))
+
+# Лимит Telegram для рассылок — около 30 сообщений в секунду на бота.
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 25))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 10))
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", 200))
+BROADCAST_LEASE_S = int(os.getenv("BROADCAST_LEASE_S", 60))
+BROADCAST_POLL_INTERVAL = float(os.getenv("BROADCAST_POLL_INTERVAL", 10))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", 5))
+
+REMINDER_INTERVAL = int(os.getenv("REMINDER_INTERVAL", 900))
+REMINDER_BATCH_SIZE = int(os.getenv("REMINDER_BATCH_SIZE", 200))
+# За сколько дней до окончания напоминать; отдельно напоминание в момент окончания.
+REMINDER_EXPIRY_DAYS = sorted({int(d) for d in os.getenv("REMINDER_EXPIRY_DAYS", "3,1").split(",") if d.strip()})
+# Не напоминаем о подписках, истёкших раньше этого (например, при первом запуске).
+REMINDER_EXPIRED_LOOKBACK_DAYS = int(os.getenv("REMINDER_EXPIRED_LOOKBACK_DAYS", 2))
+REMINDER_QUOTA_THRESHOLDS = sorted({int(p) for p in os.getenv("REMINDER_QUOTA_THRESHOLDS", "80,100").split(",") if p.strip()})
+REMINDER_RATE = float(os.getenv("REMINDER_RATE", 20))
+REMINDER_RETENTION_DAYS = int(os.getenv("REMINDER_RETENTION_DAYS", 400))
+
+# Выбор лидера для фоновых задач в единственном экземпляре: как часто проверять
+# соединение с блокировками и пытаться забрать лидерство у упавшей реплики.
+LEADER_HEARTBEAT_S = float(os.getenv("LEADER_HEARTBEAT_S", 5))
@@ -0,0 +1,22 @@
+import argparse
+import asyncio
+from app.db.models import User, Subscription
+from app.db.database import engine
+from app.db.migrations import current_version, latest_version, run_migrations
+
+async def main(status_only: bool):
+    version = await current_version(engine)
+    target = latest_version()
+    print(f"Текущая версия схемы: {version}, последняя: {target}.")
+
+    if not status_only and version < target:
+        version = await run_migrations(engine)
+        print(f"Схема обновлена до версии {version}.")
+
+    await engine.dispose()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Применение миграций схемы БД.")
+    parser.add_argument("--status", action="store_true", help="только показать версию схемы")
+    args = parser.parse_args()
+    asyncio.run(main(args.status))
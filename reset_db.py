@@ -1,20 +1,21 @@
 import asyncio
-from app.db.database import engine, Base
+from sqlalchemy import text
 # Обязательно импортируем модели, чтобы Base знала о них
 from app.db.models import User, Subscription 
+from app.db.database import engine, Base
+from app.db.migrations import run_migrations
 
 async def main():
     print("Удаление старых таблиц...")
     async with engine.begin() as conn:
         # Удаляем ВСЕ таблицы, известные Base
         await conn.run_sync(Base.metadata.drop_all)
+        await conn.execute(text("DROP TABLE IF EXISTS schema_version"))
     print("Старые таблицы удалены.")
     
-    print("Создание новых таблиц по моделям...")
-    async with engine.begin() as conn:
-        # Создаем ВСЕ таблицы заново
-        await conn.run_sync(Base.metadata.create_all)
-    print("База данных успешно пересоздана.")
+    print("Создание новых таблиц миграциями...")
+    version = await run_migrations(engine)
+    print(f"База данных успешно пересоздана (схема v{version}).")
     
     # Закрываем пул соединений
     await engine.dispose()
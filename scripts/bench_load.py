@@ -0,0 +1,422 @@
+"""Нагрузочный прогон бота целиком: смешанный поток апдейтов через dp.feed_update.
+
+Поднимает фейковые Bot API, Marzban и Crypto Pay (с задержкой и долей
+ошибок), собирает тот же Dispatcher, что и bot.py, и с заданной частотой
+запускает сценарии пользователей: /start, статус, подключение, выбор
+тарифа, оплату звёздами (инвойс → pre_checkout → successful_payment) и
+криптой (инвойс оплачивается фейком через --crypto-paid-after секунд).
+Параллельно работают воркеры outbox и опрос Crypto Pay, поэтому оплаты
+проходят до выдачи ключа.
+
+Отчёт: достигнутая пропускная способность, p50/p95/p99 по хендлерам и по
+апдейтам, отсечённые троттлингом, занятость пула БД, число обращений к
+каждому внешнему сервису и время от оплаты до начисления. С --json отчёт
+сохраняется, с --baseline сравнивается с сохранённым ранее — это эталон,
+с которым сверяются остальные изменения производительности.
+
+Нужен DATABASE_URL на тестовую базу Postgres.
+
+Пример:
+    DATABASE_URL=postgresql://postgres@127.0.0.1/bot_bench DB_PROFILE=benchmark \\
+        python scripts/bench_load.py --rate 100 --duration 30 --panel-latency 0.05 --json base.json
+"""
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+BENCH_ENV = {
+    "MARZBAN_API_URL": "http://127.0.0.1:8083",
+    "MARZBAN_TOKEN_STATE_FILE": "",
+    "CRYPTO_API_URL": "http://127.0.0.1:8084",
+    "CRYPTO_TOKEN": "test-token",
+    "CRYPTO_POLL_INTERVAL": "1",
+    "CRYPTO_WEBHOOK_ENABLED": "false",
+    "OUTBOX_POLL_INTERVAL": "0.2",
+    "LOG_FORMAT": "text",
+    "LOG_LEVEL": "WARNING",
+}
+os.environ.update({key: value for key, value in BENCH_ENV.items() if key not in os.environ})
+
+from typing import Any, Awaitable, Callable, Dict
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import TelegramObject, Update
+from sqlalchemy import BigInteger, delete, func, select
+
+from app.db.models import OutboxJob, PanelUser, Payment, Subscription, User
+from app.db.database import engine, get_db_session, init_db, pool_metrics, pool_stats
+from app.keyboards.pay_menu import PAID_TARIFS
+from app.main_commands import router as commands_router, throttling
+from app.middlewares.throttling import TokenBuckets
+from app.services.marzban_pool import marzban_client
+from app.services.outbox import run_outbox_workers
+from app.handlers.buy import check_crypto_payments
+import bot as bot_app
+from fake_bot_api import FAKE_TOKEN, FakeBotAPI
+from fake_cryptopay import FakeCryptoPay
+from fake_marzban import FakeMarzban
+
+BASE_USER_ID = 9_300_000_000
+TARIFF = next(iter(PAID_TARIFS))
+DEFAULT_MIX = "start=20,status=30,connect=20,buy=15,stars=8,crypto=7"
+USERNAME_IN_PATH = re.compile(r"/tg\d+")
+
+
+class HandlerTimer(BaseMiddleware):
+    """Сырые длительности хендлеров по имени функции (гистограмма метрик слишком грубая для p99)."""
+
+    def __init__(self):
+        self.samples: Dict[str, list[float]] = collections.defaultdict(list)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        name = data["handler"].callback.__name__
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            self.samples[name].append(time.perf_counter() - started)
+
+
+def percentiles(samples: list[float]) -> dict:
+    ordered = sorted(samples)
+    p = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000 if ordered else 0.0
+    return {"count": len(ordered), "p50_ms": p(0.5), "p95_ms": p(0.95), "p99_ms": p(0.99)}
+
+
+class Updates:
+    """Сырые апдейты Telegram от имени синтетических пользователей."""
+
+    def __init__(self):
+        self._ids = itertools.count(1)
+
+    def _user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": "Load", "username": f"load{user_id}"}
+
+    def _message(self, user_id: int, **fields) -> dict:
+        update_id = next(self._ids)
+        return {"update_id": update_id, "message": {
+            "message_id": update_id, "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"}, "from": self._user(user_id), **fields,
+        }}
+
+    def text(self, user_id: int, text: str) -> dict:
+        return self._message(user_id, text=text)
+
+    def callback(self, user_id: int, data: str) -> dict:
+        update_id = next(self._ids)
+        return {"update_id": update_id, "callback_query": {
+            "id": str(update_id), "from": self._user(user_id), "chat_instance": str(user_id), "data": data,
+            "message": {
+                "message_id": update_id, "date": int(time.time()), "text": "menu",
+                "chat": {"id": user_id, "type": "private"}, "from": {"id": 123456, "is_bot": True, "first_name": "Fake"},
+            },
+        }}
+
+    def pre_checkout(self, user_id: int, payload: str, amount: int) -> dict:
+        update_id = next(self._ids)
+        return {"update_id": update_id, "pre_checkout_query": {
+            "id": str(update_id), "from": self._user(user_id), "currency": "XTR",
+            "total_amount": amount, "invoice_payload": payload,
+        }}
+
+    def successful_payment(self, user_id: int, payload: str, amount: int) -> dict:
+        return self._message(user_id, successful_payment={
+            "currency": "XTR", "total_amount": amount, "invoice_payload": payload,
+            "telegram_payment_charge_id": f"load-{user_id}-{next(self._ids)}", "provider_payment_charge_id": "",
+        })
+
+
+def scenarios(updates: Updates) -> Dict[str, Callable[[int], list[tuple[str, dict]]]]:
+    """Сценарий — последовательность (шаг, апдейт) одного пользователя."""
+    stars = PAID_TARIFS[TARIFF]["stars"]
+
+    def stars_flow(user_id: int):
+        payload = f"stars_{TARIFF}_{user_id}"
+        return [
+            ("pay_stars", updates.callback(user_id, f"pay_stars_{TARIFF}")),
+            ("pre_checkout", updates.pre_checkout(user_id, payload, stars)),
+            ("successful_payment", updates.successful_payment(user_id, payload, stars)),
+        ]
+
+    return {
+        "start": lambda user_id: [("start", updates.text(user_id, "/start"))],
+        "status": lambda user_id: [("status", updates.text(user_id, "ℹ️ Cтатус"))],
+        "connect": lambda user_id: [("connect", updates.text(user_id, "❤️ Подключится"))],
+        "buy": lambda user_id: [
+            ("buy_menu", updates.text(user_id, "💳 Купить")),
+            ("buy_tariff", updates.callback(user_id, f"buy_{TARIFF}")),
+        ],
+        "stars": stars_flow,
+        "crypto": lambda user_id: [("pay_crypto", updates.callback(user_id, f"pay_crypto_{TARIFF}"))],
+    }
+
+
+def parse_mix(mix: str) -> Dict[str, int]:
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        weights[name.strip()] = int(weight)
+    return weights
+
+
+async def cleanup():
+    async with await get_db_session() as session:
+        await session.execute(delete(Payment).where(Payment.user_id >= BASE_USER_ID))
+        await session.execute(delete(OutboxJob).where(OutboxJob.payload["user_id"].as_string().cast(BigInteger) >= BASE_USER_ID))
+        await session.execute(delete(Subscription).where(Subscription.user_id >= BASE_USER_ID))
+        await session.execute(delete(PanelUser).where(PanelUser.user_id >= BASE_USER_ID))
+        await session.execute(delete(User).where(User.id >= BASE_USER_ID))
+        await session.commit()
+
+
+def by_route(calls: Dict[str, int]) -> Dict[str, int]:
+    """Сводит вызовы панели по маршрутам: /api/user/tg123 → /api/user/{username}."""
+    routes: collections.Counter = collections.Counter()
+    for key, count in calls.items():
+        routes[USERNAME_IN_PATH.sub("/{username}", key)] += count
+    return dict(routes)
+
+
+async def drain_payments(stars_paid: int, timeout: float) -> dict:
+    """Ждёт начисления всех оплат прогона; возвращает статусы и задержку от заявки до начисления.
+
+    Ожидаются оплаты звёздами, дошедшие до хендлера, и все выставленные крипто-инвойсы.
+    """
+    async with await get_db_session() as session:
+        invoices = await session.scalar(
+            select(func.count()).select_from(Subscription)
+            .where(Subscription.user_id >= BASE_USER_ID, Subscription.invoice_id.is_not(None))
+        )
+    expected = stars_paid + invoices
+    deadline = time.monotonic() + timeout
+    while True:
+        async with await get_db_session() as session:
+            statuses = dict((await session.execute(
+                select(Payment.status, func.count()).where(Payment.user_id >= BASE_USER_ID).group_by(Payment.status)
+            )).all())
+        if statuses.get("applied", 0) >= expected or time.monotonic() > deadline:
+            break
+        await asyncio.sleep(0.5)
+
+    async with await get_db_session() as session:
+        delays = (await session.execute(
+            select(func.extract("epoch", Payment.applied_at - Payment.created_at))
+            .where(Payment.user_id >= BASE_USER_ID, Payment.status == "applied")
+        )).scalars().all()
+    return {"statuses": statuses, "expected": expected, **percentiles([float(d) for d in delays])}
+
+
+async def run_load(bot: Bot, rate: float, duration: float, users: int, mix: Dict[str, int]) -> dict:
+    dp = bot_app.dp
+    updates = Updates()
+    flows = scenarios(updates)
+    names, weights = list(mix), list(mix.values())
+    fresh = iter(range(BASE_USER_ID, BASE_USER_ID + users))
+    started_users: list[int] = []
+
+    step_samples: Dict[str, list[float]] = collections.defaultdict(list)
+    errors: collections.Counter = collections.Counter()
+    flow_counts: collections.Counter = collections.Counter()
+    in_flight = 0
+    max_in_flight = 0
+    held_samples: list[int] = []
+    done = asyncio.Event()
+
+    async def sample_pool():
+        while not done.is_set():
+            held_samples.append(engine.sync_engine.pool.checkedout())
+            await asyncio.sleep(0.01)
+
+    async def run_flow(name: str, user_id: int):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        try:
+            for step, raw in flows[name](user_id):
+                update = Update.model_validate(raw, context={"bot": bot})
+                step_started = time.perf_counter()
+                try:
+                    await dp.feed_update(bot, update)
+                except Exception as e:
+                    errors[f"{step}: {type(e).__name__}"] += 1
+                    return
+                finally:
+                    step_samples[step].append(time.perf_counter() - step_started)
+        finally:
+            in_flight -= 1
+
+    def pick() -> tuple[str, int]:
+        name = random.choices(names, weights)[0]
+        if name == "start" or not started_users:
+            user_id = next(fresh, None)
+            if user_id is None:
+                return "start", random.choice(started_users)
+            started_users.append(user_id)
+            return "start", user_id
+        return name, random.choice(started_users)
+
+    sampler = asyncio.create_task(sample_pool())
+    pool_metrics.reset()
+    tasks = []
+    total = int(rate * duration)
+    started = time.perf_counter()
+    lag_max = 0.0
+    for i in range(total):
+        # Открытая модель: сценарии стартуют по расписанию, даже если бот не успевает.
+        delay = started + i / rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            lag_max = max(lag_max, -delay)
+        name, user_id = pick()
+        flow_counts[name] += 1
+        tasks.append(asyncio.create_task(run_flow(name, user_id)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    done.set()
+    await sampler
+
+    processed = sum(len(samples) for samples in step_samples.values())
+    return {
+        "offered_rate": rate,
+        "elapsed_s": elapsed,
+        "flows": dict(flow_counts),
+        "updates": processed,
+        "throughput": processed / elapsed,
+        "schedule_lag_max_ms": lag_max * 1000,
+        "max_in_flight": max_in_flight,
+        "errors": dict(errors),
+        "steps": {step: percentiles(samples) for step, samples in sorted(step_samples.items())},
+        "pool": {
+            **pool_stats(),
+            "held_avg": sum(held_samples) / len(held_samples) if held_samples else 0.0,
+            "held_max": max(held_samples, default=0),
+        },
+    }
+
+
+def print_report(report: dict, baseline: dict | None):
+    load = report["load"]
+    print(f"Предложено {load['offered_rate']:.0f} сценариев/с, апдейтов {load['updates']} за {load['elapsed_s']:.1f} с: "
+          f"{load['throughput']:.1f} апд./с, в полёте до {load['max_in_flight']}, "
+          f"отставание расписания до {load['schedule_lag_max_ms']:.0f} мс.")
+    print(f"Сценарии: {load['flows']}; ошибки: {load['errors'] or 'нет'}; отсечено троттлингом: {report['throttled']}.")
+
+    def table(title: str, rows: dict, base_rows: dict):
+        print(f"\n{title:<28} {'n':>6} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9}")
+        for name, row in rows.items():
+            line = f"{name:<28} {row['count']:>6} {row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} {row['p99_ms']:>9.1f}"
+            base = base_rows.get(name)
+            if base and base["p95_ms"]:
+                line += f"   p95 {(row['p95_ms'] / base['p95_ms'] - 1) * 100:+.0f}% к эталону"
+            print(line)
+
+    table("Хендлер", report["handlers"], (baseline or {}).get("handlers", {}))
+    table("Шаг (feed_update)", load["steps"], (baseline or {}).get("load", {}).get("steps", {}))
+
+    pool = load["pool"]
+    print(f"\nПул БД ({pool['profile']}, размер {pool['size']}): занято в среднем {pool['held_avg']:.1f}, "
+          f"максимум {pool['held_max']}, overflow-выдач {pool['overflow_checkouts']}, "
+          f"ожидание до {pool['wait_max_ms']:.1f} мс, таймаутов {pool['timeouts']}.")
+    for service, calls in report["calls"].items():
+        print(f"Вызовы {service}: " + ", ".join(f"{key} {value}" for key, value in sorted(calls.items())))
+    payments = report["payments"]
+    print(f"Оплаты: {payments['statuses']} из {payments['expected']}; от заявки до начисления "
+          f"p50 {payments['p50_ms']:.0f} мс, p95 {payments['p95_ms']:.0f} мс.")
+
+    if baseline:
+        base_load = baseline["load"]
+        print(f"\nК эталону: пропускная способность {base_load['throughput']:.1f} → {load['throughput']:.1f} апд./с "
+              f"({(load['throughput'] / base_load['throughput'] - 1) * 100:+.0f}%), "
+              f"пул занят в среднем {base_load['pool']['held_avg']:.1f} → {pool['held_avg']:.1f}.")
+
+
+async def main(args):
+    panel = FakeMarzban(latency_s=args.panel_latency, error_rate=args.panel_errors)
+    pay = FakeCryptoPay(latency_s=args.crypto_latency, error_rate=args.crypto_errors, paid_after_s=args.crypto_paid_after)
+    api = FakeBotAPI(latency_s=args.api_latency, error_rate=args.api_errors)
+    for server in (panel, pay, api):
+        await server.start()
+    bot = Bot(token=FAKE_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(api.base_url)))
+
+    timer = HandlerTimer()
+    for observer in (commands_router.message, commands_router.callback_query, commands_router.pre_checkout_query):
+        observer.middleware(timer)
+    if args.raw_capacity:
+        # Меряем сам бот, а не глобальный лимитер: бюджеты на пользователя остаются.
+        throttling.global_buckets = {name: TokenBuckets(1, 1e9, 10 ** 9) for name in throttling.global_buckets}
+
+    background = []
+    try:
+        await marzban_client.initialize()
+        await init_db()
+        await cleanup()
+        background = [asyncio.create_task(run_outbox_workers(bot)), asyncio.create_task(check_crypto_payments())]
+
+        load = await run_load(bot, args.rate, args.duration, args.users, parse_mix(args.mix))
+        payments = await drain_payments(len(timer.samples["process_successful_payment"]), args.drain_timeout)
+        report = {
+            "load": load,
+            "handlers": {name: percentiles(samples) for name, samples in sorted(timer.samples.items())},
+            "throttled": {name: count for name, count in throttling.throttled.items() if count},
+            "calls": {
+                "Bot API": dict(api.calls),
+                "Marzban": by_route(panel.calls),
+                "Crypto Pay": dict(pay.calls),
+            },
+            "payments": payments,
+            "settings": {key: value for key, value in vars(args).items() if key not in ("json", "baseline")},
+        }
+
+        baseline = None
+        if args.baseline:
+            with open(args.baseline, encoding="utf-8") as f:
+                baseline = json.load(f)
+        print_report(report, baseline)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+    finally:
+        for task in background:
+            task.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
+        await cleanup()
+        await marzban_client.close()
+        await bot.session.close()
+        for server in (panel, pay, api):
+            await server.stop()
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=float, default=50, help="новых сценариев в секунду")
+    parser.add_argument("--duration", type=float, default=20, help="длительность подачи нагрузки, с")
+    parser.add_argument("--users", type=int, default=2000, help="размер пула синтетических пользователей")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="веса сценариев, например start=20,status=30")
+    parser.add_argument("--raw-capacity", action="store_true", help="снять глобальные бюджеты троттлинга")
+    parser.add_argument("--api-latency", type=float, default=0.03, help="задержка фейкового Bot API, с")
+    parser.add_argument("--api-errors", type=float, default=0.0, help="доля ответов 500 от Bot API")
+    parser.add_argument("--panel-latency", type=float, default=0.05, help="задержка фейкового Marzban, с")
+    parser.add_argument("--panel-errors", type=float, default=0.0, help="доля ответов 503 от Marzban")
+    parser.add_argument("--crypto-latency", type=float, default=0.1, help="задержка фейкового Crypto Pay, с")
+    parser.add_argument("--crypto-errors", type=float, default=0.0, help="доля ответов 500 от Crypto Pay")
+    parser.add_argument("--crypto-paid-after", type=float, default=2.0, help="через сколько секунд инвойс оплачивается")
+    parser.add_argument("--drain-timeout", type=float, default=60, help="сколько ждать начисления оплат, с")
+    parser.add_argument("--json", help="сохранить отчёт в файл")
+    parser.add_argument("--baseline", help="сравнить с отчётом, сохранённым через --json")
+    asyncio.run(main(parser.parse_args()))
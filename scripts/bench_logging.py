@@ -0,0 +1,98 @@
+"""Сколько event loop простаивает на записи логов: print() против очереди.
+
+Медленный stdout (pipe, который не успевает вычитывать docker/journald)
+моделируется потоком, каждая запись в который спит --write-delay-ms.
+Параллельно с "хендлерами", пишущими логи, тикер раз в миллисекунду
+замеряет, насколько позже запланированного он просыпается.
+
+Пример:
+    python scripts/bench_logging.py --messages 5000 --write-delay-ms 0.2
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services.logging_setup import setup_logging, stop_logging, new_request_id, user_id_var
+
+
+class SlowStream:
+    def __init__(self, delay_s: float):
+        self.delay_s = delay_s
+        self.lines = 0
+
+    def write(self, text: str):
+        time.sleep(self.delay_s)
+        self.lines += text.count("\n")
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+async def measure(name: str, log, messages: int, workers: int):
+    lags: list[float] = []
+    blocked_s = 0.0
+    done = asyncio.Event()
+
+    async def ticker():
+        loop = asyncio.get_running_loop()
+        while not done.is_set():
+            expected = loop.time() + 0.001
+            await asyncio.sleep(0.001)
+            lags.append(max(loop.time() - expected, 0.0))
+
+    async def worker(worker_id: int):
+        nonlocal blocked_s
+        new_request_id("bench")
+        user_id_var.set(worker_id)
+        for i in range(messages // workers):
+            started = time.perf_counter()
+            log(f"Пользователь 'tg{worker_id}' существует. Обновление (продление) подписки... #{i}")
+            blocked_s += time.perf_counter() - started
+            await asyncio.sleep(0)
+
+    tick_task = asyncio.create_task(ticker())
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(w) for w in range(workers)))
+    elapsed = time.perf_counter() - started
+    done.set()
+    await tick_task
+
+    lags.sort()
+    p = lambda q: lags[min(len(lags) - 1, int(q * len(lags)))] * 1000
+    print(
+        f"{name:<7} wall={elapsed:.2f}s in_log_calls={blocked_s:.2f}s "
+        f"loop_lag p50={p(0.5):.2f}ms p99={p(0.99):.2f}ms max={lags[-1] * 1000:.2f}ms",
+        file=sys.__stdout__,
+    )
+
+
+async def main(messages: int, workers: int, write_delay_s: float):
+    print_stream = SlowStream(write_delay_s)
+    await measure("print", lambda msg: print(msg, file=print_stream), messages, workers)
+
+    queue_stream = SlowStream(write_delay_s)
+    setup_logging("INFO", fmt="json", stream=queue_stream)
+    logger = logging.getLogger("app.services.marzban_api")
+    await measure("queue", logger.info, messages, workers)
+    flush_started = time.perf_counter()
+    stop_logging()
+    print(
+        f"queue   listener drained {queue_stream.lines} lines, "
+        f"{time.perf_counter() - flush_started:.2f}s after the loop finished",
+        file=sys.__stdout__,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=50)
+    parser.add_argument("--write-delay-ms", type=float, default=0.2, help="задержка одной записи в stdout, мс")
+    args = parser.parse_args()
+    asyncio.run(main(args.messages, args.workers, args.write_delay_ms / 1000))
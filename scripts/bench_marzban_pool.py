@@ -0,0 +1,59 @@
+"""Всплеск пробных /start против фейковой панели и статистика пула соединений.
+
+Показывает, упирается ли выдача ключей в установку соединений (create_avg_ms,
+queue_wait_*) или в задержку самой панели (latency).
+
+Пример:
+    MARZBAN_POOL_LIMIT_PER_HOST=20 python scripts/bench_marzban_pool.py --users 500 --latency 0.05
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("MARZBAN_API_URL", "http://127.0.0.1:8083")
+os.environ.setdefault("MARZBAN_TOKEN_STATE_FILE", "")
+
+from app.services.marzban_api import MarzbanAPI
+from fake_marzban import FakeMarzban
+
+
+async def main(users: int, latency: float):
+    panel = FakeMarzban(latency_s=latency)
+    await panel.start()
+    client = MarzbanAPI()
+    client.base_url = panel.base_url
+    await client.initialize()
+
+    latencies = []
+
+    async def trial(i: int):
+        started = time.perf_counter()
+        await client.create_user(telegram_user_id=1_000_000 + i, tariff_code="free", user_data={})
+        latencies.append(time.perf_counter() - started)
+
+    try:
+        started = time.perf_counter()
+        await asyncio.gather(*(trial(i) for i in range(users)))
+        elapsed = time.perf_counter() - started
+    finally:
+        stats = client.transport_stats()
+        await client.close()
+        await panel.stop()
+
+    latencies.sort()
+    p = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+    print(f"trials={users} elapsed={elapsed:.2f}s rps={users / elapsed:.1f} "
+          f"p50={p(0.5):.1f}ms p99={p(0.99):.1f}ms panel_latency={latency * 1000:.0f}ms")
+    for key, value in stats.items():
+        print(f"  {key:<18} {value:.2f}" if isinstance(value, float) else f"  {key:<18} {value}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.05, help="задержка панели, с")
+    args = parser.parse_args()
+    asyncio.run(main(args.users, args.latency))
@@ -0,0 +1,120 @@
+"""Нагрузочный прогон /start: задержка и число занятых соединений пула БД.
+
+Сравнивает текущую логику register_start (короткие транзакции, соединение
+отпускается до Marzban) со старой схемой, где сессия держалась открытой на
+время create_user. Нужны DATABASE_URL на тестовую базу Postgres и фейковая
+панель (поднимается сама).
+
+Пример:
+    DATABASE_URL=postgresql://postgres@127.0.0.1/bot_bench DB_PROFILE=benchmark \\
+        python scripts/bench_start.py --users 500 --concurrency 100 --panel-latency 0.2
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("MARZBAN_API_URL", "http://127.0.0.1:8083")
+os.environ.setdefault("MARZBAN_TOKEN_STATE_FILE", "")
+
+from datetime import datetime, timedelta
+from sqlalchemy import delete, select
+
+from app.db.models import User, Subscription
+from app.db.database import engine, get_db_session, init_db, pool_metrics, pool_stats
+from app.keyboards.pay_menu import TRIAL_TARIFF, TRIAL_TARIFF_CODE
+from app.main_commands import register_start
+from app.services.marzban_pool import marzban_client
+from fake_marzban import FakeMarzban
+
+BASE_USER_ID = 9_000_000_000
+
+
+async def legacy_start(user_id: int, username: str, full_name: str) -> str:
+    """Прежняя схема /start: get + select + create_user внутри одной открытой сессии."""
+    async with await get_db_session() as session:
+        if not await session.get(User, user_id):
+            session.add(User(id=user_id, username=username, registration_date=datetime.utcnow()))
+        result = await session.execute(
+            select(Subscription).where(Subscription.user_id == user_id, Subscription.tariff_code == TRIAL_TARIFF_CODE)
+        )
+        if result.scalars().first():
+            return "exists"
+        link = await marzban_client.create_user(telegram_user_id=user_id, tariff_code=TRIAL_TARIFF_CODE, user_data={})
+        if link:
+            session.add(Subscription(
+                tariff_code=TRIAL_TARIFF_CODE, expires_at=datetime.utcnow() + timedelta(days=TRIAL_TARIFF["days"]),
+                data_limit_gb=TRIAL_TARIFF["limit_gb"], status="active", user_id=user_id, is_paid=True, vpn_link=link,
+            ))
+        await session.commit()
+        return link or "error"
+
+
+async def cleanup():
+    async with await get_db_session() as session:
+        await session.execute(delete(Subscription).where(Subscription.user_id >= BASE_USER_ID))
+        await session.execute(delete(User).where(User.id >= BASE_USER_ID))
+        await session.commit()
+
+
+async def run(name: str, start, users: int, concurrency: int, panel: FakeMarzban):
+    await cleanup()
+    panel.users.clear()
+    for client in marzban_client.panels.values():
+        client._user_cache.clear()
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: list[float] = []
+    pool_metrics.reset()
+    held_samples: list[int] = []
+    done = asyncio.Event()
+
+    async def sample_pool():
+        while not done.is_set():
+            held_samples.append(engine.sync_engine.pool.checkedout())
+            await asyncio.sleep(0.001)
+
+    async def one(i: int):
+        async with semaphore:
+            started = time.perf_counter()
+            await start(BASE_USER_ID + i, f"bench{i}", f"Bench {i}")
+            latencies.append(time.perf_counter() - started)
+
+    sampler = asyncio.create_task(sample_pool())
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(users)))
+    elapsed = time.perf_counter() - started
+    done.set()
+    await sampler
+
+    latencies.sort()
+    p = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+    stats = pool_stats()
+    print(f"{name:<8} rps={users / elapsed:.1f} p50={p(0.5):.1f}ms p99={p(0.99):.1f}ms "
+          f"held_avg={sum(held_samples) / len(held_samples):.1f} held_max={max(held_samples)} "
+          f"wait_max={stats['wait_max_ms']:.1f}ms timeouts={stats['timeouts']}")
+
+
+async def main(users: int, concurrency: int, panel_latency: float):
+    panel = FakeMarzban(latency_s=panel_latency)
+    await panel.start()
+    await marzban_client.initialize()
+    await init_db()
+    try:
+        await run("legacy", legacy_start, users, concurrency, panel)
+        await run("current", register_start, users, concurrency, panel)
+    finally:
+        await cleanup()
+        await marzban_client.close()
+        await panel.stop()
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--panel-latency", type=float, default=0.2, help="задержка панели, с")
+    args = parser.parse_args()
+    asyncio.run(main(args.users, args.concurrency, args.panel_latency))
@@ -0,0 +1,119 @@
+"""Сравнение задержки «обновление → ответ» в режимах polling и webhook.
+
+Бот работает против локального фейкового Bot API (scripts/fake_bot_api.py)
+и обрабатывает кнопку «🆘 Помощь» настоящим роутером app.handlers.help.
+
+Пример:
+    python scripts/bench_webhook_vs_polling.py --updates 500 --concurrency 20
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiohttp import web
+
+from app.handlers.help import router as help_router
+from app.services.telegram_webhook import mount_telegram_webhook, set_telegram_webhook, delete_telegram_webhook
+from fake_bot_api import FAKE_TOKEN, FakeBotAPI, make_text_update
+
+WEBHOOK_HOST = "127.0.0.1"
+WEBHOOK_PORT = 8082
+WEBHOOK_PATH = "/telegram/webhook"
+WEBHOOK_SECRET = "bench-secret"
+
+
+def make_bot(api: FakeBotAPI) -> Bot:
+    session = AiohttpSession(api=TelegramAPIServer.from_base(api.base_url))
+    return Bot(token=FAKE_TOKEN, session=session)
+
+
+def make_dispatcher() -> Dispatcher:
+    dp = Dispatcher()
+    dp.include_router(help_router)
+    return dp
+
+
+async def drive(api: FakeBotAPI, updates: int, concurrency: int) -> list[float]:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: list[float] = []
+
+    async def one(i: int):
+        async with semaphore:
+            waiter = await api.push_update(make_text_update(i + 1, 10_000 + i, "🆘 Помощь"))
+            latencies.append(await asyncio.wait_for(waiter, 30))
+
+    await asyncio.gather(*(one(i) for i in range(updates)))
+    return latencies
+
+
+async def bench_polling(updates: int, concurrency: int) -> tuple[list[float], float]:
+    api = FakeBotAPI()
+    await api.start()
+    bot = make_bot(api)
+    dp = make_dispatcher()
+    polling = asyncio.create_task(dp.start_polling(bot, handle_signals=False, close_bot_session=False))
+    try:
+        await asyncio.sleep(0.2)
+        started = time.perf_counter()
+        latencies = await drive(api, updates, concurrency)
+        return latencies, time.perf_counter() - started
+    finally:
+        await dp.stop_polling()
+        polling.cancel()
+        await bot.session.close()
+        await api.stop()
+
+
+async def bench_webhook(updates: int, concurrency: int) -> tuple[list[float], float]:
+    api = FakeBotAPI()
+    await api.start()
+    bot = make_bot(api)
+    dp = make_dispatcher()
+
+    app = web.Application()
+    mount_telegram_webhook(app, dp, bot, path=WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    await set_telegram_webhook(bot, dp, base_url=f"http://{WEBHOOK_HOST}:{WEBHOOK_PORT}",
+                               path=WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+    try:
+        started = time.perf_counter()
+        latencies = await drive(api, updates, concurrency)
+        return latencies, time.perf_counter() - started
+    finally:
+        await delete_telegram_webhook(bot)
+        await runner.cleanup()
+        await bot.session.close()
+        await api.stop()
+
+
+def report(name: str, latencies: list[float], elapsed: float):
+    ordered = sorted(latencies)
+    pct = lambda p: ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000
+    print(
+        f"{name:<8} n={len(ordered)} rps={len(ordered) / elapsed:.1f} "
+        f"mean={statistics.mean(ordered) * 1000:.2f}ms p50={pct(0.50):.2f}ms "
+        f"p95={pct(0.95):.2f}ms p99={pct(0.99):.2f}ms"
+    )
+
+
+async def main(updates: int, concurrency: int):
+    report("polling", *await bench_polling(updates, concurrency))
+    report("webhook", *await bench_webhook(updates, concurrency))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--updates", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(main(args.updates, args.concurrency))
@@ -0,0 +1,127 @@
+"""Сквозная проверка рассылки против фейкового Bot API с флуд-лимитом.
+
+Засевает пользователей, часть которых «заблокировала» бота, запускает
+рассылку, обрывает её посередине (как упавший процесс) и продолжает с
+сохранённого курсора от имени другого владельца после истечения аренды.
+Проверяет, что каждый доступный пользователь получил сообщение, повторов
+не больше одной страницы, заблокировавшие отмечены в users и следующая
+рассылка их пропускает. Нужен DATABASE_URL на отдельную тестовую базу:
+рассылка идёт по всей таблице users.
+
+Пример:
+    DATABASE_URL=postgresql://postgres@127.0.0.1/bot_bench \\
+        python scripts/check_broadcast.py --users 1000 --rate 40 --api-limit 30
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BROADCAST_LEASE_S", "3")
+
+from datetime import datetime
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from app.db.models import Broadcast, User
+from app.db.database import engine, get_db_session, init_db
+from app.services import broadcast as broadcasts
+from config import BROADCAST_LEASE_S, BROADCAST_PAGE_SIZE
+from fake_bot_api import FAKE_TOKEN, FakeBotAPI
+
+BASE_USER_ID = 9_100_000_000
+ADMIN_ID = BASE_USER_ID - 1
+
+
+async def seed(users: int):
+    async with await get_db_session() as session:
+        await session.execute(delete(User).where(User.id >= BASE_USER_ID))
+        await session.execute(update(Broadcast).where(Broadcast.status == "running").values(status="cancelled"))
+        now = datetime.utcnow()
+        for start in range(0, users, 1000):
+            await session.execute(pg_insert(User).values([
+                {"id": BASE_USER_ID + i, "username": f"b{i}", "registration_date": now}
+                for i in range(start, min(start + 1000, users))
+            ]))
+        await session.commit()
+
+
+async def run_phase(bot: Bot, broadcast_id: int, rate: float, crash_after: float | None) -> float:
+    started = time.perf_counter()
+    claimed = await broadcasts._claim()
+    assert claimed is not None and claimed.id == broadcast_id, "рассылка не взята в аренду"
+    task = asyncio.create_task(broadcasts.run_broadcast(bot, claimed, rate=rate))
+    if crash_after is None:
+        await task
+    else:
+        await asyncio.sleep(crash_after)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    return time.perf_counter() - started
+
+
+async def main(users: int, blocked_every: int, rate: float, api_limit: int, crash_after: float):
+    blocked = {BASE_USER_ID + i for i in range(0, users, blocked_every)}
+    api = FakeBotAPI(rate_limit=api_limit, blocked_chats=blocked)
+    await api.start()
+    bot = Bot(token=FAKE_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(api.base_url)))
+    try:
+        await init_db()
+        await seed(users)
+
+        first = await broadcasts.create_broadcast("Плановые работы в 03:00 МСК", ADMIN_ID)
+        crash_s = await run_phase(bot, first.id, rate, crash_after)
+        state = await broadcasts.get_broadcast(first.id)
+        print(f"Оборвали через {crash_s:.1f} с на курсоре {max(state.cursor - BASE_USER_ID, 0)}, доставлено {state.sent}.")
+
+        # Другой процесс: свой владелец, ждёт истечения аренды упавшего.
+        broadcasts._OWNER = uuid.uuid4().hex
+        await asyncio.sleep(BROADCAST_LEASE_S + 0.5)
+        resume_s = await run_phase(bot, first.id, rate, None)
+        state = await broadcasts.get_broadcast(first.id)
+
+        ours = {chat_id: n for chat_id, n in api.delivered.items() if chat_id >= BASE_USER_ID}
+        reachable = users - len(blocked)
+        missing = reachable - len(ours)
+        duplicates = sum(n - 1 for n in ours.values())
+        async with await get_db_session() as session:
+            marked = await session.scalar(
+                select(func.count()).select_from(User).where(User.id >= BASE_USER_ID, User.blocked_at.is_not(None))
+            )
+        throughput = state.sent / (crash_s + resume_s)
+        print(f"Рассылка #{state.id}: {state.status}, доставлено {state.sent}, заблокировали {state.blocked}, ошибок {state.failed}.")
+        print(f"Скорость {throughput:.1f} сообщ./с при лимите API {api_limit}/с, ответов 429: {api.rejected[429]}.")
+        print(f"Не получили: {missing}, повторов: {duplicates} (допустимо до {BROADCAST_PAGE_SIZE}), отмечено заблокировавших: {marked}/{len(blocked)}.")
+
+        rejected_403 = api.rejected[403]
+        second = await broadcasts.create_broadcast("Вторая рассылка", ADMIN_ID)
+        await run_phase(bot, second.id, rate, None)
+        print(f"Вторая рассылка: новых ответов 403: {api.rejected[403] - rejected_403}.")
+
+        ok = (state.status == "done" and missing == 0 and duplicates <= BROADCAST_PAGE_SIZE
+              and marked == len(blocked) and api.rejected[403] == rejected_403)
+        print("OK" if ok else "FAIL")
+    finally:
+        async with await get_db_session() as session:
+            await session.execute(delete(User).where(User.id >= BASE_USER_ID))
+            await session.commit()
+        await bot.session.close()
+        await api.stop()
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=600)
+    parser.add_argument("--blocked-every", type=int, default=20, help="каждый N-й пользователь заблокировал бота")
+    parser.add_argument("--rate", type=float, default=25, help="темп отправки бота, сообщ./с")
+    parser.add_argument("--api-limit", type=int, default=30, help="лимит фейкового Bot API, сообщ./с")
+    parser.add_argument("--crash-after", type=float, default=8, help="через сколько секунд оборвать первый проход")
+    args = parser.parse_args()
+    asyncio.run(main(args.users, args.blocked_every, args.rate, args.api_limit, args.crash_after))
@@ -0,0 +1,113 @@
+"""Выбор инбаунда по снимку здоровья нод против фейковой панели Marzban.
+
+Панель с тремя vless-инбаундами, каждый на своей ноде (de, nl, fi). Пока
+снимка нет, новые пользователи получают MARZBAN_DEFAULT_INBOUND. Затем
+нода fi падает, а nl гонит вчетверо больше трафика, чем de: новые
+пользователи не должны попасть на fi, большинство должно уйти на de, и
+создание не делает запросов к эндпоинтам здоровья. После падения de
+продление уводит её пользователей на nl, а пользователи nl остаются на
+месте. В конце пул из двух панелей не размещает новых на панель, где
+не осталось живых нод.
+
+База не нужна.
+
+Пример:
+    python scripts/check_inbound_health.py --users 400 --active 500
+"""
+import argparse
+import asyncio
+import collections
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("MARZBAN_TOKEN_STATE_FILE", "")
+
+import app.db.models  # noqa: F401 — модели импортируются раньше app.db.database
+from app.services.marzban_api import MarzbanAPI
+from app.services.marzban_pool import MarzbanPool
+from config import MARZBAN_DEFAULT_INBOUND
+from fake_marzban import FakeMarzban
+
+GB = 1_000_000_000
+BASE_USER_ID = 9_500_000_000
+HEALTH_PATHS = ("GET /api/inbounds", "GET /api/hosts", "GET /api/nodes", "GET /api/nodes/usage", "GET /api/system")
+
+
+def tags_of(fake: FakeMarzban, user_ids) -> dict[int, str]:
+    return {user_id: ",".join(fake.users[f"tg{user_id}"]["inbounds"]["vless"]) for user_id in user_ids}
+
+
+async def main(users: int, active: int):
+    fake = FakeMarzban(latency_s=0.002)
+    fake.inbounds = {f"VLESS {name.upper()}": [f"{name}.example"] for name in ("de", "nl", "fi")}
+    nodes = {name: fake.add_node(name, f"{name}.example") for name in ("de", "nl", "fi")}
+    fake.users.update({f"seed{i}": {"username": f"seed{i}", "status": "active"} for i in range(active)})
+    spare = FakeMarzban(port=8085)
+    spare.inbounds = {"VLESS SPARE": ["spare.example"]}
+    spare.add_node("spare", "spare.example", status="error")
+    for server in (fake, spare):
+        await server.start()
+
+    api = MarzbanAPI(name="p1", base_urls=[fake.base_url], token_state_file="")
+    other = MarzbanAPI(name="p2", base_urls=[spare.base_url], token_state_file="")
+    ok = True
+    try:
+        await api.initialize()
+        link = await api.create_user(BASE_USER_ID - 1, "1m", {})
+        fallback = tags_of(fake, [BASE_USER_ID - 1])[BASE_USER_ID - 1]
+        print(f"Без снимка: инбаунд '{fallback}'.")
+        ok &= bool(link) and fallback == MARZBAN_DEFAULT_INBOUND
+
+        await api.refresh_health()
+        nodes["fi"]["status"] = "error"
+        nodes["de"]["uplink"] += 1 * GB
+        nodes["nl"]["uplink"] += 4 * GB
+        await asyncio.sleep(1)
+        await api.refresh_health()
+        loads = {tag: f"{state.load / GB:.1f} ГБ/с" for tag, state in api.health.inbounds.items()}
+        print(f"Снимок: {loads}, здоровы {[tag for tag, state in api.health.inbounds.items() if state.healthy]}.")
+
+        health_calls = sum(fake.calls.get(path, 0) for path in HEALTH_PATHS)
+        user_ids = [BASE_USER_ID + i for i in range(users)]
+        links = await asyncio.gather(*(api.create_user(user_id, "1m", {}) for user_id in user_ids))
+        placed = tags_of(fake, user_ids)
+        counts = collections.Counter(placed.values())
+        extra = sum(fake.calls.get(path, 0) for path in HEALTH_PATHS) - health_calls
+        print(f"Новые пользователи: {dict(sorted(counts.items()))}; запросов здоровья при создании: {extra}.")
+        ok &= all(links) and counts["VLESS FI"] == 0 and counts["VLESS DE"] > counts["VLESS NL"] and extra == 0
+
+        nodes["de"]["status"] = "error"
+        await api.refresh_health()
+        grants = await asyncio.gather(*(
+            api.apply_grant(user_id, "1m", api.plan_grant("1m", fake.users[f"tg{user_id}"])) for user_id in user_ids
+        ))
+        renewed = tags_of(fake, user_ids)
+        moved = sum(1 for user_id in user_ids if placed[user_id] == "VLESS DE" and renewed[user_id] == "VLESS NL")
+        kept = sum(1 for user_id in user_ids if placed[user_id] == "VLESS NL" and renewed[user_id] == "VLESS NL")
+        print(f"После падения de и продления: {dict(sorted(collections.Counter(renewed.values()).items()))}; "
+              f"уведено с de {moved}/{counts['VLESS DE']}, остались на nl {kept}/{counts['VLESS NL']}.")
+        ok &= all(grants) and moved == counts["VLESS DE"] and kept == counts["VLESS NL"]
+
+        nodes["de"]["status"] = "connected"
+        await other.initialize()
+        pool = MarzbanPool([api, other])
+        before = collections.Counter(pool._rendezvous(BASE_USER_ID + i) for i in range(1000))
+        await pool.refresh_health()
+        after = collections.Counter(pool._rendezvous(BASE_USER_ID + i) for i in range(1000))
+        print(f"Пул: до снимка {dict(sorted(before.items()))}, после (у p2 нет живых нод) {dict(sorted(after.items()))}.")
+        ok &= before["p2"] > 0 and after["p2"] == 0
+        print("OK" if ok else "FAIL")
+    finally:
+        await api.close()
+        await other.close()
+        for server in (fake, spare):
+            await server.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=400)
+    parser.add_argument("--active", type=int, default=500, help="активных пользователей панели до начала")
+    args = parser.parse_args()
+    asyncio.run(main(args.users, args.active))
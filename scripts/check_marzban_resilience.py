@@ -0,0 +1,81 @@
+"""Прогон MarzbanAPI против фейковой панели в разных режимах деградации.
+
+Для каждой фазы (норма, задержки, частичные 5xx, полный отказ, восстановление)
+печатает долю успешных запросов, задержки и состояние circuit breaker.
+
+Пример:
+    python scripts/check_marzban_resilience.py --requests 200
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("MARZBAN_API_URL", "http://127.0.0.1:8083")
+os.environ.setdefault("MARZBAN_TOKEN_STATE_FILE", "")
+
+from app.services.marzban_api import MarzbanAPI
+from fake_marzban import FakeMarzban
+
+PHASES = [
+    ("норма", 0.0, 0.0),
+    ("задержка 8с", 8.0, 0.0),
+    ("30% 5xx", 0.0, 0.3),
+    ("отказ 100%", 0.0, 1.0),
+    ("восстановление", 0.0, 0.0),
+]
+
+
+async def run_phase(client: MarzbanAPI, panel: FakeMarzban, name: str, latency: float, error_rate: float, requests: int):
+    panel.latency_s, panel.error_rate = latency, error_rate
+    client._user_cache.clear()
+    latencies, ok, stale = [], 0, 0
+
+    async def one(i: int):
+        nonlocal ok, stale
+        started = time.perf_counter()
+        info, is_stale = await client.get_user_snapshot(f"tg{i % 20}")
+        latencies.append(time.perf_counter() - started)
+        ok += info is not None and not is_stale
+        stale += is_stale
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    p = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+    print(
+        f"{name:<16} ok={ok:<4} stale={stale:<4} total={elapsed:.2f}s "
+        f"p50={p(0.5):.1f}ms p99={p(0.99):.1f}ms breaker={client.breaker.stats()} shed={client.shed_requests}"
+    )
+
+
+async def main(requests: int):
+    panel = FakeMarzban()
+    await panel.start()
+    for i in range(20):
+        panel.users[f"tg{i}"] = {"username": f"tg{i}", "status": "active", "expire": int(time.time()) + 86400,
+                                 "data_limit": 10 * 2 ** 30, "data_usage": 0}
+
+    client = MarzbanAPI()
+    client.base_url = panel.base_url
+    await client.initialize()
+    try:
+        for name, latency, error_rate in PHASES:
+            if name == "восстановление":
+                await asyncio.sleep(client.breaker.reset_timeout)
+            elif name != "отказ 100%":
+                client.breaker.record_success()
+            await run_phase(client, panel, name, latency, error_rate, requests)
+    finally:
+        await client.close()
+        await panel.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=200)
+    args = parser.parse_args()
+    asyncio.run(main(args.requests))
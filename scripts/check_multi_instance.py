@@ -0,0 +1,227 @@
+"""Несколько реплик бота на одной базе: ни один инвойс не начисляется дважды.
+
+Поднимает фейковые Marzban, Crypto Pay и Bot API, засевает неоплаченные
+крипто-инвойсы и запускает --replicas процессов. В каждом идут воркеры
+outbox и выбор лидера для опроса Crypto Pay. Инвойсы «оплачиваются»
+волнами, а через --kill-after секунд текущий лидер убивается SIGKILL.
+Тогда проверяется, как быстро опрос подхватила другая реплика. С --unsafe
+каждая реплика дополнительно опрашивает инвойсы без выбора лидера: так
+проверяется, что журнал платежей сам не даёт начислить дважды.
+
+В конце проверяется, что каждый пользователь получил ровно один месяц,
+в панели создан ровно один раз и все платежи в статусе applied. Нужен
+DATABASE_URL на тестовую базу Postgres.
+
+Пример:
+    DATABASE_URL=postgresql://postgres@127.0.0.1/bot_bench \\
+        python scripts/check_multi_instance.py --invoices 200 --replicas 3 --unsafe
+"""
+import argparse
+import asyncio
+import os
+import signal
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+CHILD_ENV = {
+    "MARZBAN_API_URL": "http://127.0.0.1:8083",
+    "MARZBAN_TOKEN_STATE_FILE": "",
+    "CRYPTO_API_URL": "http://127.0.0.1:8084",
+    "CRYPTO_TOKEN": "test-token",
+    "CRYPTO_POLL_INTERVAL": "1",
+    "CRYPTO_WEBHOOK_ENABLED": "false",
+    "OUTBOX_POLL_INTERVAL": "0.2",
+    "OUTBOX_BACKOFF_BASE_S": "0.2",
+    # Задания и платежи убитой реплики возвращаются в работу по истечении аренды.
+    "OUTBOX_LEASE_S": "5",
+    "PAYMENT_LEASE_S": "5",
+    "LEADER_HEARTBEAT_S": "1",
+    "LOG_FORMAT": "text",
+    "LOG_LEVEL": "WARNING",
+}
+os.environ.update({key: value for key, value in CHILD_ENV.items() if key not in os.environ})
+
+from datetime import datetime, timedelta
+from sqlalchemy import BigInteger, delete, func, select
+
+from app.db.models import OutboxJob, Payment, Subscription, User
+from app.db.database import engine, get_db_session, init_db
+
+BASE_USER_ID = 9_200_000_000
+BASE_INVOICE_ID = 700_000_000
+
+
+async def child(unsafe: bool):
+    from aiogram import Bot
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    from app.handlers.buy import check_crypto_payments, sweep_crypto_invoices
+    from app.services.leader import leader_election
+    from app.services.marzban_pool import marzban_client
+    from app.services.outbox import run_outbox_workers
+    from fake_bot_api import FAKE_TOKEN
+
+    async def poller():
+        print(f"LEADER {os.getpid()}", flush=True)
+        await check_crypto_payments()
+
+    async def unsafe_poller():
+        while True:
+            await sweep_crypto_invoices()
+            await asyncio.sleep(0.3)
+
+    await marzban_client.initialize()
+    bot = Bot(token=FAKE_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base("http://127.0.0.1:8081")))
+    asyncio.create_task(run_outbox_workers(bot))
+    if unsafe:
+        asyncio.create_task(unsafe_poller())
+    leader_election.singleton("crypto-poller", poller)
+    print(f"READY {os.getpid()}", flush=True)
+    await leader_election.run()
+
+
+async def seed(invoices: int) -> list[int]:
+    user_ids = [BASE_USER_ID + i for i in range(invoices)]
+    async with await get_db_session() as session:
+        await session.execute(delete(Payment).where(Payment.user_id >= BASE_USER_ID))
+        await session.execute(delete(OutboxJob).where(OutboxJob.payload["user_id"].as_string().cast(BigInteger) >= BASE_USER_ID))
+        await session.execute(delete(Subscription).where(Subscription.user_id >= BASE_USER_ID))
+        await session.execute(delete(User).where(User.id >= BASE_USER_ID))
+        created = datetime.utcnow() - timedelta(hours=1)
+        session.add_all(User(id=user_id, registration_date=created) for user_id in user_ids)
+        await session.flush()
+        session.add_all(
+            Subscription(
+                user_id=user_id, tariff_code="1m", data_limit_gb=100, status="pending", is_paid=False,
+                invoice_id=str(BASE_INVOICE_ID + i), created_at=created,
+            )
+            for i, user_id in enumerate(user_ids)
+        )
+        await session.commit()
+    return user_ids
+
+
+async def cleanup():
+    async with await get_db_session() as session:
+        await session.execute(delete(Payment).where(Payment.user_id >= BASE_USER_ID))
+        await session.execute(delete(OutboxJob).where(OutboxJob.payload["user_id"].as_string().cast(BigInteger) >= BASE_USER_ID))
+        await session.execute(delete(Subscription).where(Subscription.user_id >= BASE_USER_ID))
+        await session.execute(delete(User).where(User.id >= BASE_USER_ID))
+        await session.commit()
+
+
+async def parent(invoices: int, replicas: int, waves: int, kill_after: float, timeout: float, unsafe: bool):
+    from app.services.marzban_pool import marzban_client
+    from fake_bot_api import FakeBotAPI
+    from fake_cryptopay import FakeCryptoPay
+    from fake_marzban import FakeMarzban
+
+    panel, pay, api = FakeMarzban(latency_s=0.02), FakeCryptoPay(), FakeBotAPI()
+    for server in (panel, pay, api):
+        await server.start()
+    await init_db()
+    user_ids = await seed(invoices)
+
+    leaders: list[tuple[float, int]] = []
+    ready: set[int] = set()
+    procs: dict[int, asyncio.subprocess.Process] = {}
+
+    async def spawn():
+        args = [sys.executable, os.path.abspath(__file__), "--child"] + (["--unsafe"] if unsafe else [])
+        proc = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE)
+        procs[proc.pid] = proc
+
+        async def read():
+            async for line in proc.stdout:
+                kind, _, pid = line.decode().strip().partition(" ")
+                if kind == "LEADER":
+                    leaders.append((time.monotonic(), int(pid)))
+                elif kind == "READY":
+                    ready.add(int(pid))
+        asyncio.create_task(read())
+
+    for _ in range(replicas):
+        await spawn()
+    while len(ready) < replicas or not leaders:
+        await asyncio.sleep(0.1)
+
+    started = time.monotonic()
+    killed_at = None
+    invoice_ids = [BASE_INVOICE_ID + i for i in range(invoices)]
+    wave = -(-invoices // waves)
+    try:
+        while time.monotonic() - started < timeout:
+            elapsed = time.monotonic() - started
+            paid_waves = min(waves, int(elapsed) + 1)
+            pay.mark_paid(invoice_ids[:paid_waves * wave])
+
+            if killed_at is None and elapsed >= kill_after and leaders:
+                victim = leaders[-1][1]
+                os.kill(victim, signal.SIGKILL)
+                killed_at = time.monotonic()
+                print(f"Убит лидер {victim} на {elapsed:.1f} с.")
+
+            async with await get_db_session() as session:
+                applied = await session.scalar(
+                    select(func.count()).select_from(Payment)
+                    .where(Payment.user_id >= BASE_USER_ID, Payment.status == "applied")
+                )
+            if applied == invoices and paid_waves == waves:
+                break
+            await asyncio.sleep(0.5)
+
+        month = marzban_client.metadata_presets["1m"]["expire"]
+        now_s = time.time()
+        months = [(panel.users[f"tg{user_id}"]["expire"] - now_s) / month for user_id in user_ids if f"tg{user_id}" in panel.users]
+        double = sum(1 for m in months if m > 1.5)
+        async with await get_db_session() as session:
+            statuses = dict((await session.execute(
+                select(Payment.status, func.count()).where(Payment.user_id >= BASE_USER_ID).group_by(Payment.status)
+            )).all())
+            paid_subs = await session.scalar(
+                select(func.count()).select_from(Subscription)
+                .where(Subscription.user_id >= BASE_USER_ID, Subscription.is_paid == True)
+            )
+
+        failover = None
+        if killed_at is not None:
+            after = [at for at, _ in leaders if at > killed_at]
+            failover = after[0] - killed_at if after else None
+        print(f"Реплик {replicas}{' + опрос без лидера' if unsafe else ''}, инвойсов {invoices}, "
+              f"за {time.monotonic() - started:.1f} с.")
+        print(f"Лидеры опроса: {[pid for _, pid in leaders]}; переключение после убийства: "
+              f"{f'{failover:.1f} с' if failover is not None else 'нет'}.")
+        print(f"Платежи: {statuses}; оплаченных подписок {paid_subs}; "
+              f"создано в панели {panel.calls.get('POST /api/user', 0)}; начислено дважды: {double}.")
+        ok = (statuses == {"applied": invoices} and paid_subs == invoices and len(months) == invoices
+              and double == 0 and panel.calls.get("POST /api/user", 0) == invoices
+              and (killed_at is None or failover is not None))
+        print("OK" if ok else "FAIL")
+    finally:
+        for proc in procs.values():
+            if proc.returncode is None:
+                proc.kill()
+        await asyncio.gather(*(proc.wait() for proc in procs.values()))
+        await cleanup()
+        await marzban_client.close()
+        for server in (panel, pay, api):
+            await server.stop()
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--invoices", type=int, default=200)
+    parser.add_argument("--replicas", type=int, default=3)
+    parser.add_argument("--waves", type=int, default=6, help="за сколько секунд-волн оплачиваются инвойсы")
+    parser.add_argument("--kill-after", type=float, default=3, help="когда убить лидера опроса, с")
+    parser.add_argument("--timeout", type=float, default=90)
+    parser.add_argument("--unsafe", action="store_true", help="дополнительно опрашивать без выбора лидера")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        asyncio.run(child(args.unsafe))
+    else:
+        asyncio.run(parent(args.invoices, args.replicas, args.waves, args.kill_after, args.timeout, args.unsafe))
@@ -0,0 +1,144 @@
+"""Пул панелей Marzban против нескольких фейковых панелей.
+
+Регистрирует --users пользователей через register_start и проверяет, что
+каждый создан ровно на одной панели, совпадающей с subscriptions.panel, а
+распределение близко к весам. Затем продлевает часть пользователей через
+apply_grant, отключает всех одной командой bulk_disable и синхронизирует
+panel_users — всё должно уйти на панель пользователя. В конце проверяет
+ребалансировку: после закрытия панели для новых пользователей и
+добавления новой старые пользователи остаются на своих панелях, а при
+hash-размещении меняется размещение не больше доли новой панели.
+
+Нужен DATABASE_URL на тестовую базу Postgres.
+
+Пример:
+    DATABASE_URL=postgresql://postgres@127.0.0.1/bot_bench \\
+        python scripts/check_panel_pool.py --users 600 --placement least_loaded
+"""
+import argparse
+import asyncio
+import collections
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+PANELS = [("p1", 8083, 1), ("p2", 8085, 1), ("p3", 8086, 2)]
+os.environ.setdefault("MARZBAN_PANELS", json.dumps([
+    {"name": name, "url": f"http://127.0.0.1:{port}", "weight": weight} for name, port, weight in PANELS
+]))
+os.environ.setdefault("MARZBAN_TOKEN_STATE_FILE", "")
+
+from sqlalchemy import delete, select
+
+from app.db.models import PanelUser, Subscription, User
+from app.db.database import engine, get_db_session, init_db
+from app.main_commands import register_start
+from app.services.marzban_api import MarzbanAPI
+from app.services.marzban_pool import MarzbanPool, marzban_client
+from app.services.panel_sync import sync_panel_users
+from fake_marzban import FakeMarzban
+
+BASE_USER_ID = 9_400_000_000
+
+
+async def cleanup():
+    async with await get_db_session() as session:
+        await session.execute(delete(Subscription).where(Subscription.user_id >= BASE_USER_ID))
+        await session.execute(delete(PanelUser).where(PanelUser.user_id >= BASE_USER_ID))
+        await session.execute(delete(User).where(User.id >= BASE_USER_ID))
+        await session.commit()
+
+
+def owners(fakes: dict[str, FakeMarzban], user_ids) -> dict[int, list[str]]:
+    return {user_id: [name for name, fake in fakes.items() if f"tg{user_id}" in fake.users] for user_id in user_ids}
+
+
+async def main(users: int, placement: str, concurrency: int):
+    fakes = {name: FakeMarzban(port=port, latency_s=0.005) for name, port, _ in PANELS}
+    for fake in fakes.values():
+        await fake.start()
+    marzban_client.placement = placement
+    await marzban_client.initialize()
+    await init_db()
+    await cleanup()
+    ok = True
+    try:
+        user_ids = [BASE_USER_ID + i for i in range(users)]
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def start(user_id: int):
+            async with semaphore:
+                await register_start(user_id, f"pool{user_id}", "Pool")
+
+        await asyncio.gather(*(start(user_id) for user_id in user_ids))
+
+        async with await get_db_session() as session:
+            stored = dict((await session.execute(
+                select(Subscription.user_id, Subscription.panel).where(Subscription.user_id >= BASE_USER_ID)
+            )).all())
+        where = owners(fakes, user_ids)
+        misplaced = [user_id for user_id in user_ids if where[user_id] != [stored.get(user_id)]]
+        counts = collections.Counter(stored.values())
+        total_weight = sum(weight for *_, weight in PANELS)
+        print(f"Размещение {placement}: {dict(sorted(counts.items()))}, ожидалось по весам "
+              f"{ {name: round(users * weight / total_weight) for name, _, weight in PANELS} }; не на своей панели: {len(misplaced)}.")
+        ok &= not misplaced and len(stored) == users
+
+        # Продление и массовое отключение должны уйти на панель пользователя.
+        posts_before = {name: fake.calls.get("POST /api/user", 0) for name, fake in fakes.items()}
+        renewed = user_ids[::10]
+        links = await asyncio.gather(*(
+            marzban_client.apply_grant(user_id, "1m", marzban_client.plan_grant("1m", None)) for user_id in renewed
+        ))
+        new_posts = sum(fake.calls.get("POST /api/user", 0) - posts_before[name] for name, fake in fakes.items())
+        print(f"Продлено {sum(1 for link in links if link)}/{len(renewed)}, лишних созданий: {new_posts}.")
+        ok &= all(links) and new_posts == 0
+
+        report = await marzban_client.bulk_disable_users(f"tg{user_id}" for user_id in user_ids)
+        disabled = sum(1 for fake in fakes.values() for user in fake.users.values()
+                       if user["username"].startswith("tg94") and user["status"] == "disabled")
+        print(f"bulk_disable: {dict(collections.Counter(report.values()))}, отключено в панелях {disabled}.")
+        ok &= disabled == users and set(report.values()) == {"ok"}
+
+        stats = await sync_panel_users()
+        async with await get_db_session() as session:
+            synced = dict((await session.execute(
+                select(PanelUser.user_id, PanelUser.panel).where(PanelUser.user_id >= BASE_USER_ID)
+            )).all())
+        wrong = sum(1 for user_id in user_ids if synced.get(user_id) != stored[user_id])
+        print(f"Синхронизация: просмотрено {stats['seen']}, полная {stats['complete']}; panel_users с чужой панелью: {wrong}.")
+        ok &= stats["complete"] and wrong == 0
+
+        # Ребалансировка: p1 закрыта для новых, добавлена p4. Старые пользователи остаются на месте.
+        p4 = MarzbanAPI(name="p4", base_urls=["http://127.0.0.1:8087"], token_state_file="")
+        rebalanced = MarzbanPool(
+            [*marzban_client.panels.values(), p4],
+            weights={**marzban_client.weights, "p4": 1}, accepting=["p2", "p3", "p4"], placement=placement,
+        )
+        moved_old = sum(1 for user_id, panel in (await rebalanced.panels_for(user_ids)).items() if panel != stored[user_id])
+        fresh = [BASE_USER_ID + users + i for i in range(users)]
+        before = {user_id: marzban_client._rendezvous(user_id) for user_id in fresh}
+        after = await rebalanced.panels_for(fresh)
+        to_p1 = sum(1 for panel in after.values() if panel == "p1")
+        changed = sum(1 for user_id in fresh if after[user_id] != before[user_id])
+        print(f"Ребалансировка: старых пользователей сменили панель {moved_old}, новых на закрытую p1: {to_p1}, "
+              f"новых размещено иначе, чем до изменений: {changed}/{len(fresh)} "
+              f"({dict(sorted(collections.Counter(after.values()).items()))}).")
+        ok &= moved_old == 0 and to_p1 == 0
+        print("OK" if ok else "FAIL")
+    finally:
+        await cleanup()
+        await marzban_client.close()
+        for fake in fakes.values():
+            await fake.stop()
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=400)
+    parser.add_argument("--placement", choices=("hash", "least_loaded"), default="hash")
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+    asyncio.run(main(args.users, args.placement, args.concurrency))
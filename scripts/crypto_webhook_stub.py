@@ -0,0 +1,68 @@
+"""Локальная заглушка Crypto Pay: отправляет подписанный invoice_paid на вебхук бота.
+
+Пример:
+    python scripts/crypto_webhook_stub.py --invoice-id 12345 --url http://localhost:8080/crypto/webhook
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services.crypto_webhook import SIGNATURE_HEADER, compute_signature
+from config import CRYPTO_TOKEN, CRYPTO_WEBHOOK_PATH
+
+
+def build_invoice_paid(invoice_id: int, payload: str) -> dict:
+    return {
+        "update_id": int(time.time()),
+        "update_type": "invoice_paid",
+        "request_date": time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime()),
+        "payload": {
+            "invoice_id": invoice_id,
+            "status": "paid",
+            "asset": "USDT",
+            "payload": payload,
+            "paid_at": time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime()),
+        },
+    }
+
+
+async def send(url: str, token: str, update: dict, bad_signature: bool = False) -> int:
+    body = json.dumps(update).encode()
+    signature = compute_signature(token, body)
+    if bad_signature:
+        signature = "0" * len(signature)
+
+    async with aiohttp.ClientSession() as session:
+        started = time.perf_counter()
+        async with session.post(
+            url,
+            data=body,
+            headers={SIGNATURE_HEADER: signature, "Content-Type": "application/json"},
+        ) as response:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            print(f"{response.status} за {elapsed_ms:.1f} мс: {await response.text()}")
+            return response.status
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--invoice-id", type=int, required=True)
+    parser.add_argument("--payload", default="crypto_1m_0")
+    parser.add_argument("--url", default=f"http://localhost:{os.environ.get('PORT', 8080)}{CRYPTO_WEBHOOK_PATH}")
+    parser.add_argument("--token", default=CRYPTO_TOKEN)
+    parser.add_argument("--bad-signature", action="store_true", help="проверить отказ при неверной подписи")
+    args = parser.parse_args()
+
+    update = build_invoice_paid(args.invoice_id, args.payload)
+    asyncio.run(send(args.url, args.token, update, bad_signature=args.bad_signature))
+
+
+if __name__ == "__main__":
+    main()
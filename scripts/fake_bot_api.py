@@ -0,0 +1,195 @@
+"""Локальный фейковый Telegram Bot API для бенчмарков.
+
+Отдаёт обновления через getUpdates (long polling) или POST на вебхук бота
+и фиксирует момент, когда бот отвечает sendMessage, чтобы измерять
+задержку «обновление → ответ».
+
+С rate_limit sendMessage ограничен как у настоящего Bot API: сверх лимита
+за скользящую секунду отвечает 429 с retry_after. Чаты из blocked_chats
+отвечают 403, как пользователь, заблокировавший бота. latency_s и
+error_rate добавляют задержку и долю ответов 500 ко всем методам, кроме
+getUpdates.
+"""
+import asyncio
+import collections
+import itertools
+import random
+import time
+
+from aiohttp import ClientSession, web
+
+FAKE_TOKEN = "123456:TEST-fake-token"
+
+
+def make_text_update(update_id: int, user_id: int, text: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+            "text": text,
+        },
+    }
+
+
+class FakeBotAPI:
+    def __init__(self, host: str = "127.0.0.1", port: int = 8081,
+                 rate_limit: int | None = None, retry_after: int = 1, blocked_chats: set[int] | None = None,
+                 latency_s: float = 0.0, error_rate: float = 0.0):
+        self.host = host
+        self.port = port
+        self.latency_s = latency_s
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.blocked_chats = blocked_chats or set()
+        self.delivered: collections.Counter = collections.Counter()
+        self.rejected: collections.Counter = collections.Counter()
+        self._window: collections.deque = collections.deque()
+        self._flood_until = 0.0
+        self.updates: list[dict] = []
+        self.update_available = asyncio.Event()
+        self.webhook_url: str | None = None
+        self.webhook_secret: str | None = None
+        self.sent_at: dict[int, float] = {}
+        self.calls: dict[str, int] = {}
+        self.reply_waiters: dict[int, asyncio.Future] = {}
+        self._message_ids = itertools.count(1_000_000)
+        self._runner: web.AppRunner | None = None
+        self._client: ClientSession | None = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._dispatch)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self._client = ClientSession()
+
+    async def stop(self):
+        if self._client:
+            await self._client.close()
+        if self._runner:
+            await self._runner.cleanup()
+
+    async def push_update(self, update: dict) -> asyncio.Future:
+        """Отдаёт обновление боту и возвращает future, завершаемую ответом бота."""
+        chat_id = update["message"]["chat"]["id"]
+        waiter = asyncio.get_running_loop().create_future()
+        self.reply_waiters[chat_id] = waiter
+        self.sent_at[chat_id] = time.perf_counter()
+
+        if self.webhook_url:
+            headers = {}
+            if self.webhook_secret:
+                headers["X-Telegram-Bot-Api-Secret-Token"] = self.webhook_secret
+            async with self._client.post(self.webhook_url, json=update, headers=headers) as response:
+                await response.read()
+        else:
+            self.updates.append(update)
+            self.update_available.set()
+        return waiter
+
+    async def _dispatch(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        data = dict(await request.post())
+        handler = getattr(self, f"_{method}", None)
+        if method != "getUpdates":
+            if self.latency_s:
+                await asyncio.sleep(self.latency_s)
+            if self.error_rate and random.random() < self.error_rate:
+                return self._error(500, "Internal Server Error: injected failure")
+        if handler is None:
+            return web.json_response({"ok": True, "result": True})
+        if method == "sendMessage":
+            error = self._check_limits(int(data["chat_id"]))
+            if error is not None:
+                return error
+        return web.json_response({"ok": True, "result": await handler(data)})
+
+    def _error(self, code: int, description: str, **parameters) -> web.Response:
+        self.rejected[code] += 1
+        body = {"ok": False, "error_code": code, "description": description}
+        if parameters:
+            body["parameters"] = parameters
+        return web.json_response(body, status=code)
+
+    def _check_limits(self, chat_id: int) -> web.Response | None:
+        now = time.monotonic()
+        if self.rate_limit is not None:
+            if now < self._flood_until:
+                return self._error(429, f"Too Many Requests: retry after {self.retry_after}", retry_after=self.retry_after)
+            while self._window and now - self._window[0] >= 1:
+                self._window.popleft()
+            if len(self._window) >= self.rate_limit:
+                # Как и Telegram, наказываем бота целиком до истечения retry_after.
+                self._flood_until = now + self.retry_after
+                return self._error(429, f"Too Many Requests: retry after {self.retry_after}", retry_after=self.retry_after)
+            self._window.append(now)
+        if chat_id in self.blocked_chats:
+            return self._error(403, "Forbidden: bot was blocked by the user")
+        return None
+
+    async def _getMe(self, data: dict):
+        return {"id": 123456, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+
+    async def _getUpdates(self, data: dict):
+        offset = int(data.get("offset") or 0)
+        timeout = float(data.get("timeout") or 0)
+        self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates and timeout:
+            self.update_available.clear()
+            try:
+                await asyncio.wait_for(self.update_available.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return [u for u in self.updates if u["update_id"] >= offset]
+
+    async def _setWebhook(self, data: dict):
+        self.webhook_url = data.get("url")
+        self.webhook_secret = data.get("secret_token")
+        return True
+
+    async def _deleteWebhook(self, data: dict):
+        self.webhook_url = None
+        self.webhook_secret = None
+        return True
+
+    async def _editMessageText(self, data: dict):
+        return {
+            "message_id": int(data.get("message_id") or 0),
+            "date": int(time.time()),
+            "chat": {"id": int(data.get("chat_id") or 0), "type": "private"},
+            "text": data.get("text", ""),
+        }
+
+    async def _sendInvoice(self, data: dict):
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(data["chat_id"]), "type": "private"},
+            "invoice": {
+                "title": data.get("title", ""), "description": data.get("description", ""),
+                "start_parameter": "", "currency": data.get("currency", "XTR"), "total_amount": 0,
+            },
+        }
+
+    async def _sendMessage(self, data: dict):
+        chat_id = int(data["chat_id"])
+        self.delivered[chat_id] += 1
+        waiter = self.reply_waiters.pop(chat_id, None)
+        if waiter and not waiter.done():
+            waiter.set_result(time.perf_counter() - self.sent_at.pop(chat_id))
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": data.get("text", ""),
+        }
@@ -0,0 +1,95 @@
+"""Локальный фейковый Crypto Pay API: createInvoice и getInvoices.
+
+Статусы инвойсов хранятся в statuses и меняются на лету (mark_paid),
+чтобы опрос check_crypto_payments видел оплату «в процессе» работы бота.
+С paid_after_s созданный инвойс сам становится paid через столько секунд.
+latency_s и error_rate добавляют задержку и долю ответов 500.
+"""
+import asyncio
+import itertools
+import random
+import time
+
+from aiohttp import web
+
+
+class FakeCryptoPay:
+    def __init__(self, host: str = "127.0.0.1", port: int = 8084,
+                 latency_s: float = 0.0, error_rate: float = 0.0, paid_after_s: float | None = None):
+        self.host = host
+        self.port = port
+        self.latency_s = latency_s
+        self.error_rate = error_rate
+        self.paid_after_s = paid_after_s
+        self.statuses: dict[int, str] = {}
+        self.created: dict[int, float] = {}
+        self.calls: dict[str, int] = {}
+        # Номера от текущего времени не пересекаются с инвойсами прошлых прогонов в той же базе.
+        self._invoice_ids = itertools.count(int(time.time()) * 1000)
+        self._runner: web.AppRunner | None = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def mark_paid(self, invoice_ids):
+        for invoice_id in invoice_ids:
+            self.statuses[int(invoice_id)] = "paid"
+
+    async def start(self):
+        app = web.Application(middlewares=[self._chaos])
+        app.router.add_get("/api/createInvoice", self._create_invoice)
+        app.router.add_get("/api/getInvoices", self._get_invoices)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    @web.middleware
+    async def _chaos(self, request: web.Request, handler):
+        key = request.path.removeprefix("/api/")
+        self.calls[key] = self.calls.get(key, 0) + 1
+        if self.latency_s:
+            await asyncio.sleep(self.latency_s)
+        if self.error_rate and random.random() < self.error_rate:
+            return web.json_response({"ok": False, "error": {"code": 500, "name": "INJECTED_FAILURE"}}, status=500)
+        return await handler(request)
+
+    def _status(self, invoice_id: int) -> str:
+        status = self.statuses.get(invoice_id, "active")
+        created = self.created.get(invoice_id)
+        if status == "active" and created is not None and self.paid_after_s is not None \
+                and time.monotonic() - created >= self.paid_after_s:
+            status = self.statuses[invoice_id] = "paid"
+        return status
+
+    def _invoice(self, invoice_id: int, **fields) -> dict:
+        now = time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime())
+        return {
+            "invoice_id": invoice_id,
+            "status": self._status(invoice_id),
+            "hash": f"IV{invoice_id}",
+            "asset": "USDT",
+            "amount": "3",
+            "bot_invoice_url": f"https://t.me/CryptoBot?start=IV{invoice_id}",
+            "web_app_invoice_url": f"https://app.example/IV{invoice_id}",
+            "mini_app_invoice_url": f"https://t.me/CryptoBot/app?startapp=IV{invoice_id}",
+            "created_at": now,
+            "allow_comments": True,
+            "allow_anonymous": True,
+            "currency_type": "crypto",
+            **fields,
+        }
+
+    async def _create_invoice(self, request: web.Request):
+        invoice_id = next(self._invoice_ids)
+        self.created[invoice_id] = time.monotonic()
+        fields = {key: request.query[key] for key in ("asset", "amount", "description", "payload") if key in request.query}
+        return web.json_response({"ok": True, "result": self._invoice(invoice_id, **fields)})
+
+    async def _get_invoices(self, request: web.Request):
+        ids = [int(i) for i in request.query.get("invoice_ids", "").split(",") if i]
+        return web.json_response({"ok": True, "result": {"items": [self._invoice(i) for i in ids]}})
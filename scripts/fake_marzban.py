@@ -0,0 +1,156 @@
+"""Локальная фейковая панель Marzban с инъекцией задержек и 5xx-ошибок.
+
+Хранит пользователей в памяти и реализует эндпоинты, которыми пользуется
+MarzbanAPI. Задержку и долю ошибок можно менять на лету (latency_s,
+error_rate), чтобы проверять дедлайны, повторы и circuit breaker.
+
+Инбаунды (inbounds: тег → адреса хостов) и ноды (add_node, nodes с
+status и накопленным трафиком uplink/downlink) отдаются через api/inbounds,
+api/hosts, api/nodes и api/nodes/usage для снимка здоровья панели.
+"""
+import asyncio
+import base64
+import json
+import random
+import time
+
+from aiohttp import web
+
+
+def make_jwt(exp: float) -> str:
+    encode = lambda obj: base64.urlsafe_b64encode(json.dumps(obj).encode()).rstrip(b"=").decode()
+    return f"{encode({'alg': 'HS256', 'typ': 'JWT'})}.{encode({'sub': 'admin', 'exp': int(exp)})}.signature"
+
+
+class FakeMarzban:
+    def __init__(self, host: str = "127.0.0.1", port: int = 8083,
+                 latency_s: float = 0.0, error_rate: float = 0.0, token_ttl_s: float = 86400):
+        self.host = host
+        self.port = port
+        self.latency_s = latency_s
+        self.error_rate = error_rate
+        self.token_ttl_s = token_ttl_s
+        self.users: dict[str, dict] = {}
+        self.tokens: set[str] = set()
+        self.calls: dict[str, int] = {}
+        self.inbounds: dict[str, list[str]] = {"VLESS TCP REALITY": ["{SERVER_IP}"]}
+        self.nodes: dict[str, dict] = {}
+        self.master_traffic = 0
+        self._runner: web.AppRunner | None = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def add_node(self, name: str, address: str, status: str = "connected") -> dict:
+        node = self.nodes[name] = {
+            "id": len(self.nodes) + 1, "name": name, "address": address, "port": 62050, "api_port": 62051,
+            "usage_coefficient": 1.0, "xray_version": "1.8.24", "status": status, "message": None,
+            "uplink": 0, "downlink": 0,
+        }
+        return node
+
+    async def start(self):
+        app = web.Application(middlewares=[self._chaos])
+        app.router.add_post("/api/admin/token", self._token)
+        app.router.add_get("/api/user/{username}", self._get_user)
+        app.router.add_put("/api/user/{username}", self._put_user)
+        app.router.add_post("/api/user", self._post_user)
+        app.router.add_get("/api/users", self._list_users)
+        app.router.add_get("/api/inbounds", self._inbounds)
+        app.router.add_get("/api/hosts", self._hosts)
+        app.router.add_get("/api/nodes", self._nodes)
+        app.router.add_get("/api/nodes/usage", self._nodes_usage)
+        app.router.add_get("/api/system", self._system)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    @web.middleware
+    async def _chaos(self, request: web.Request, handler):
+        key = f"{request.method} {request.path}"
+        self.calls[key] = self.calls.get(key, 0) + 1
+        if self.latency_s:
+            await asyncio.sleep(self.latency_s)
+        if self.error_rate and random.random() < self.error_rate:
+            return web.json_response({"detail": "injected failure"}, status=503)
+        if request.path != "/api/admin/token":
+            token = request.headers.get("Authorization", "").removeprefix("Bearer ")
+            if token not in self.tokens:
+                return web.json_response({"detail": "Could not validate credentials"}, status=401)
+        return await handler(request)
+
+    def _user_view(self, user: dict) -> dict:
+        return {**user, "subscription_url": f"https://sub.example/{user['username']}", "links": []}
+
+    async def _token(self, request: web.Request):
+        token = make_jwt(time.time() + self.token_ttl_s)
+        self.tokens.add(token)
+        return web.json_response({"access_token": token, "token_type": "bearer"})
+
+    async def _get_user(self, request: web.Request):
+        user = self.users.get(request.match_info["username"])
+        if not user:
+            return web.json_response({"detail": "User not found"}, status=404)
+        return web.json_response(self._user_view(user))
+
+    async def _put_user(self, request: web.Request):
+        username = request.match_info["username"]
+        if username not in self.users:
+            return web.json_response({"detail": "User not found"}, status=404)
+        self.users[username].update(await request.json())
+        self.users[username]["username"] = username
+        return web.json_response(self._user_view(self.users[username]))
+
+    async def _post_user(self, request: web.Request):
+        payload = await request.json()
+        username = payload["username"]
+        if username in self.users:
+            return web.json_response({"detail": "User already exists"}, status=409)
+        self.users[username] = {"data_usage": 0, "used_traffic": 0, **payload}
+        return web.json_response(self._user_view(self.users[username]))
+
+    async def _list_users(self, request: web.Request):
+        offset = int(request.query.get("offset", 0))
+        limit = int(request.query.get("limit", 100))
+        names = sorted(self.users)
+        wanted = request.query.getall("username", [])
+        if wanted:
+            names = [n for n in names if n in set(wanted)]
+        page = names[offset:offset + limit]
+        return web.json_response({
+            "users": [self._user_view(self.users[n]) for n in page],
+            "total": len(names),
+        })
+
+    async def _inbounds(self, request: web.Request):
+        return web.json_response({"vless": [
+            {"tag": tag, "protocol": "vless", "network": "tcp", "tls": "reality", "port": 443} for tag in self.inbounds
+        ]})
+
+    async def _hosts(self, request: web.Request):
+        return web.json_response({
+            tag: [{"remark": f"{tag} ({address})", "address": address, "port": None} for address in addresses]
+            for tag, addresses in self.inbounds.items()
+        })
+
+    async def _nodes(self, request: web.Request):
+        return web.json_response([
+            {key: value for key, value in node.items() if key not in ("uplink", "downlink")} for node in self.nodes.values()
+        ])
+
+    async def _nodes_usage(self, request: web.Request):
+        usages = [{"node_id": None, "node_name": "Master", "uplink": self.master_traffic, "downlink": 0}]
+        usages += [
+            {"node_id": node["id"], "node_name": node["name"], "uplink": node["uplink"], "downlink": node["downlink"]}
+            for node in self.nodes.values()
+        ]
+        return web.json_response({"usages": usages})
+
+    async def _system(self, request: web.Request):
+        active = sum(1 for user in self.users.values() if user.get("status") == "active")
+        return web.json_response({"version": "0.8.4", "total_user": len(self.users), "users_active": active})